@@ -1,33 +1,83 @@
 import os
-import mimetypes
+import json
+import shutil
+import time
+import base64
+import binascii
+import hashlib
 from datetime import datetime
 from typing import Optional
 
 from flask import (
     Blueprint,
+    Response,
     jsonify,
     request,
     session,
     current_app,
+    stream_with_context,
     url_for,
 )
-from sqlalchemy import or_
+from sqlalchemy import String, and_, case, func, or_, select, type_coerce
 from werkzeug.utils import secure_filename
 from werkzeug.security import check_password_hash
 
-from models import db, Archivo, Etiqueta, Playlist, Usuario
+from models import (
+    db,
+    Archivo,
+    Etiqueta,
+    Playlist,
+    Subida,
+    Tarea,
+    Usuario,
+    archivo_etiqueta,
+    favoritos,
+    playlist_archivo,
+)
 from utils import (
-    guardar_miniatura_si_es_imagen,
-    convertir_doc_a_pdf,
-    convertir_video_a_audio,
-    generar_miniatura_pdf,
-    generar_miniatura_video,
+    condicion_visible,
+    nombre_libre,
     usuario_puede_ver,
 )
+from hls import url_hls
+from miniaturas import srcset_miniatura, url_miniatura
+from variantes import srcset_variantes
+from busqueda import condicion_busqueda, es_sqlite, fts_disponible, marcar, subconsulta_fts
+from tareas import ESTADOS_FINALES, cancelar
+from ingesta import ingerir, medir, recibir
+from subidas import (
+    ErrorSubida,
+    crear as crear_subida,
+    descartar as descartar_subida,
+    escribiendo as subida_escribiendo,
+    escribir_trozo,
+    reclamar_para_finalizar,
+    ruta_temporal,
+)
 
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 
+# Maximum number of bound parameters per IN (...) clause in batch queries.
+IN_CLAUSE_CHUNK = 500
+
+# Page size bounds for the keyset-paginated file listing.
+DEFAULT_PAGE_SIZE = 60
+MAX_PAGE_SIZE = 500
+
+# Sort key per `order` value: (column, descending). The primary key is always
+# appended as tie-breaker so the cursor position is unique.
+ORDER_MAP = {
+    "recent": (Archivo.fecha_subida, True),
+    "oldest": (Archivo.fecha_subida, False),
+    "name": (Archivo.nombre, False),
+    "name_desc": (Archivo.nombre, True),
+}
+
+# Search results may also be sorted by bm25 rank (lower is better). The rank
+# column only exists in the full-text subquery, so it is resolved per request.
+RELEVANCE = "relevance"
+
 
 def _current_user():
     """Return the currently authenticated user, or None."""
@@ -51,65 +101,168 @@ def _serialize_user(usuario: Usuario) -> dict:
     }
 
 
-def _build_media_url(archivo: Archivo, nombre: str) -> Optional[str]:
-    """Create a /media URL for a given file if the file exists."""
-    if archivo.es_privado and not session.get("acceso_privado"):
-        return None
+def _build_media_url(archivo: Archivo, nombre: Optional[str]) -> Optional[str]:
+    """Create a /media URL for a given file name if the user may access it.
 
-    carpeta_base = (
-        current_app.config["PRIVATE_UPLOAD_FOLDER"]
-        if archivo.es_privado
-        else current_app.config["UPLOAD_FOLDER"]
-    )
-    ruta = os.path.join(carpeta_base, nombre)
-    if not os.path.exists(ruta):
+    Availability comes from the stored row (``ruta``) instead of touching the
+    filesystem, so listings never stat files. Thumbnails go through
+    ``url_miniatura``.
+    """
+    if not nombre:
+        return None
+    if archivo.es_privado and not session.get("acceso_privado"):
         return None
     return url_for("media", nombre=nombre)
 
 
-def _serialize_archivo(archivo: Archivo, usuario: Optional[Usuario]) -> dict:
-    """Transform an Archivo instance into a JSON-safe dictionary."""
-    favorite_ids = {a.id for a in usuario.favoritos} if usuario else set()
+def _chunks(valores: list, size: int = IN_CLAUSE_CHUNK):
+    """Yield successive slices of `valores` small enough for an IN clause."""
+    for inicio in range(0, len(valores), size):
+        yield valores[inicio:inicio + size]
 
-    thumb_name = f"thumb_{archivo.nombre}"
-    media_url = _build_media_url(archivo, archivo.nombre)
-    thumb_url = _build_media_url(archivo, thumb_name)
 
-    safe_size = 0
-    if archivo.ruta and os.path.exists(archivo.ruta):
-        safe_size = os.path.getsize(archivo.ruta)
+def _serialize_archivos(archivos: list, usuario: Optional[Usuario]) -> list:
+    """Transform a batch of Archivo instances into JSON-safe dictionaries.
 
-    return {
-        "id": archivo.id,
-        "name": archivo.nombre,
-        "description": archivo.descripcion or "",
-        "mimeType": archivo.tipo,
-        "size": safe_size,
-        "uploadedAt": archivo.fecha_subida.isoformat() if archivo.fecha_subida else None,
-        "isPrivate": bool(archivo.es_privado),
-        "isFavorite": archivo.id in favorite_ids,
-        "thumbnailUrl": thumb_url,
-        "mediaUrl": media_url,
-        "tags": [etiqueta.nombre for etiqueta in archivo.etiquetas],
+    Tags and favorites for the whole batch are fetched with one query each,
+    so the cost does not grow with one extra round-trip per file.
+    """
+    ids = list({archivo.id for archivo in archivos})
+
+    favorite_ids = set()
+    tags_por_archivo = {}
+    for bloque in _chunks(ids):
+        if usuario:
+            favorite_ids.update(
+                db.session.execute(
+                    select(favoritos.c.archivo_id).where(
+                        favoritos.c.usuario_id == usuario.id,
+                        favoritos.c.archivo_id.in_(bloque),
+                    )
+                ).scalars()
+            )
+
+        filas = db.session.execute(
+            select(archivo_etiqueta.c.archivo_id, Etiqueta.nombre)
+            .join(Etiqueta, Etiqueta.id == archivo_etiqueta.c.etiqueta_id)
+            .where(archivo_etiqueta.c.archivo_id.in_(bloque))
+            .order_by(Etiqueta.nombre)
+        )
+        for archivo_id, nombre in filas:
+            tags_por_archivo.setdefault(archivo_id, []).append(nombre)
+
+    return [
+        {
+            "id": archivo.id,
+            "name": archivo.nombre,
+            "description": archivo.descripcion or "",
+            "mimeType": archivo.tipo,
+            "size": archivo.tamaño or 0,
+            "uploadedAt": archivo.fecha_subida.isoformat() if archivo.fecha_subida else None,
+            "isPrivate": bool(archivo.es_privado),
+            "isFavorite": archivo.id in favorite_ids,
+            "thumbnailUrl": url_miniatura(archivo),
+            "thumbnailSrcSet": srcset_miniatura(archivo),
+            "imageSrcSet": srcset_variantes(archivo),
+            "mediaUrl": _build_media_url(archivo, archivo.nombre if archivo.ruta else None),
+            "hlsUrl": url_hls(archivo),
+            "tags": tags_por_archivo.get(archivo.id, []),
+        }
+        for archivo in archivos
+    ]
+
+
+def _serialize_archivo(archivo: Archivo, usuario: Optional[Usuario]) -> dict:
+    """Transform a single Archivo instance into a JSON-safe dictionary."""
+    return _serialize_archivos([archivo], usuario)[0]
+
+
+def _serialize_playlists(playlists: list, usuario: Optional[Usuario]) -> list:
+    """Transform a batch of Playlist instances into JSON-safe dictionaries.
+
+    Visible items of every playlist are loaded in a single query, with the
+    visibility rules applied in SQL.
+    """
+    items_por_playlist = {playlist.id: [] for playlist in playlists}
+    for bloque in _chunks(list(items_por_playlist)):
+        filas = db.session.execute(
+            select(playlist_archivo.c.playlist_id, Archivo)
+            .join(Archivo, Archivo.id == playlist_archivo.c.archivo_id)
+            .where(playlist_archivo.c.playlist_id.in_(bloque), condicion_visible())
+        )
+        for playlist_id, archivo in filas:
+            items_por_playlist[playlist_id].append(archivo)
+
+    serializados = {
+        item["id"]: item
+        for item in _serialize_archivos(
+            [archivo for items in items_por_playlist.values() for archivo in items],
+            usuario,
+        )
     }
 
+    return [
+        {
+            "id": playlist.id,
+            "name": playlist.nombre,
+            "createdAt": playlist.fecha_creacion.isoformat()
+            if playlist.fecha_creacion
+            else None,
+            "items": [serializados[archivo.id] for archivo in items_por_playlist[playlist.id]],
+        }
+        for playlist in playlists
+    ]
+
 
 def _serialize_playlist(playlist: Playlist, usuario: Optional[Usuario]) -> dict:
-    """Transform a Playlist instance into a JSON-safe dictionary."""
+    """Transform a single Playlist instance into a JSON-safe dictionary."""
+    return _serialize_playlists([playlist], usuario)[0]
+
+
+def _serialize_tarea(tarea: Tarea) -> dict:
+    """Transform a background Tarea into a JSON-safe dictionary."""
+
+    def _fecha(valor):
+        return valor.isoformat() if valor else None
+
     return {
-        "id": playlist.id,
-        "name": playlist.nombre,
-        "createdAt": playlist.fecha_creacion.isoformat()
-        if playlist.fecha_creacion
-        else None,
-        "items": [
-            _serialize_archivo(archivo, usuario)
-            for archivo in playlist.archivos
-            if not archivo.fecha_eliminado and usuario_puede_ver(archivo)
-        ],
+        "id": tarea.id,
+        "type": tarea.tipo,
+        "fileId": tarea.archivo_id,
+        "status": tarea.estado,
+        "progress": tarea.progreso or 0,
+        "eta": tarea.eta,
+        "attempts": tarea.intentos or 0,
+        "error": tarea.error,
+        "createdAt": _fecha(tarea.fecha_creada),
+        "startedAt": _fecha(tarea.fecha_inicio),
+        "finishedAt": _fecha(tarea.fecha_fin),
+        "updatedAt": _fecha(tarea.fecha_actualizada),
     }
 
 
+def _parse_id_list(valor: Optional[str]) -> list:
+    """Parse a comma separated list of integer ids, ignoring garbage."""
+    return [int(parte) for parte in (valor or "").split(",") if parte.strip().isdigit()]
+
+
+def _visible_jobs_query():
+    """Jobs attached to files the current session is allowed to see."""
+    query = Tarea.query.join(Archivo, Archivo.id == Tarea.archivo_id).filter(condicion_visible())
+
+    ids = _parse_id_list(request.args.get("ids"))
+    if ids:
+        query = query.filter(Tarea.id.in_(ids))
+
+    file_ids = _parse_id_list(request.args.get("fileIds"))
+    if file_ids:
+        query = query.filter(Tarea.archivo_id.in_(file_ids))
+
+    if request.args.get("active") == "1":
+        query = query.filter(Tarea.estado.notin_(ESTADOS_FINALES))
+    return query
+
+
 @api_bp.route("/session", methods=["GET"])
 def session_status():
     """Expose the authentication status for the SPA."""
@@ -158,56 +311,226 @@ def api_logout():
     return jsonify({"authenticated": False}), 200
 
 
+def _filters_key(search: str, tipo: str, favorites: bool) -> str:
+    """Short fingerprint of the listing filters, so a cursor is only valid for its own listing."""
+    payload = json.dumps([search, tipo, favorites], separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def _encode_cursor(order: str, valor, archivo_id: int, totals: dict, filtros: str) -> str:
+    """Build the opaque token pointing right after the row (valor, archivo_id) in `order`."""
+    if isinstance(valor, datetime):
+        valor = valor.isoformat()
+    payload = json.dumps([order, valor, archivo_id, totals, filtros], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(token: str) -> Optional[tuple]:
+    """Parse a token produced by `_encode_cursor`, or None if it is invalid."""
+    try:
+        relleno = "=" * (-len(token) % 4)
+        order, valor, ultimo_id, totals, filtros = json.loads(
+            base64.urlsafe_b64decode(token + relleno).decode("utf-8")
+        )
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+    if (order not in ORDER_MAP and order != RELEVANCE) or not isinstance(ultimo_id, int):
+        return None
+    if not isinstance(totals, dict) or not isinstance(filtros, str):
+        return None
+
+    if order == RELEVANCE:
+        if not isinstance(valor, (int, float)):
+            return None
+    elif valor is not None and ORDER_MAP[order][0].key == "fecha_subida":
+        # Kept as text: `_sort_column` decides how it is compared.
+        try:
+            datetime.fromisoformat(valor)
+        except (TypeError, ValueError):
+            return None
+    return order, valor, ultimo_id, totals, filtros
+
+
+def _sort_column(order: str, conexion=None):
+    """Column to sort and page by for a non-relevance `order`.
+
+    SQLite stores dates as text in more than one format (server default
+    without microseconds, Python values with them) and compares them as
+    text, so the keyset must use the stored string rather than a bound
+    datetime, which would be rendered with microseconds.
+    """
+    columna, descendente = ORDER_MAP[order]
+    if columna.key == "fecha_subida" and es_sqlite(conexion):
+        columna = type_coerce(columna, String)
+    return columna, descendente
+
+
+def _cursor_value(order: str, columna, archivo: Archivo):
+    """Value of the sort column for the last row of a page, as `_after_cursor` expects it."""
+    if ORDER_MAP[order][0].key != "fecha_subida":
+        return getattr(archivo, columna.key)
+    if es_sqlite():
+        return db.session.execute(select(columna).where(Archivo.id == archivo.id)).scalar()
+    return archivo.fecha_subida
+
+
+def _after_cursor(columna, descendente: bool, valor, ultimo_id: int):
+    """Keyset predicate selecting the rows that follow (valor, ultimo_id).
+
+    NULLs are ordered as the lowest value (see `api_list_files`), so they come
+    first in ascending pages and last in descending ones.
+    """
+    if valor is None:
+        if descendente:
+            return and_(columna.is_(None), Archivo.id < ultimo_id)
+        return or_(columna.isnot(None), and_(columna.is_(None), Archivo.id > ultimo_id))
+
+    if descendente:
+        return or_(
+            columna < valor,
+            columna.is_(None),
+            and_(columna == valor, Archivo.id < ultimo_id),
+        )
+    return or_(columna > valor, and_(columna == valor, Archivo.id > ultimo_id))
+
+
+def _files_query(usuario_id: int, ver_privados: bool, search: str, busqueda, tipo: str, solo_favoritos: bool):
+    """Unordered query of the files /api/files lists for these filters.
+
+    `busqueda` is the full-text subquery for `search` (None to fall back to
+    ILIKE). Returns the query and the subquery of the user's favorite ids.
+    `flask explain` (planes.py) builds its checks with this same function.
+    """
+    query = Archivo.query.filter(condicion_visible(ver_privados))
+
+    if busqueda is not None:
+        query = query.join(busqueda, busqueda.c.archivo_id == Archivo.id).add_columns(
+            busqueda.c.rango, busqueda.c.nombre_marcado, busqueda.c.fragmento
+        )
+    elif search:
+        query = query.filter(condicion_busqueda(search))
+
+    if tipo:
+        query = query.filter(Archivo.tipo.ilike(f"{tipo}%"))
+
+    ids_favoritos = select(favoritos.c.archivo_id).where(favoritos.c.usuario_id == usuario_id)
+    if solo_favoritos:
+        query = query.filter(Archivo.id.in_(ids_favoritos))
+    return query, ids_favoritos
+
+
+def _count_files(query, ids_favoritos):
+    """Query returning (total, favorites, private) for a `_files_query`."""
+    return query.order_by(None).with_entities(
+        func.count(Archivo.id),
+        func.coalesce(func.sum(case((Archivo.id.in_(ids_favoritos), 1), else_=0)), 0),
+        func.coalesce(func.sum(case((Archivo.es_privado.is_(True), 1), else_=0)), 0),
+    )
+
+
+def _order_files(query, columna, descendente: bool, posicion: Optional[tuple] = None):
+    """Order a `_files_query` by `columna` and start after `posicion` (valor, ultimo_id)."""
+    if posicion is not None:
+        query = query.filter(_after_cursor(columna, descendente, *posicion))
+    if descendente:
+        return query.order_by(columna.desc().nulls_last(), Archivo.id.desc())
+    return query.order_by(columna.asc().nulls_first(), Archivo.id.asc())
+
+
 @api_bp.route("/files", methods=["GET"])
 def api_list_files():
-    """Return the accessible files for the current user."""
+    """Return one page of the accessible files for the current user.
+
+    Pages are addressed with an opaque `cursor` (the `nextCursor` of the
+    previous page) instead of offsets, so deep pages cost the same as the
+    first one. The totals (matching, favorite and private files) are only
+    counted on the first page and carried in the cursor afterwards, so later
+    pages report them as an estimate. A cursor is bound to the order and
+    filters it was issued for and is rejected with any others.
+
+    `search` goes through the full-text index when there is one (see
+    busqueda.py): results default to `order=relevance` and every item carries
+    a `highlight` with the matches wrapped in <mark>.
+    """
     usuario = _current_user()
     if not usuario:
         return jsonify({"error": "No autenticado."}), 401
 
-    favoritos_ids = {archivo.id for archivo in usuario.favoritos}
-
-    query = Archivo.query.filter(Archivo.fecha_eliminado.is_(None))
-
-    if not session.get("acceso_privado"):
-        query = query.filter(Archivo.es_privado.is_(False))
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Parámetro limit inválido."}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
 
     search = (request.args.get("search") or "").strip()
-    if search:
-        wildcard = f"%{search}%"
-        query = query.filter(
-            or_(
-                Archivo.nombre.ilike(wildcard),
-                Archivo.descripcion.ilike(wildcard),
-                Archivo.tipo.ilike(wildcard),
-            )
-        )
+    busqueda = subconsulta_fts(search) if search and fts_disponible() else None
+
+    order = request.args.get("order") or (RELEVANCE if busqueda is not None else "recent")
+    if order not in ORDER_MAP and (order != RELEVANCE or busqueda is None):
+        order = "recent"
 
     tipo = (request.args.get("type") or "").strip()
-    if tipo:
-        query = query.filter(Archivo.tipo.ilike(f"{tipo}%"))
+    solo_favoritos = request.args.get("favorites") == "1"
+    filtros = _filters_key(search, tipo, solo_favoritos)
+
+    cursor = None
+    token = request.args.get("cursor")
+    if token:
+        cursor = _decode_cursor(token)
+        if cursor is None or cursor[0] != order or cursor[4] != filtros:
+            return jsonify({"error": "Cursor inválido."}), 400
+
+    query, ids_favoritos = _files_query(
+        usuario.id, session.get("acceso_privado", False), search, busqueda, tipo, solo_favoritos
+    )
 
-    only_favorites = request.args.get("favorites") == "1"
-    if only_favorites:
-        if not favoritos_ids:
-            return jsonify([])
-        query = query.filter(Archivo.id.in_(favoritos_ids))
-
-    order = request.args.get("order", "recent")
-    order_map = {
-        "recent": Archivo.fecha_subida.desc(),
-        "oldest": Archivo.fecha_subida.asc(),
-        "name": Archivo.nombre.asc(),
-        "name_desc": Archivo.nombre.desc(),
-    }
-    query = query.order_by(order_map.get(order, Archivo.fecha_subida.desc()))
+    posicion = None
+    if cursor is None:
+        total, favoritos_total, privados_total = _count_files(query, ids_favoritos).one()
+        totals = {"total": total, "favorites": favoritos_total, "private": privados_total}
+    else:
+        _, valor, ultimo_id, totals, _ = cursor
+        if isinstance(valor, str) and not es_sqlite():
+            valor = datetime.fromisoformat(valor)
+        posicion = (valor, ultimo_id)
+
+    columna, descendente = (busqueda.c.rango, False) if order == RELEVANCE else _sort_column(order)
+    query = _order_files(query, columna, descendente, posicion)
+
+    # One extra row tells us whether another page exists without a COUNT.
+    filas = query.limit(limit + 1).all()
+    hay_mas = len(filas) > limit
+    filas = filas[:limit]
+
+    if busqueda is not None:
+        pagina = [fila[0] for fila in filas]
+        items = _serialize_archivos(pagina, usuario)
+        for item, (_, _, nombre_marcado, fragmento) in zip(items, filas):
+            item["highlight"] = {"name": marcar(nombre_marcado), "snippet": marcar(fragmento)}
+    else:
+        pagina = filas
+        items = _serialize_archivos(pagina, usuario)
 
-    archivos = [
-        _serialize_archivo(archivo, usuario)
-        for archivo in query.all()
-        if usuario_puede_ver(archivo)
-    ]
-    return jsonify(archivos), 200
+    next_cursor = None
+    if hay_mas:
+        ultima = pagina[-1]
+        valor = filas[-1][1] if order == RELEVANCE else _cursor_value(order, columna, ultima)
+        next_cursor = _encode_cursor(order, valor, ultima.id, totals, filtros)
+
+    return (
+        jsonify(
+            {
+                "items": items,
+                "nextCursor": next_cursor,
+                "total": totals.get("total", 0),
+                "favoritesTotal": totals.get("favorites", 0),
+                "privateTotal": totals.get("private", 0),
+                "totalIsEstimate": cursor is not None,
+            }
+        ),
+        200,
+    )
 
 
 @api_bp.route("/files/<int:archivo_id>", methods=["GET"])
@@ -257,6 +580,17 @@ def api_toggle_favorite(archivo_id: int):
     return jsonify({"id": archivo.id, "favorite": archivo in usuario.favoritos}), 200
 
 
+def _upload_folder(privado: bool) -> str:
+    """Destination folder for public or private uploads, created on demand."""
+    carpeta = (
+        current_app.config["PRIVATE_UPLOAD_FOLDER"]
+        if privado
+        else current_app.config["UPLOAD_FOLDER"]
+    )
+    os.makedirs(carpeta, exist_ok=True)
+    return carpeta
+
+
 @api_bp.route("/files", methods=["POST"])
 def api_upload_files():
     """Handle multi-file uploads triggered from the SPA."""
@@ -272,53 +606,32 @@ def api_upload_files():
     convertir_audio = request.form.get("convertToAudio") == "1"
     marcar_privado = request.form.get("private") == "1"
 
-    carpeta_destino = (
-        current_app.config["PRIVATE_UPLOAD_FOLDER"]
-        if marcar_privado
-        else current_app.config["UPLOAD_FOLDER"]
-    )
-    os.makedirs(carpeta_destino, exist_ok=True)
+    carpeta_destino = _upload_folder(marcar_privado)
 
     guardados = []
+    tareas = []
+    duplicados = []
 
     for archivo_subido in archivos:
         if not archivo_subido or not archivo_subido.filename:
             continue
 
-        filename = secure_filename(archivo_subido.filename)
-        ruta = os.path.join(carpeta_destino, filename)
-        thumb_path = os.path.join(carpeta_destino, f"thumb_{filename}")
-
-        archivo_subido.save(ruta)
-        tipo_detectado = (
-            mimetypes.guess_type(ruta)[0] or archivo_subido.mimetype or "application/octet-stream"
-        )
-
-        if tipo_detectado == "application/pdf":
-            generar_miniatura_pdf(ruta, thumb_path)
-        elif tipo_detectado.startswith("video/"):
-            generar_miniatura_video(ruta, thumb_path)
-        else:
-            guardar_miniatura_si_es_imagen(ruta, thumb_path, tipo_detectado)
+        filename = nombre_libre(carpeta_destino, secure_filename(archivo_subido.filename))
+        recibido = recibir(archivo_subido, carpeta_destino, filename)
 
-        nuevo = Archivo(
-            nombre=filename,
-            ruta=ruta,
-            tipo=tipo_detectado,
+        nuevo, existente, tareas_archivo = ingerir(
+            recibido,
             es_privado=marcar_privado,
+            convertir_pdf=convertir_pdf,
+            convertir_audio=convertir_audio,
+            ver_privados=session.get("acceso_privado", False),
             fecha_subida=datetime.utcnow(),
         )
-        db.session.add(nuevo)
-        guardados.append(nuevo)
-
-        ext = os.path.splitext(filename)[1].lower()
-        convertibles = {".doc", ".docx", ".odt", ".ppt", ".pptx", ".xls", ".xlsx"}
-
-        if convertir_pdf and ext in convertibles:
-            convertir_doc_a_pdf(ruta, carpeta_destino)
-
-        if convertir_audio and tipo_detectado.startswith("video/"):
-            convertir_video_a_audio(ruta, carpeta_destino)
+        tareas.extend(tareas_archivo)
+        if existente is not None:
+            duplicados.append(_serialize_duplicado(filename, existente, nuevo is None))
+        if nuevo is not None:
+            guardados.append(nuevo)
 
     db.session.commit()
 
@@ -326,14 +639,210 @@ def api_upload_files():
     return (
         jsonify(
             {
-                "uploaded": [_serialize_archivo(archivo, usuario) for archivo in guardados],
+                "uploaded": _serialize_archivos(guardados, usuario),
                 "count": len(guardados),
+                "jobs": [_serialize_tarea(tarea) for tarea in tareas],
+                "duplicates": duplicados,
             }
         ),
         201,
     )
 
 
+def _serialize_duplicado(nombre: str, existente: Archivo, rechazado: bool) -> dict:
+    """Describe an upload whose bytes were already in the library.
+
+    The existing file is only identified if the uploader may see it.
+    """
+    visible = not existente.es_privado or session.get("acceso_privado", False)
+    return {"name": nombre, "existingId": existente.id if visible else None, "rejected": rechazado}
+
+
+def _serialize_subida(subida: Subida) -> dict:
+    """Transform a chunked upload session into a JSON-safe dictionary."""
+    return {
+        "id": subida.id,
+        "name": subida.nombre,
+        "size": subida.tamaño,
+        "offset": subida.recibido,
+        "status": subida.estado,
+        "fileId": subida.archivo_id,
+        "rejected": bool(subida.rechazada),
+    }
+
+
+def _subida_response(subida: Subida, status: int = 200, **extra):
+    """JSON body plus the tus-style Upload-Offset / Upload-Length headers."""
+    respuesta = jsonify({**_serialize_subida(subida), **extra})
+    respuesta.status_code = status
+    respuesta.headers["Upload-Offset"] = str(subida.recibido)
+    respuesta.headers["Upload-Length"] = str(subida.tamaño)
+    respuesta.headers["Cache-Control"] = "no-store"
+    return respuesta
+
+
+def _own_subida(subida_id: str, usuario: Usuario) -> Optional[Subida]:
+    """Fetch an upload session only if it belongs to `usuario`."""
+    subida = db.session.get(Subida, subida_id)
+    if subida is None or subida.usuario_id != usuario.id:
+        return None
+    return subida
+
+
+@api_bp.errorhandler(ErrorSubida)
+def _handle_upload_error(error: ErrorSubida):
+    return jsonify({"error": str(error)}), error.codigo
+
+
+@api_bp.route("/uploads", methods=["POST"])
+def api_create_upload():
+    """Start a resumable chunked upload. Body: name, size, private, convertTo*."""
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    payload = request.get_json(silent=True) or {}
+    subida = crear_subida(
+        usuario,
+        secure_filename(payload.get("name") or ""),
+        payload.get("size"),
+        es_privado=bool(payload.get("private")),
+        opciones={
+            "convertToPdf": bool(payload.get("convertToPdf")),
+            "convertToAudio": bool(payload.get("convertToAudio")),
+        },
+    )
+
+    respuesta = _subida_response(subida, 201)
+    respuesta.headers["Location"] = url_for("api.api_upload_status", subida_id=subida.id)
+    return respuesta
+
+
+@api_bp.route("/uploads/<subida_id>", methods=["GET"])
+def api_upload_status(subida_id: str):
+    """Report the confirmed offset so the client knows where to resume (also HEAD)."""
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    subida = _own_subida(subida_id, usuario)
+    if subida is None:
+        return jsonify({"error": "Subida no encontrada."}), 404
+
+    return _subida_response(subida)
+
+
+@api_bp.route("/uploads/<subida_id>", methods=["PATCH"])
+def api_append_upload(subida_id: str):
+    """Append one chunk at `Upload-Offset`, verified against `Upload-Checksum` if sent."""
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    subida = _own_subida(subida_id, usuario)
+    if subida is None:
+        return jsonify({"error": "Subida no encontrada."}), 404
+
+    desplazamiento = request.headers.get("Upload-Offset", "")
+    if not desplazamiento.isdigit():
+        return jsonify({"error": "Falta la cabecera Upload-Offset."}), 400
+
+    try:
+        escribir_trozo(
+            subida,
+            int(desplazamiento),
+            request.content_length,
+            request.stream,
+            request.headers.get("Upload-Checksum"),
+        )
+    except ErrorSubida as error:
+        # The body tells the client which offset to resume from
+        db.session.refresh(subida)
+        return _subida_response(subida, error.codigo, error=str(error))
+
+    return _subida_response(subida)
+
+
+@api_bp.route("/uploads/<subida_id>/finalize", methods=["POST"])
+def api_finalize_upload(subida_id: str):
+    """Move a complete upload into the library through the normal ingest path.
+
+    Repeating the call after success returns the same result.
+    """
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    subida = _own_subida(subida_id, usuario)
+    if subida is None:
+        return jsonify({"error": "Subida no encontrada."}), 404
+
+    if subida.estado != "completada":
+        if not reclamar_para_finalizar(subida):
+            return _subida_response(subida, 409, error="La subida se está escribiendo o finalizando.")
+
+        carpeta_destino = _upload_folder(subida.es_privado)
+        ruta = os.path.join(carpeta_destino, nombre_libre(carpeta_destino, subida.nombre))
+        opciones = subida.opciones or {}
+        # Mismo disco que la biblioteca: mover no copia los datos
+        shutil.move(ruta_temporal(subida), ruta)
+        try:
+            nuevo, existente, tareas = ingerir(
+                medir(ruta),
+                es_privado=subida.es_privado,
+                convertir_pdf=opciones.get("convertToPdf", False),
+                convertir_audio=opciones.get("convertToAudio", False),
+                ver_privados=session.get("acceso_privado", False),
+                fecha_subida=datetime.utcnow(),
+            )
+            db.session.flush()
+        except Exception:
+            db.session.rollback()
+            if os.path.exists(ruta):
+                shutil.move(ruta, ruta_temporal(subida))
+            subida.estado = "activa"
+            db.session.commit()
+            raise
+
+        subida.estado = "completada"
+        subida.rechazada = nuevo is None
+        subida.archivo_id = nuevo.id if nuevo is not None else existente.id
+        db.session.commit()
+        extra = {
+            "jobs": [_serialize_tarea(tarea) for tarea in tareas],
+            "duplicate": _serialize_duplicado(subida.nombre, existente, nuevo is None)
+            if existente is not None
+            else None,
+        }
+    else:
+        extra = {"jobs": [], "duplicate": None}
+
+    archivo = db.session.get(Archivo, subida.archivo_id) if subida.archivo_id else None
+    if archivo is not None and usuario_puede_ver(archivo):
+        extra["file"] = _serialize_archivo(archivo, usuario)
+    return _subida_response(subida, **extra)
+
+
+@api_bp.route("/uploads/<subida_id>", methods=["DELETE"])
+def api_cancel_upload(subida_id: str):
+    """Abort an upload and free its temporary file and quota."""
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    subida = _own_subida(subida_id, usuario)
+    if subida is None:
+        return jsonify({"error": "Subida no encontrada."}), 404
+    if subida.estado == "finalizando":
+        return _subida_response(subida, 409, error="La subida se está finalizando.")
+    if subida_escribiendo(subida):
+        return _subida_response(subida, 409, error="Se está escribiendo un trozo de la subida.")
+
+    descartar_subida(subida)
+    db.session.commit()
+    return "", 204
+
+
 @api_bp.route("/tags", methods=["GET"])
 def api_list_tags():
     """Expose all tag names for quick filtering."""
@@ -379,7 +888,7 @@ def api_playlists():
         .all()
     )
 
-    return jsonify([_serialize_playlist(playlist, usuario) for playlist in playlists]), 200
+    return jsonify(_serialize_playlists(playlists, usuario)), 200
 
 
 @api_bp.route("/playlists/<int:playlist_id>", methods=["DELETE"])
@@ -442,3 +951,90 @@ def api_remove_playlist_item(playlist_id: int, archivo_id: int):
         db.session.commit()
 
     return jsonify(_serialize_playlist(playlist, usuario)), 200
+
+
+@api_bp.route("/jobs", methods=["GET"])
+def api_list_jobs():
+    """List background jobs, filtered by `ids`, `fileIds` and `active=1`."""
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    tareas = _visible_jobs_query().order_by(Tarea.id.desc()).limit(MAX_PAGE_SIZE).all()
+    return jsonify([_serialize_tarea(tarea) for tarea in tareas]), 200
+
+
+@api_bp.route("/jobs/<int:tarea_id>", methods=["GET"])
+def api_job_detail(tarea_id: int):
+    """Return the state of a single background job."""
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    tarea = Tarea.query.get_or_404(tarea_id)
+    if tarea.archivo is not None and not usuario_puede_ver(tarea.archivo):
+        return jsonify({"error": "Acceso no autorizado."}), 403
+
+    return jsonify(_serialize_tarea(tarea)), 200
+
+
+@api_bp.route("/jobs/<int:tarea_id>/cancel", methods=["POST"])
+def api_cancel_job(tarea_id: int):
+    """Cancel a pending or running background job."""
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    tarea = Tarea.query.get_or_404(tarea_id)
+    if tarea.archivo is not None and not usuario_puede_ver(tarea.archivo):
+        return jsonify({"error": "Acceso no autorizado."}), 403
+
+    if not cancelar(tarea):
+        return jsonify({"error": "La tarea ya ha terminado."}), 409
+    db.session.commit()
+
+    return jsonify(_serialize_tarea(tarea)), 200
+
+
+@api_bp.route("/jobs/stream", methods=["GET"])
+def api_stream_jobs():
+    """Server-Sent Events feed with job updates, same filters as /jobs.
+
+    Each changed job is sent as one `job` event. The stream closes once every
+    matching job has finished, or after JOBS_STREAM_TIMEOUT seconds: each open
+    stream holds a sync worker, so it is kept short and the `retry:` field
+    makes EventSource reconnect after JOBS_STREAM_RETRY milliseconds. The
+    first round of a new connection sends every matching job again.
+    """
+    usuario = _current_user()
+    if not usuario:
+        return jsonify({"error": "No autenticado."}), 401
+
+    query = _visible_jobs_query()
+    intervalo = current_app.config["JOBS_STREAM_INTERVAL"]
+    limite = time.monotonic() + current_app.config["JOBS_STREAM_TIMEOUT"]
+    reintento = current_app.config["JOBS_STREAM_RETRY"]
+
+    def eventos():
+        yield f"retry: {reintento}\n\n"
+        vistos = {}
+        while time.monotonic() < limite:
+            # Finish the previous transaction so each round sees fresh rows.
+            db.session.rollback()
+            tareas = query.order_by(Tarea.id).limit(MAX_PAGE_SIZE).all()
+            for tarea in tareas:
+                datos = _serialize_tarea(tarea)
+                if vistos.get(tarea.id) != datos["updatedAt"]:
+                    vistos[tarea.id] = datos["updatedAt"]
+                    yield f"event: job\ndata: {json.dumps(datos)}\n\n"
+            if all(tarea.estado in ESTADOS_FINALES for tarea in tareas):
+                yield "event: end\ndata: {}\n\n"
+                return
+            yield ": ping\n\n"
+            time.sleep(intervalo)
+
+    return Response(
+        stream_with_context(eventos()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
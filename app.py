@@ -1,22 +1,18 @@
 from flask import Flask, render_template, request, redirect, url_for, session, abort, send_file, jsonify, send_from_directory, flash
 from flask_migrate import Migrate
 from datetime import datetime, timedelta
-from sqlalchemy import func
+from sqlalchemy import func, or_
+from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash
+from werkzeug.security import generate_password_hash, safe_join
 from PIL import Image
 from config import Config
 from flask_cors import CORS
 from models import Archivo, Etiqueta, Usuario, db, archivo_etiqueta, favoritos, Playlist, playlist_archivo, Bloc, bloc_compartido
 from utils import (
-    guardar_miniatura_si_es_imagen,
-    convertir_doc_a_pdf,
-    convertir_video_a_audio,
     login_requerido,
     usuario_puede_ver,
-    generar_miniatura_pdf,
-    generar_miniatura_video,
-    calcular_hash
+    nombre_libre
 )
 from os import listdir
 import subprocess
@@ -26,35 +22,78 @@ import hashlib
 import yt_dlp
 import tempfile
 from api_routes import api_bp
+from entrega import servir_archivo
+from reconciliar import reconciliar
+from duplicados import informe_duplicados
+from basedatos import iniciar as iniciar_bd, mantener
+from miniaturas import (
+    EXTENSIONES,
+    MODOS as MODOS_MINIATURAS,
+    es_legado,
+    reconstruir as reconstruir_miniaturas,
+    ruta_miniatura,
+    srcset_miniatura,
+    url_miniatura,
+)
+from trickplay import PISTA, carpeta_trickplay, url_trickplay
+from hls import MAESTRA, TIPOS_MIME as TIPOS_HLS, admite_hls, carpeta_hls, marcar_uso as marcar_uso_hls, url_hls, url_hls_js
+from variantes import admite_variantes, obtener_variante, srcset_variantes
+from busqueda import asegurar_indice, es_sqlite, reconstruir as reconstruir_busqueda
+from hashes import rehashear
+from planes import explicar, explicar_con_datos_de_ejemplo
+from indice_etiquetas import PRIVADOS, PUBLICOS, TODOS, buscar_archivos, indice
+from ingesta import PeticionIngesta, ingerir, recibir
+from tareas import (
+    TIPOS_FASTSTART,
+    Despachador,
+    encolar_conversion,
+    encolar_faststart,
+    encolar_hls,
+    encolar_miniaturas,
+    encolar_sondeo,
+    encolar_trickplay,
+    iniciar_en_segundo_plano,
+)
+import click
 
-app = Flask(__name__, static_url_path="/media", static_folder="uploads/DovahCloud")
+app = Flask(__name__, static_url_path="/media", static_folder=Config.UPLOAD_FOLDER)
+# Los ficheros multipart se escriben a disco una sola vez, calculando hash y tipo al vuelo
+app.request_class = PeticionIngesta
 app.secret_key = 'dragonborn'
 app.config.from_object(Config)
 
+# Orígenes del SPA en desarrollo (vite y similares), con la cookie de sesión
+ORIGENES_SPA = [
+    "http://localhost:5173",
+    "http://127.0.0.1:5173",
+    "http://localhost:3000",
+    "http://127.0.0.1:3000",
+]
+
 CORS(
     app,
     resources={
         r"/api/*": {
-            "origins": [
-                "http://localhost:5173",
-                "http://127.0.0.1:5173",
-                "http://localhost:3000",
-                "http://127.0.0.1:3000",
-            ],
+            "origins": ORIGENES_SPA,
             "supports_credentials": True,
-        }
+            "expose_headers": ["Location", "Upload-Offset", "Upload-Length"],
+        },
+        # hls.js pide listas y segmentos con XHR desde el SPA
+        r"/hls/*": {"origins": ORIGENES_SPA, "supports_credentials": True},
     },
 )
 
 migrate = Migrate(app, db)
 
-db.init_app(app)
+# db.init_app con WAL y pragmas en SQLite, o el pool de PostgreSQL
+iniciar_bd(app)
 
 app.register_blueprint(api_bp)
 
 # Crear tablas al iniciar si no existen
 with app.app_context():
     db.create_all()
+    asegurar_indice()
 
 @app.route('/registro', methods=['GET', 'POST'])
 def registro():
@@ -166,6 +205,33 @@ def panel_admin():
     usuarios = Usuario.query.all()
     return render_template('panel_admin.html', usuarios=usuarios)
 
+@app.route('/admin/duplicados')
+@login_requerido
+def duplicados_admin():
+    if not session.get('es_admin'):
+        abort(403)
+
+    grupos = informe_duplicados()
+    recuperable = sum(grupo['recuperable'] for grupo in grupos)
+    return render_template('duplicados.html', grupos=grupos, recuperable=recuperable)
+
+@app.route('/admin/miniaturas', methods=['POST'])
+@login_requerido
+def miniaturas_admin():
+    if not session.get('es_admin'):
+        abort(403)
+
+    modo = request.form.get('modo', 'faltan')
+    if modo not in MODOS_MINIATURAS:
+        abort(400)
+
+    encoladas, sin_fichero = encolar_miniaturas(modo)
+    db.session.commit()
+    flash(f"🖼️ {encoladas} miniatura(s) encoladas; el despachador de tareas las irá generando.")
+    if sin_fichero:
+        flash(f"⚠️ {len(sin_fichero)} archivo(s) sin fichero en disco: ejecuta `flask reconcile` para revisarlos.")
+    return redirect(url_for('panel_admin'))
+
 @app.route('/admin/editar/<int:id>', methods=['GET', 'POST'])
 @login_requerido
 def editar_usuario(id):
@@ -202,41 +268,29 @@ def upload():
 
         convertir_pdf = request.form.get('convertir_pdf')
         convertir_audio = request.form.get('convertir_audio')
+        rechazados = []
 
         for archivo_subido in archivos:
             if not archivo_subido or archivo_subido.filename == '':
                 continue
 
-            filename = secure_filename(archivo_subido.filename)
             carpeta_destino = app.config['UPLOAD_FOLDER']
-            ruta = os.path.join(carpeta_destino, filename)
-            thumb_path = os.path.join(carpeta_destino, f"thumb_{filename}")
-
-            archivo_subido.save(ruta)
-            tipo_detectado = mimetypes.guess_type(ruta)[0] or archivo_subido.mimetype or 'application/octet-stream'
-            tamaño = os.path.getsize(ruta)
-
-            if tipo_detectado == 'application/pdf':
-                generar_miniatura_pdf(ruta, thumb_path)
-            elif tipo_detectado.startswith('video/'):
-                generar_miniatura_video(ruta, thumb_path)
-            else:
-                guardar_miniatura_si_es_imagen(ruta, thumb_path, tipo_detectado)
-
-            nuevo = Archivo(nombre=filename, ruta=ruta, tipo=tipo_detectado, tamaño=tamaño)
-            db.session.add(nuevo)
-
-            ext = os.path.splitext(filename)[1].lower()
-            convertibles = ['.doc', '.docx', '.odt', '.ppt', '.pptx', '.xls', '.xlsx']
-
-            if convertir_pdf and ext in convertibles:
-                convertir_doc_a_pdf(ruta, carpeta_destino)
-
-            if convertir_audio and tipo_detectado.startswith('video/'):
-                convertir_video_a_audio(ruta, carpeta_destino)
+            filename = nombre_libre(carpeta_destino, secure_filename(archivo_subido.filename))
+
+            recibido = recibir(archivo_subido, carpeta_destino, filename)
+            nuevo, existente, _ = ingerir(recibido, convertir_pdf=bool(convertir_pdf),
+                                          convertir_audio=bool(convertir_audio),
+                                          ver_privados=session.get('acceso_privado', False))
+            if nuevo is None:
+                if existente.es_privado and not session.get('acceso_privado'):
+                    rechazados.append(filename)
+                else:
+                    rechazados.append(f"{filename} (igual que {existente.nombre})")
 
         db.session.commit()
-        flash(f"✅ {len(archivos)} archivo(s) subido(s) correctamente.")
+        flash(f"✅ {len(archivos) - len(rechazados)} archivo(s) subido(s) correctamente.")
+        if rechazados:
+            flash(f"⚠️ Ya estaban en la biblioteca y no se han subido: {', '.join(rechazados)}")
         return redirect(url_for('ver_archivos'))
 
     return render_template('upload.html')
@@ -314,6 +368,263 @@ def limpiar_papelera():
 
     print(f"🧹 Limpieza completada. {eliminados} archivos purgados.")
 
+@app.cli.group("tareas")
+def tareas_cli():
+    """Cola de tareas en segundo plano."""
+
+@tareas_cli.command("trabajar")
+@click.option('--procesos', type=int, default=None, help="Procesos simultáneos (por defecto TAREAS_PROCESOS).")
+@click.option('--hasta-vaciar', is_flag=True, help="Salir cuando no queden tareas pendientes.")
+def tareas_trabajar(procesos, hasta_vaciar):
+    """Ejecuta el despachador de tareas en primer plano."""
+    despachador = Despachador(app, procesos=procesos)
+    print(f"⚙️ Despachador de tareas con {despachador.procesos} proceso(s)")
+    try:
+        despachador.ejecutar(hasta_vaciar=hasta_vaciar)
+    except KeyboardInterrupt:
+        print("👋 Despachador detenido.")
+
+@tareas_cli.command("sondear")
+@click.option('--procesos', type=int, default=None, help="Procesos simultáneos (por defecto TAREAS_PROCESOS).")
+@click.option('--todos', is_flag=True, help="Volver a sondear también los que tienen datos vigentes.")
+def tareas_sondear(procesos, todos):
+    """Rellena media_info de los audios y vídeos existentes con ffprobe en paralelo."""
+    archivos = (
+        Archivo.query.options(joinedload(Archivo.media_info))
+        .filter(or_(Archivo.tipo.like('video/%'), Archivo.tipo.like('audio/%')))
+        .all()
+    )
+    encolados = 0
+    for archivo in archivos:
+        if todos or archivo.media_info is None or archivo.media_info.caducada():
+            encolar_sondeo(archivo)
+            encolados += 1
+    db.session.commit()
+    print(f"🔎 {encolados} de {len(archivos)} archivo(s) por sondear")
+
+    # Solo despacha sondeos: el resto de la cola sigue a cargo del despachador habitual
+    despachador = Despachador(app, procesos=procesos, tipos=['sondeo'])
+    try:
+        despachador.ejecutar(hasta_vaciar=True)
+    except KeyboardInterrupt:
+        print("👋 Sondeo interrumpido; se retoma al volver a lanzarlo.")
+        return
+    print("✅ Sondeo completado.")
+
+@tareas_cli.command("trickplay")
+@click.option('--procesos', type=int, default=None, help="Procesos simultáneos (por defecto TAREAS_PROCESOS).")
+@click.option('--todos', is_flag=True, help="Regenerar también los vídeos que ya tienen hojas.")
+def tareas_trickplay(procesos, todos):
+    """Genera las hojas de previsualización de los vídeos existentes."""
+    videos = Archivo.query.filter(Archivo.tipo.like('video/%'), Archivo.fecha_eliminado.is_(None)).all()
+    encolados = 0
+    for archivo in videos:
+        if todos or archivo.trickplay is None:
+            encolar_trickplay(archivo)
+            encolados += 1
+    db.session.commit()
+    print(f"🎞️ {encolados} de {len(videos)} vídeo(s) por procesar")
+
+    despachador = Despachador(app, procesos=procesos, tipos=['trickplay'])
+    try:
+        despachador.ejecutar(hasta_vaciar=True)
+    except KeyboardInterrupt:
+        print("👋 Interrumpido; se retoma al volver a lanzarlo.")
+        return
+    print("✅ Hojas de previsualización generadas.")
+
+@tareas_cli.command("hls")
+@click.option('--procesos', type=int, default=None, help="Procesos simultáneos (por defecto TAREAS_PROCESOS).")
+@click.option('--todos', is_flag=True, help="Reempaquetar también los vídeos que ya tienen HLS.")
+def tareas_hls(procesos, todos):
+    """Empaqueta en HLS los vídeos existentes, sin esperar a que alguien los reproduzca."""
+    videos = Archivo.query.filter(Archivo.tipo.like('video/%'), Archivo.fecha_eliminado.is_(None)).all()
+    encolados = sum(encolar_hls(archivo, forzar=todos) is not None for archivo in videos)
+    db.session.commit()
+    print(f"📺 {encolados} de {len(videos)} vídeo(s) por empaquetar")
+    if encolados:
+        print("⚠️ Los paquetes que no quepan en HLS_MAX_BYTES se irán borrando, de los menos vistos a los más.")
+
+    despachador = Despachador(app, procesos=procesos, tipos=['hls'])
+    try:
+        despachador.ejecutar(hasta_vaciar=True)
+    except KeyboardInterrupt:
+        print("👋 Interrumpido; se retoma al volver a lanzarlo.")
+        return
+    print("✅ Vídeos empaquetados en HLS.")
+
+@tareas_cli.command("faststart")
+@click.option('--procesos', type=int, default=None, help="Procesos simultáneos (por defecto TAREAS_PROCESOS).")
+def tareas_faststart(procesos):
+    """Pone el índice (moov) al principio de los MP4/MOV existentes que lo tienen al final."""
+    candidatos = Archivo.query.filter(Archivo.tipo.in_(TIPOS_FASTSTART), Archivo.fecha_eliminado.is_(None)).all()
+    encolados = sum(encolar_faststart(archivo) is not None for archivo in candidatos)
+    db.session.commit()
+    print(f"⏩ {encolados} de {len(candidatos)} MP4/MOV con el índice al final")
+
+    despachador = Despachador(app, procesos=procesos, tipos=['faststart', 'sondeo'])
+    try:
+        despachador.ejecutar(hasta_vaciar=True)
+    except KeyboardInterrupt:
+        print("👋 Interrumpido; se retoma al volver a lanzarlo.")
+        return
+    print("✅ Faststart aplicado.")
+
+@app.cli.command("reconcile")
+@click.option('--arreglar', is_flag=True, help="Corregir lo encontrado en vez de solo informar.")
+@click.option('--raiz-anterior', 'raices_anteriores', multiple=True,
+              help="Raíz antigua de rutas absolutas guardadas (p. ej. /var/www/dovahcloud/uploads).")
+@click.option('--hilos', type=int, default=None, help="Hilos para escanear y calcular hashes.")
+def reconcile(arreglar, raices_anteriores, hilos):
+    """Compara la BD con las carpetas de subida y, con --arreglar, las pone de acuerdo."""
+    informe, sin_cambios = reconciliar(app, arreglar=arreglar, raices_anteriores=raices_anteriores, hilos=hilos)
+
+    titulos = {
+        'reubicados': "🔁 Rutas reubicadas",
+        'modificados': "✏️ Modificados en disco",
+        'sin_fichero': "❌ Filas sin fichero" + (" (a la papelera)" if arreglar else ""),
+        'huerfanos': "📂 Ficheros sin fila" + (" (importados)" if arreglar else ""),
+        'miniaturas_huerfanas': "🖼️ Miniaturas huérfanas" + (" (borradas)" if arreglar else ""),
+        'sin_miniatura': "🕳️ Sin miniatura" + (" (encoladas)" if arreglar else ""),
+        'sin_media_info': "🔎 Sin metadatos de ffprobe" + (" (encolados)" if arreglar else ""),
+    }
+    for clave, rutas in informe.items():
+        if not rutas:
+            continue
+        print(f"{titulos[clave]}: {len(rutas)}")
+        for ruta in rutas:
+            print(f"   - {ruta}")
+
+    print(f"✅ Sin cambios: {sin_cambios}")
+    if not arreglar and any(informe.values()):
+        print("ℹ️ Ejecuta `flask reconcile --arreglar` para corregirlo.")
+
+@app.cli.command("rehash")
+@click.option('--algoritmo', default=None, help="Algoritmo a usar (por defecto HASH_ALGORITMO).")
+@click.option('--todos', is_flag=True, help="Recalcular también los que no han cambiado.")
+@click.option('--procesos', type=int, default=None, help="Procesos simultáneos (por defecto, uno por núcleo).")
+@click.option('--lote', type=int, default=500, show_default=True, help="Filas por commit.")
+def rehash(algoritmo, todos, procesos, lote):
+    """Recalcula hash_archivo en paralelo, saltando los ficheros sin cambios."""
+    def progresar(hechos, total, leidos):
+        if hechos % 100 == 0 or hechos == total:
+            print(f"   {hechos}/{total} · {leidos / 1024 ** 3:.1f} GiB", flush=True)
+
+    try:
+        resultado = rehashear(algoritmo=algoritmo, todos=todos, procesos=procesos,
+                              lote=lote, al_progresar=progresar)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    for ruta in resultado['sin_fichero']:
+        print(f"⚠️ Archivo no encontrado: {ruta}")
+    for error in resultado['errores']:
+        print(f"❌ {error}")
+    segundos = max(resultado['segundos'], 0.001)
+    print(f"✅ Sin cambios: {resultado['sin_cambios']} de {resultado['total']}")
+    print(f"🔑 Recalculados: {resultado['hasheados']} · {resultado['bytes'] / 1024 ** 2:.0f} MiB en "
+          f"{resultado['segundos']:.1f} s ({resultado['bytes'] / 1024 ** 2 / segundos:.0f} MiB/s)")
+    if resultado['sin_fichero']:
+        print("ℹ️ Ejecuta `flask reconcile` para revisar los archivos que faltan.")
+
+@app.cli.group("thumbs")
+def thumbs_cli():
+    """Miniaturas de los archivos."""
+
+@thumbs_cli.command("rebuild")
+@click.option('--cambiados', 'modo', flag_value='cambiados',
+              help="Regenerar también las de ficheros que han cambiado desde su miniatura.")
+@click.option('--todos', 'modo', flag_value='todos', help="Regenerar todas.")
+@click.option('--procesos', type=int, default=None, help="Procesos simultáneos (por defecto, uno por núcleo).")
+@click.option('--lote', type=int, default=200, show_default=True, help="Filas por commit y punto de control.")
+@click.option('--reiniciar', is_flag=True, help="Ignorar el punto de control de una ejecución interrumpida.")
+def thumbs_rebuild(modo, procesos, lote, reiniciar):
+    """Regenera en paralelo las miniaturas que faltan (o las cambiadas, o todas)."""
+    modo = modo or 'faltan'
+
+    impresos = [0]
+
+    def progresar(hechos, total):
+        # Los lotes terminan de varios en varios: se avisa al pasar cada centena
+        if hechos // 100 > impresos[0] // 100 or hechos == total:
+            impresos[0] = hechos
+            print(f"   {hechos}/{total}", flush=True)
+
+    try:
+        resultado = reconstruir_miniaturas(modo=modo, procesos=procesos, lote=lote,
+                                           reiniciar=reiniciar, al_progresar=progresar)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    except KeyboardInterrupt:
+        print("👋 Interrumpido; se retoma al volver a lanzarlo.")
+        return
+
+    for ruta in resultado['sin_fichero']:
+        print(f"⚠️ Archivo no encontrado: {ruta}")
+    for error in resultado['errores']:
+        print(f"❌ {error}")
+    if resultado['reanudados']:
+        print(f"⏭️ Ya hechas en la ejecución anterior: {resultado['reanudados']}")
+    generadas = sum(resultado['generadas'].values())
+    detalle = ' · '.join(f"{clase}: {cuantas}" for clase, cuantas in resultado['generadas'].items())
+    print(f"✅ Miniaturas generadas: {generadas} de {resultado['total']} ({detalle})")
+    print(f"⏱️ {resultado['segundos']:.1f} s ({generadas / max(resultado['segundos'], 0.001):.1f} archivos/s)")
+    if resultado['sin_fichero']:
+        print("ℹ️ Ejecuta `flask reconcile` para revisar los archivos que faltan.")
+
+@app.cli.command("reindex")
+def reindex():
+    """Reconstruye el índice de texto completo de la búsqueda (solo SQLite)."""
+    if not es_sqlite():
+        print("ℹ️ La búsqueda de texto completo solo se indexa en SQLite; este motor usa ILIKE.")
+        return
+    asegurar_indice()
+    with db.engine.begin() as conexion:
+        indexados = reconstruir_busqueda(conexion)
+    print(f"🔎 Índice de búsqueda reconstruido: {indexados} archivo(s).")
+
+@app.cli.command("explain")
+@click.option('--bd-actual', is_flag=True, help="Usar la base de datos configurada en vez de una de ejemplo.")
+@click.option('--detalle', is_flag=True, help="Mostrar el plan de todas las consultas, no solo las que fallan.")
+def explain(bd_actual, detalle):
+    """Comprueba con EXPLAIN QUERY PLAN que las consultas frecuentes usan índices."""
+    if bd_actual:
+        if not es_sqlite():
+            print("ℹ️ EXPLAIN QUERY PLAN solo está disponible en SQLite.")
+            return
+        with db.engine.connect() as conexion:
+            planes = explicar(conexion)
+    else:
+        planes = explicar_con_datos_de_ejemplo()
+
+    fallidas = 0
+    for nombre, detalles, problemas in planes:
+        if problemas:
+            fallidas += 1
+            print(f"❌ {nombre}: {', '.join(problemas)}")
+        elif detalle:
+            print(f"✅ {nombre}")
+        if problemas or detalle:
+            for linea in detalles:
+                print(f"   {linea}")
+
+    if fallidas:
+        print(f"⚠️ {fallidas} de {len(planes)} consulta(s) sin índice adecuado.")
+        raise SystemExit(1)
+    print(f"✅ Ninguna de las {len(planes)} consultas comprobadas recorre tablas enteras ni ordena sin índice.")
+
+@app.cli.command("optimize")
+@click.option('--analyze', 'analizar', is_flag=True, help="ANALYZE completo en vez de PRAGMA optimize (SQLite).")
+@click.option('--vacuum', is_flag=True, help="Compactar también la BD (bloquea las escrituras mientras dura).")
+def optimize(analizar, vacuum):
+    """Mantenimiento periódico de la base de datos: estadísticas, índice de búsqueda, WAL y VACUUM."""
+    pasos, antes, despues = mantener(analizar=analizar, vacuum=vacuum)
+    for paso, segundos in pasos:
+        print(f"   {paso} · {segundos:.2f} s")
+    if antes is not None:
+        print(f"💾 Tamaño: {antes / 1024 ** 2:.1f} MiB → {despues / 1024 ** 2:.1f} MiB")
+    print("✅ Mantenimiento de la base de datos completado.")
+
 @app.route('/descargar_youtube', methods=['GET', 'POST'])
 @login_requerido
 def descargar_youtube():
@@ -379,20 +690,86 @@ def procesar_youtube():
     session['tipo_youtube'] = 'audio/mpeg' if formato == 'audio' else 'video/mp4'
     return redirect(url_for('subida_desde_youtube'))
 
+@app.route('/debug-thumb/<filename>', defaults={'privado': '0'})
 @app.route('/debug-thumb/<privado>/<filename>')
 def debug_thumb(privado, filename):
-    from flask import send_from_directory
-    folder = PRIVATE_UPLOAD_FOLDER if privado == '1' else UPLOAD_FOLDER
-    return send_from_directory(folder, filename)
+    if privado == '1' and not session.get('acceso_privado'):
+        abort(403)
+    folder = app.config['PRIVATE_UPLOAD_FOLDER'] if privado == '1' else app.config['UPLOAD_FOLDER']
+    ruta = safe_join(folder, filename)
+    if ruta is None or not os.path.isfile(ruta):
+        abort(404)
+    return servir_archivo(ruta, derivado=filename.startswith('thumb_'))
+
+@app.route('/miniatura/<int:id>/<medida>')
+def miniatura(id, medida):
+    archivo = Archivo.query.get_or_404(id)
+    if not usuario_puede_ver(archivo):
+        abort(403)
+    if not archivo.miniatura or es_legado(archivo.miniatura) or medida not in app.config['MINIATURAS_MEDIDAS']:
+        abort(404)
+    try:
+        return servir_archivo(ruta_miniatura(archivo.miniatura, medida), derivado=True)
+    except FileNotFoundError:
+        abort(404)
+
+@app.route('/trickplay/<int:id>/<fichero>')
+def trickplay(id, fichero):
+    archivo = Archivo.query.get_or_404(id)
+    if not usuario_puede_ver(archivo):
+        abort(403)
+    if not archivo.trickplay:
+        abort(404)
+    ruta = safe_join(carpeta_trickplay(archivo.trickplay), fichero)
+    if ruta is None or not os.path.isfile(ruta):
+        abort(404)
+    return servir_archivo(ruta, mimetype='text/vtt' if fichero == PISTA else None, derivado=True)
+
+@app.route('/vendor/<path:fichero>')
+def vendor(fichero):
+    return send_from_directory(app.config['VENDOR_FOLDER'], fichero, max_age=86400)
+
+@app.route('/hls/<int:id>/<version>/<path:fichero>')
+def hls(id, version, fichero):
+    archivo = Archivo.query.get_or_404(id)
+    if not usuario_puede_ver(archivo):
+        abort(403)
+    # La versión es el hash del contenido: tras una conversión, las URLs viejas no valen
+    if not admite_hls(archivo) or version != archivo.hash_archivo[:8]:
+        abort(404)
+
+    clave = archivo.hash_archivo
+    if fichero == MAESTRA:
+        try:
+            marcar_uso_hls(clave)
+        except FileNotFoundError:
+            # Sin sesión no se genera nada: un rastreador que recorra las páginas
+            # públicas haría recodificar la biblioteca entera, una y otra vez
+            if not session.get('usuario_id'):
+                abort(404)
+            # Primera reproducción (o paquete desalojado): se genera y el reproductor
+            # usa mientras tanto el fichero original
+            encolar_hls(archivo)
+            db.session.commit()
+            return "⏳ Preparando el streaming de este vídeo.", 503, {'Retry-After': '30'}
+
+    ruta = safe_join(carpeta_hls(clave), fichero)
+    if ruta is None or not os.path.isfile(ruta):
+        abort(404)
+    respuesta = servir_archivo(ruta, mimetype=TIPOS_HLS.get(os.path.splitext(fichero)[1]), derivado=True)
+    if fichero.endswith('.ts'):
+        respuesta.headers['Cache-Control'] = app.config['HLS_CACHE_CONTROL']
+    return respuesta
 
 @app.context_processor
 def inyectar_funciones_utiles():
-    def get_thumb_url(archivo):
-        import os
-        folder = PRIVATE_UPLOAD_FOLDER if archivo.es_privado else UPLOAD_FOLDER
-        ruta_relativa = os.path.relpath(folder, start='media')
-        return f"/media/{ruta_relativa}thumb_{archivo.nombre}.jpg"
-    return dict(get_thumb_url=get_thumb_url)
+    def get_thumb_url(archivo, medida=None):
+        # Cadena vacía si aún no hay miniatura: el <img> muestra su alt
+        return url_miniatura(archivo, medida) or ''
+
+    def get_srcset(archivo, hasta=None):
+        # Imágenes: variantes a demanda; el resto, las medidas de su miniatura
+        return srcset_variantes(archivo, hasta) or srcset_miniatura(archivo) or ''
 
     def etiquetas_visibles():
         if session.get('acceso_privado'):
@@ -417,6 +794,10 @@ def inyectar_funciones_utiles():
     return {
         'usuario_puede_ver': usuario_puede_ver,
         'get_thumb_url': get_thumb_url,
+        'get_srcset': get_srcset,
+        'get_trickplay_url': url_trickplay,
+        'get_hls_url': url_hls,
+        'get_hls_js_url': url_hls_js,
         'cantidad_cola': cantidad_cola,
         **etiquetas_visibles()
     }
@@ -516,7 +897,16 @@ def editar_descripcion(id):
 @app.route('/descargar/<int:id>')
 def descargar(id):
     archivo = Archivo.query.get_or_404(id)
-    return send_file(archivo.ruta, as_attachment=True)
+
+    # Protegemos archivos privados
+    if archivo.es_privado and not session.get('acceso_privado'):
+        abort(403)
+
+    try:
+        return servir_archivo(archivo.ruta, archivo=archivo, mimetype=archivo.tipo,
+                              descarga_como=archivo.nombre)
+    except FileNotFoundError:
+        abort(404)
 
 @app.route('/filtrar_privado')
 @login_requerido
@@ -529,32 +919,16 @@ def filtrar_privado():
     archivos = []
 
     if consulta:
-        terminos = consulta.split()
-        incluir = [t for t in terminos if not t.startswith('-')]
-        excluir = [t[1:] for t in terminos if t.startswith('-')]
-
-        query = db.session.query(Archivo).join(Archivo.etiquetas)
-
-        for etiqueta in incluir:
-            query = query.filter(Archivo.etiquetas.any(Etiqueta.nombre == etiqueta))
-        for etiqueta in excluir:
-            query = query.filter(~Archivo.etiquetas.any(Etiqueta.nombre == etiqueta))
-
-        query = query.filter(Archivo.es_privado == True)
-
+        # (atributo, descendente); las etiquetas se resuelven en el índice en memoria
         ordenes = {
-            'recientes': Archivo.fecha_subida.desc(),
-            'antiguos': Archivo.fecha_subida.asc(),
-            'peso_desc': Archivo.tamaño.desc(),
-            'peso_asc': Archivo.tamaño.asc(),
-            'tipo': Archivo.tipo.asc()
+            'recientes': ('fecha_subida', True),
+            'antiguos': ('fecha_subida', False),
+            'peso_desc': ('tamaño', True),
+            'peso_asc': ('tamaño', False),
+            'tipo': ('tipo', False)
         }
 
-        orden_campo = ordenes.get(orden)
-        if orden_campo:
-            query = query.order_by(orden_campo)
-
-        archivos = query.distinct().all()
+        archivos = buscar_archivos(consulta, PRIVADOS, ordenes.get(orden))
 
     return render_template('filtrar_privado.html', archivos=archivos, etiqueta_buscada=consulta)
 
@@ -638,22 +1012,9 @@ def buscar():
     if not consulta:
         return render_template('filtro.html', archivos=[], consulta='')
 
-    terminos = consulta.split()
-    etiquetas_incluir = [t for t in terminos if not t.startswith('-')]
-    etiquetas_excluir = [t[1:] for t in terminos if t.startswith('-')]
-
-    query = db.session.query(Archivo).join(Archivo.etiquetas)
-
-    for etiqueta in etiquetas_incluir:
-        query = query.filter(Archivo.etiquetas.any(Etiqueta.nombre == etiqueta))
-    for etiqueta in etiquetas_excluir:
-        query = query.filter(~Archivo.etiquetas.any(Etiqueta.nombre == etiqueta))
-
     # Limitar resultados si el usuario no tiene acceso privado
-    if not session.get('acceso_privado'):
-        query = query.filter(Archivo.es_privado == False)
-
-    archivos = query.distinct().all()
+    ambito = TODOS if session.get('acceso_privado') else PUBLICOS
+    archivos = buscar_archivos(consulta, ambito)
     return render_template('filtro.html', archivos=archivos, consulta=consulta)
 
 @app.route('/sugerencias_etiquetas')
@@ -666,30 +1027,11 @@ def sugerencias_etiquetas():
     es_exclusion = ultima.startswith('-')
     parcial = ultima[1:] if es_exclusion else ultima
 
-    query = (
-        db.session.query(Etiqueta.nombre, func.count(Archivo.id).label('cantidad'))
-        .select_from(Etiqueta)
-        .join(archivo_etiqueta, Etiqueta.id == archivo_etiqueta.c.etiqueta_id)
-        .join(Archivo, archivo_etiqueta.c.archivo_id == Archivo.id)
-        .filter(Etiqueta.nombre.ilike(f'{parcial}%'))
-    )
-
-    if not session.get('acceso_privado'):
-        query = query.filter(Etiqueta.es_privada == False, Archivo.es_privado == False)
-
-    resultados = (
-        query.group_by(Etiqueta.nombre)
-             .having(func.count(Archivo.id) > 0)
-             .order_by(
-                 db.case(
-                     (Etiqueta.nombre.startswith("'"), 1),
-                     else_=0
-                 ),
-                 Etiqueta.nombre.asc()
-             )
-             .limit(10)
-             .all()
-    )
+    # Se responde desde el índice de etiquetas en memoria, sin consultar la BD
+    if session.get('acceso_privado'):
+        resultados = indice.sugerir(parcial, TODOS)
+    else:
+        resultados = indice.sugerir(parcial, PUBLICOS, etiquetas_privadas=False)
 
     sugerencias = [
         {'nombre': f"-{nombre}" if es_exclusion else nombre, 'cantidad': cantidad}
@@ -717,27 +1059,71 @@ def media(nombre):
 
     # Detectar tipo MIME real si no se trata de una imagen miniatura
     mimetype = mimetypes.guess_type(ruta_archivo)[0] or 'application/octet-stream'
-    return send_file(ruta_archivo, mimetype=mimetype, as_attachment=False)
+    return servir_archivo(ruta_archivo, archivo=archivo, mimetype=mimetype,
+                          derivado=nombre.startswith('thumb_'))
+
+@app.route('/media/<int:id>/resize')
+def redimensionar_media(id):
+    archivo = Archivo.query.get_or_404(id)
+    if not usuario_puede_ver(archivo):
+        abort(403)
+    if not admite_variantes(archivo):
+        abort(404)
+
+    medidas = app.config['VARIANTES_MEDIDAS']
+    ancho = request.args.get('w', type=int)
+    alto = request.args.get('h', type=int)
+    formato = request.args.get('fmt', app.config['MINIATURAS_FORMATO'])
+    if ancho is None and alto is None:
+        abort(400)
+    if any(valor is not None and valor not in medidas for valor in (ancho, alto)) or formato not in EXTENSIONES:
+        abort(400)
+
+    try:
+        ruta = obtener_variante(archivo, ancho, alto, formato)
+    except FileNotFoundError:
+        abort(404)
+    except (OSError, RuntimeError) as e:
+        print(f"⚠️ No se pudo redimensionar {archivo.nombre}: {e}")
+        abort(415)
+
+    respuesta = servir_archivo(ruta, derivado=True)
+    if request.args.get('v') == archivo.hash_archivo[:8]:
+        respuesta.headers['Cache-Control'] = app.config['VARIANTES_CACHE_CONTROL']
+    return respuesta
 
 @app.route('/multimedia')
 def estado_multimedia():
-    archivos = Archivo.query.filter_by(es_privado=False).all()
+    archivos = (
+        Archivo.query.options(joinedload(Archivo.media_info))
+        .filter(Archivo.es_privado == False,
+                or_(Archivo.tipo.like('video/%'), Archivo.tipo.like('audio/%')))
+        .all()
+    )
     analisis = []
 
+    # Solo lectura, desde la tabla media_info: los sondeos los encolan la subida
+    # y `flask tareas sondear`, no las visitas a esta página
     for archivo in archivos:
-        if archivo.tipo.startswith(('video/', 'audio/')):
-            info = analizar_codec(archivo)
-            analisis.append({
-                'archivo': archivo,
-                'info': info
-            })
+        info = archivo.media_info
+        if info is not None and info.caducada():
+            info = None
+        analisis.append({
+            'archivo': archivo,
+            'info': info
+        })
 
     return render_template('multimedia.html', analisis=analisis)
 
 @app.route('/convertir/<int:id>')
 def convertir(id):
     archivo = Archivo.query.get_or_404(id)
-    convertir_archivo(archivo)
+    tarea = encolar_conversion(archivo)
+    if tarea is None:
+        flash("⚠️ Este archivo no necesita conversión.")
+    else:
+        db.session.commit()
+        flash(f"⚙️ Conversión en cola (tarea {tarea.id}). El archivo se actualizará al terminar.")
     return redirect(url_for('detalle_archivo', id=archivo.id))
 
 @app.route('/galeria')
@@ -756,108 +1142,6 @@ def galeria_videos():
     ).order_by(Archivo.fecha_subida.desc()).all()
     return render_template('videos.html', videos=videos)
 
-@app.route('/regenerar_thumbs')
-@login_requerido
-def regenerar_thumbs():
-    procesadas = 0
-    omitidas = 0
-    errores = 0
-
-    archivos = Archivo.query.filter(Archivo.fecha_eliminado == None).all()
-
-    for archivo in archivos:
-        nombre = archivo.nombre
-        ruta_origen = archivo.ruta
-        carpeta = app.config['PRIVATE_UPLOAD_FOLDER'] if archivo.es_privado else app.config['UPLOAD_FOLDER']
-        thumb_path = os.path.join(carpeta, f"thumb_{nombre}.jpg")
-
-        if os.path.exists(thumb_path):
-            omitidas += 1
-            continue
-
-        tipo = archivo.tipo or mimetypes.guess_type(nombre)[0] or ''
-
-        try:
-            if tipo == 'application/pdf':
-                exito = generar_miniatura_pdf(ruta_origen, thumb_path)
-            elif tipo.startswith('video/'):
-                exito = generar_miniatura_video(ruta_origen, thumb_path)
-            elif tipo.startswith('image/'):
-                exito = guardar_miniatura_si_es_imagen(ruta_origen, thumb_path, tipo)
-            else:
-                exito = False
-
-            if exito:
-                procesadas += 1
-            else:
-                errores += 1
-                print(f"⚠️ No se pudo generar miniatura para: {nombre}")
-        except Exception as e:
-            errores += 1
-            print(f"💥 Error procesando {nombre}: {e}")
-
-        print("Analizando: {} ({}) --> {}".format(archivo.nombre, tipo, archivo.ruta))
-        print(f"➡️ Miniatura en: {thumb_path}")
-        print("📦 ¿Archivo original existe?", os.path.exists(ruta_origen))
-        print("📦 ¿Miniatura ya existe?", os.path.exists(thumb_path))
-
-        return (
-            f"<h2>🔁 Regeneración completada</h2>"
-            f"<p>✅ Miniaturas nuevas: {procesadas}</p>"
-            f"<p>⏭️ Ya existentes: {omitidas}</p>"
-            f"<p>⚠️ Fallidas: {errores}</p>"
-        )
-
-@app.route('/regenerar_thumbs_fisico')
-@login_requerido
-def regenerar_thumbs_fisico():
-    carpeta = app.config['UPLOAD_FOLDER']
-    procesadas = 0
-    omitidas = 0
-    errores = 0
-
-    for nombre in os.listdir(carpeta):
-        if nombre.startswith('thumb_'):
-            continue
-        ruta = os.path.join(carpeta, nombre)
-        if not os.path.isfile(ruta):
-            continue
-
-        thumb_path = os.path.join(carpeta, f'thumb_{nombre}.jpg')
-        if os.path.exists(thumb_path):
-            omitidas += 1
-            continue
-
-        tipo = mimetypes.guess_type(nombre)[0] or ''
-        print(f"🧪 {nombre} → tipo: {tipo}")
-
-        try:
-            if tipo == 'application/pdf':
-                ok = generar_miniatura_pdf(ruta, thumb_path)
-            elif tipo.startswith('video/'):
-                ok = generar_miniatura_video(ruta, thumb_path)
-            elif tipo.startswith('image/'):
-                ok = guardar_miniatura_si_es_imagen(ruta, thumb_path, tipo)
-            else:
-                ok = False
-
-            if ok:
-                procesadas += 1
-                print(f"✅ Miniatura generada: {thumb_path}")
-            else:
-                errores += 1
-                print(f"⚠️ Sin miniatura: {nombre}")
-        except Exception as e:
-            errores += 1
-            print(f"💥 Error con {nombre}: {e}")
-
-    return (
-        f"<h2>🔁 Miniaturas generadas (basado en disco)</h2>"
-        f"<p>✅ Nuevas: {procesadas}</p>"
-        f"<p>⏭️ Ya existentes: {omitidas}</p>"
-        f"<p>⚠️ Fallidas: {errores}</p>"
-    )
-
 @app.route('/privado/archivos')
 @login_requerido
 def ver_archivos_privados():
@@ -889,36 +1173,20 @@ def upload_privado():
 
         carpeta_destino = app.config['PRIVATE_UPLOAD_FOLDER']
         guardados = 0
+        rechazados = []
 
         for archivo_subido in archivos:
             if not archivo_subido or archivo_subido.filename == '':
                 continue
 
-            filename = secure_filename(archivo_subido.filename)
-            ruta = os.path.join(carpeta_destino, filename)
-            archivo_subido.save(ruta)
-
-            tipo_detectado = mimetypes.guess_type(ruta)[0] or archivo_subido.mimetype or 'application/octet-stream'
-            tamaño = os.path.getsize(ruta)
-            archivo_hash = calcular_hash(ruta)
-            thumb_path = os.path.join(carpeta_destino, f"thumb_{filename}.jpg")
-
-            if tipo_detectado == 'application/pdf':
-                generar_miniatura_pdf(ruta, thumb_path)
-            elif tipo_detectado.startswith('video/'):
-                generar_miniatura_video(ruta, thumb_path)
-            elif tipo_detectado.startswith('image/'):
-                guardar_miniatura_si_es_imagen(ruta, thumb_path, tipo_detectado)
-
-            archivo = Archivo(
-                nombre=filename,
-                ruta=ruta,
-                tipo=tipo_detectado,
-                fecha_subida=datetime.now(),
-                tamaño=tamaño,
-                es_privado=True,
-                hash_archivo=archivo_hash
-            )
+            filename = nombre_libre(carpeta_destino, secure_filename(archivo_subido.filename))
+
+            recibido = recibir(archivo_subido, carpeta_destino, filename)
+            archivo, existente, _ = ingerir(recibido, es_privado=True, fecha_subida=datetime.now(),
+                                            ver_privados=session.get('acceso_privado', False))
+            if archivo is None:
+                rechazados.append(f"{filename} (igual que {existente.nombre})")
+                continue
 
             for nombre_et in nombres_etiquetas:
                 etiqueta = Etiqueta.query.filter_by(nombre=nombre_et).first()
@@ -932,92 +1200,12 @@ def upload_privado():
 
         db.session.commit()
         flash(f"✅ {guardados} archivo(s) subido(s) a zona privada.")
+        if rechazados:
+            flash(f"⚠️ Ya estaban en la biblioteca y no se han subido: {', '.join(rechazados)}")
         return redirect(url_for('ver_archivos_privados'))
 
     return render_template('upload_privado.html')
 
-def analizar_codec(archivo):
-    ruta = archivo.ruta
-    resultado = {
-        'video': False,
-        'audio': False,
-        'video_codec': None,
-        'audio_codec': None,
-        'recomendado': True
-    }
-
-    try:
-        datos = subprocess.run(
-            ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=codec_name', '-of', 'default=nw=1', ruta],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        if datos.stdout:
-            resultado['video'] = True
-            resultado['video_codec'] = datos.stdout.strip().split('=')[-1]
-
-        datos = subprocess.run(
-            ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name', '-of', 'default=nw=1', ruta],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        if datos.stdout:
-            resultado['audio'] = True
-            resultado['audio_codec'] = datos.stdout.strip().split('=')[-1]
-
-        # Verificamos si es un formato recomendado
-        if resultado['video'] and resultado['video_codec'] != 'h264':
-            resultado['recomendado'] = False
-        if resultado['audio'] and resultado['audio_codec'] not in ['aac', 'mp3']:
-            resultado['recomendado'] = False
-
-    except Exception as e:
-        resultado['error'] = str(e)
-
-    return resultado
-
-def convertir_archivo(archivo):
-    origen = archivo.ruta
-    destino = origen  # Sobrescribe el original
-
-    # Si es audio WMA → MP3
-    if archivo.tipo.startswith('audio/') and archivo.nombre.lower().endswith('.wma'):
-        nuevo_nombre = archivo.nombre.rsplit('.', 1)[0] + '.mp3'
-        destino = os.path.join(app.config['UPLOAD_FOLDER'], nuevo_nombre)
-
-        comando = [
-            'ffmpeg', '-i', origen,
-            '-acodec', 'libmp3lame', '-y',
-            destino
-        ]
-        subprocess.run(comando, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        # Actualizar en base de datos
-        archivo.nombre = nuevo_nombre
-        archivo.ruta = destino
-        archivo.tipo = 'audio/mpeg'
-
-    # Si es vídeo con códec incompatible → H.264 + AAC
-    elif archivo.tipo.startswith('video/'):
-        nuevo_nombre = archivo.nombre.rsplit('.', 1)[0] + '_compatible.mp4'
-        destino = os.path.join(app.config['UPLOAD_FOLDER'], nuevo_nombre)
-
-        comando = [
-            'ffmpeg', '-i', origen,
-            '-c:v', 'libx264', '-c:a', 'aac',
-            '-preset', 'fast', '-crf', '23',
-            '-y', destino
-        ]
-        subprocess.run(comando, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        archivo.nombre = nuevo_nombre
-        archivo.ruta = destino
-        archivo.tipo = 'video/mp4'
-
-    db.session.commit()
-
 @app.route('/playlist/<int:id>')
 @login_requerido
 def ver_playlist(id):
@@ -1353,5 +1541,8 @@ def eliminar_bloc(id):
     return redirect(url_for('mis_blocs'))
 
 if __name__ == "__main__":
+    # Con el recargador de debug solo el proceso hijo (WERKZEUG_RUN_MAIN) despacha tareas
+    if app.config['TAREAS_HILO_INTEGRADO'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_en_segundo_plano(app)
     # Ejecuta Flask directamente con python app.py
     app.run(host="0.0.0.0", port=5000, debug=True)
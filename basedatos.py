@@ -0,0 +1,102 @@
+"""Motor de base de datos: SQLite afinado o PostgreSQL con pool.
+
+Con SQLite (por defecto) cada conexión nueva pasa a WAL y recibe los pragmas
+de `SQLITE_PRAGMAS`: las lecturas dejan de bloquear a la escritura y una
+escritura que encuentra la BD ocupada espera `busy_timeout` en vez de fallar
+con "database is locked". Si DOVAH_DATABASE_URL apunta a PostgreSQL se usa
+un pool de conexiones por proceso con los tamaños de `BD_POOL_*`.
+
+`mantener` hace el mantenimiento periódico (`flask optimize`, pensado para cron).
+"""
+import os
+import sqlite3
+import time
+
+from sqlalchemy import event, text
+
+from busqueda import TABLA, fts_disponible
+from models import db
+
+
+def opciones_motor(config):
+    """SQLALCHEMY_ENGINE_OPTIONS según el motor de SQLALCHEMY_DATABASE_URI."""
+    if not config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        return {}
+    return {
+        'pool_size': config['BD_POOL_TAMANO'],
+        'max_overflow': config['BD_POOL_EXTRA'],
+        'pool_timeout': config['BD_POOL_ESPERA'],
+        'pool_recycle': config['BD_POOL_RECICLAR'],
+        # Descarta conexiones que el servidor cerró (reinicio, pgbouncer...) antes de usarlas
+        'pool_pre_ping': True,
+    }
+
+
+def iniciar(app):
+    """Configura el motor y registra `db` en la app (en lugar de `db.init_app`)."""
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    # Heroku y otros dan postgres://, que SQLAlchemy 2 ya no acepta
+    if url.startswith('postgres://'):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://' + url[len('postgres://'):]
+
+    opciones = opciones_motor(app.config)
+    opciones.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opciones
+    db.init_app(app)
+
+    pragmas = app.config['SQLITE_PRAGMAS']
+    with app.app_context():
+        for motor in db.engines.values():
+            if motor.dialect.name == 'sqlite':
+                event.listen(motor, 'connect', lambda conexion, _: ajustar_sqlite(conexion, pragmas))
+
+
+def ajustar_sqlite(conexion, pragmas):
+    """Aplica los pragmas a una conexión sqlite3 recién abierta."""
+    if not isinstance(conexion, sqlite3.Connection):
+        return
+    cursor = conexion.cursor()
+    try:
+        for nombre, valor in pragmas.items():
+            cursor.execute(f"PRAGMA {nombre} = {valor}")
+    finally:
+        cursor.close()
+
+
+def _tamano_sqlite(motor):
+    ruta = motor.url.database
+    if not ruta or ruta == ':memory:':
+        return None
+    return sum(os.path.getsize(ruta + sufijo) for sufijo in ('', '-wal') if os.path.exists(ruta + sufijo))
+
+
+def mantener(analizar=False, vacuum=False):
+    """Mantenimiento de la BD. Devuelve [(paso, segundos)] y el tamaño antes y después.
+
+    SQLite: `PRAGMA optimize` (o ANALYZE completo con `analizar`), compactación
+    del índice de búsqueda, VACUUM opcional y checkpoint que vacía el WAL.
+    PostgreSQL: ANALYZE, o VACUUM (ANALYZE) con `vacuum`.
+    """
+    motor = db.engine
+    sqlite = motor.dialect.name == 'sqlite'
+    pasos = []
+    if sqlite:
+        pasos.append('ANALYZE' if analizar else 'PRAGMA optimize')
+        if fts_disponible():
+            pasos.append(f"INSERT INTO {TABLA}({TABLA}) VALUES ('optimize')")
+        if vacuum:
+            pasos.append('VACUUM')
+        pasos.append('PRAGMA wal_checkpoint(TRUNCATE)')
+    else:
+        pasos.append('VACUUM (ANALYZE)' if vacuum else 'ANALYZE')
+
+    antes = _tamano_sqlite(motor) if sqlite else None
+    hechos = []
+    # VACUUM no puede ir dentro de una transacción
+    with motor.connect().execution_options(isolation_level='AUTOCOMMIT') as conexion:
+        for paso in pasos:
+            inicio = time.monotonic()
+            conexion.execute(text(paso))
+            hechos.append((paso, time.monotonic() - inicio))
+    despues = _tamano_sqlite(motor) if sqlite else None
+    return hechos, antes, despues
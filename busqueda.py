@@ -0,0 +1,172 @@
+"""Búsqueda de texto completo sobre nombre, descripción, tipo y etiquetas.
+
+En SQLite se usa una tabla virtual FTS5 (`archivo_fts`, rowid = archivo.id)
+que mantienen al día unos triggers sobre `archivo`, `archivo_etiqueta` y
+`etiqueta`, así que cualquier escritura (ORM, SQL directo, migraciones) la
+actualiza sin que el código tenga que acordarse. Cada término se busca como
+prefijo, los resultados se ordenan con bm25 y se devuelven fragmentos con
+las coincidencias marcadas.
+
+Con otros motores, o un SQLite sin FTS5, `condicion_busqueda` da el filtro
+ILIKE de siempre y no hay orden por relevancia.
+"""
+import re
+
+from markupsafe import escape
+from sqlalchemy import column, func, literal_column, or_, select, table, text
+
+from models import db, Archivo, Etiqueta
+
+TABLA = 'archivo_fts'
+
+# Peso de cada columna en bm25: nombre, descripcion, tipo, etiquetas
+PESOS = (10.0, 2.0, 1.0, 5.0)
+
+# Marcas de las coincidencias: caracteres de control que no aparecen en los
+# nombres, para escapar el HTML antes de convertirlas en <mark>
+_INICIO, _FIN = '\x02', '\x03'
+
+_ETIQUETAS_DE = (
+    "(SELECT group_concat(e.nombre, ' ') FROM archivo_etiqueta ae "
+    "JOIN etiqueta e ON e.id = ae.etiqueta_id WHERE ae.archivo_id = {})"
+)
+
+ESQUEMA = [
+    # unicode61 sin diacríticos: "cancion" encuentra "canción"; prefix acelera los "ter*" cortos
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {TABLA} USING fts5(
+        nombre, descripcion, tipo, etiquetas,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS archivo_fts_insertar AFTER INSERT ON archivo BEGIN
+        INSERT INTO {TABLA}(rowid, nombre, descripcion, tipo, etiquetas)
+        VALUES (NEW.id, NEW.nombre, NEW.descripcion, NEW.tipo, {_ETIQUETAS_DE.format('NEW.id')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS archivo_fts_actualizar AFTER UPDATE OF nombre, descripcion, tipo ON archivo BEGIN
+        UPDATE {TABLA} SET nombre = NEW.nombre, descripcion = NEW.descripcion, tipo = NEW.tipo
+        WHERE rowid = NEW.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS archivo_fts_borrar AFTER DELETE ON archivo BEGIN
+        DELETE FROM {TABLA} WHERE rowid = OLD.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS archivo_etiqueta_fts_insertar AFTER INSERT ON archivo_etiqueta BEGIN
+        UPDATE {TABLA} SET etiquetas = {_ETIQUETAS_DE.format('NEW.archivo_id')}
+        WHERE rowid = NEW.archivo_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS archivo_etiqueta_fts_borrar AFTER DELETE ON archivo_etiqueta BEGIN
+        UPDATE {TABLA} SET etiquetas = {_ETIQUETAS_DE.format('OLD.archivo_id')}
+        WHERE rowid = OLD.archivo_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS etiqueta_fts_renombrar AFTER UPDATE OF nombre ON etiqueta BEGIN
+        UPDATE {TABLA} SET etiquetas = {_ETIQUETAS_DE.format(TABLA + '.rowid')}
+        WHERE rowid IN (SELECT archivo_id FROM archivo_etiqueta WHERE etiqueta_id = NEW.id);
+    END""",
+]
+
+_fts = table(TABLA, column('rowid'), column('nombre'))
+
+# Por motor: si el índice existe (se comprueba una vez por proceso)
+_disponible = {}
+
+
+def es_sqlite(conexion=None):
+    return (conexion or db.engine).dialect.name == 'sqlite'
+
+
+def fts_disponible():
+    """True si la BD es SQLite y tiene el índice FTS5 creado."""
+    motor = db.engine
+    if motor not in _disponible:
+        disponible = False
+        if es_sqlite():
+            with motor.connect() as conexion:
+                disponible = conexion.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :tabla"),
+                    {'tabla': TABLA},
+                ).first() is not None
+        _disponible[motor] = disponible
+    return _disponible[motor]
+
+
+def crear_indice(conexion):
+    """Crea tabla y triggers si faltan; si la tabla es nueva, la llena. True si la creó."""
+    nueva = conexion.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :tabla"), {'tabla': TABLA}
+    ).first() is None
+    for sentencia in ESQUEMA:
+        conexion.execute(text(sentencia))
+    if nueva:
+        reconstruir(conexion)
+    return nueva
+
+
+def asegurar_indice():
+    """Al arrancar: en SQLite con FTS5 crea el índice que falte. No hace nada en otros motores."""
+    if not es_sqlite():
+        return
+    try:
+        with db.engine.begin() as conexion:
+            crear_indice(conexion)
+    except Exception as e:  # SQLite compilado sin FTS5: se queda el ILIKE
+        print(f"⚠️ Búsqueda sin índice de texto completo: {e}")
+    _disponible.pop(db.engine, None)
+
+
+def reconstruir(conexion):
+    """Vuelve a llenar el índice desde `archivo` y lo compacta. Devuelve las filas indexadas."""
+    conexion.execute(text(f"DELETE FROM {TABLA}"))
+    conexion.execute(text(
+        f"INSERT INTO {TABLA}(rowid, nombre, descripcion, tipo, etiquetas) "
+        f"SELECT a.id, a.nombre, a.descripcion, a.tipo, {_ETIQUETAS_DE.format('a.id')} FROM archivo a"
+    ))
+    conexion.execute(text(f"INSERT INTO {TABLA}({TABLA}) VALUES ('optimize')"))
+    return conexion.execute(text(f"SELECT count(*) FROM {TABLA}")).scalar()
+
+
+def consulta_fts(texto):
+    """Expresión MATCH: cada palabra como prefijo y todas obligatorias. None si no hay palabras."""
+    terminos = re.findall(r'\w+', texto)
+    if not terminos:
+        return None
+    # Entre comillas, para que AND, OR, NEAR o un '-' no se interpreten como operadores
+    return ' '.join(f'"{termino}"*' for termino in terminos)
+
+
+def subconsulta_fts(texto):
+    """Subconsulta (archivo_id, rango, nombre_marcado, fragmento) de las coincidencias.
+
+    `rango` es bm25: cuanto menor, más relevante. None si el texto no tiene palabras.
+    """
+    consulta = consulta_fts(texto)
+    if consulta is None:
+        return None
+    fts = literal_column(TABLA)
+    return (
+        select(
+            _fts.c.rowid.label('archivo_id'),
+            func.bm25(fts, *PESOS).label('rango'),
+            func.highlight(fts, 0, _INICIO, _FIN).label('nombre_marcado'),
+            func.snippet(fts, -1, _INICIO, _FIN, '…', 12).label('fragmento'),
+        )
+        .select_from(_fts)
+        .where(fts.op('MATCH')(consulta))
+        .subquery()
+    )
+
+
+def condicion_busqueda(texto):
+    """Filtro ILIKE equivalente, para motores sin FTS5."""
+    comodin = f"%{texto}%"
+    return or_(
+        Archivo.nombre.ilike(comodin),
+        Archivo.descripcion.ilike(comodin),
+        Archivo.tipo.ilike(comodin),
+        Archivo.etiquetas.any(Etiqueta.nombre.ilike(comodin)),
+    )
+
+
+def marcar(valor):
+    """HTML seguro de un texto de highlight/snippet, con las coincidencias en <mark>."""
+    if not valor:
+        return valor
+    return str(escape(valor)).replace(_INICIO, '<mark>').replace(_FIN, '</mark>')
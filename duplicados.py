@@ -0,0 +1,162 @@
+"""Deduplicación por contenido en la ingesta, usando hash_archivo.
+
+Cada subida se busca por hash (columna indexada) y, si sus bytes ya existen,
+se aplica la política DEDUPLICACION:
+  'enlazar'  -> el nuevo Archivo comparte los bytes mediante un enlace duro
+  'rechazar' -> la subida se descarta
+  'copiar'   -> se guarda otra copia
+Salvo al rechazar, se reutilizan la miniatura, el trickplay y los metadatos de
+ffprobe del existente, y si este ya se convirtió, su versión convertida.
+"""
+from itertools import groupby
+from operator import attrgetter
+import os
+import shutil
+
+from flask import current_app
+from sqlalchemy import func, or_, select
+
+from miniaturas import es_legado
+from models import Archivo, MediaInfo
+from tareas import plan_conversion
+from utils import nombre_libre
+
+
+def buscar_duplicado(hash_archivo, ver_privados=True):
+    """Archivo con esos bytes, antes o después de convertirlo, cuyo fichero siga en disco.
+
+    Con `ver_privados` False no se buscan entre los privados: quien sube sin
+    acceso a ellos no debe poder averiguar por sus bytes que existen.
+    """
+    if not hash_archivo:
+        return None
+    consulta = Archivo.query.filter(or_(Archivo.hash_archivo == hash_archivo, Archivo.hash_original == hash_archivo))
+    if not ver_privados:
+        consulta = consulta.filter(Archivo.es_privado.is_(False))
+    candidatos = (
+        consulta
+        # Primero los que no están en la papelera
+        .order_by(Archivo.fecha_eliminado.isnot(None), Archivo.id)
+        .limit(10)
+        .all()
+    )
+    for candidato in candidatos:
+        if candidato.ruta and os.path.isfile(candidato.ruta):
+            return candidato
+    return None
+
+
+def _poner_bytes(origen, destino, enlazar):
+    """Deja en `destino` los bytes de `origen`, con enlace duro si se pide y se puede."""
+    temporal = os.path.join(os.path.dirname(destino), f".dup_{os.path.basename(destino)}")
+    if os.path.lexists(temporal):
+        os.remove(temporal)
+    if enlazar:
+        try:
+            os.link(origen, temporal)
+        except OSError:
+            # Otro sistema de ficheros o sin soporte de enlaces duros
+            enlazar = False
+    if not enlazar:
+        shutil.copy2(origen, temporal)
+    os.replace(temporal, destino)
+
+
+def _extension(archivo):
+    return os.path.splitext(archivo.nombre)[1].lower()
+
+
+def deduplicar(nuevo, ver_privados=True):
+    """Aplica la política de duplicados a un Archivo recién subido y aún sin añadir a la sesión.
+
+    `nuevo` debe traer ruta, nombre, tipo y hash_archivo. Devuelve (existente, aceptado):
+    `existente` es None si no había duplicado, y `aceptado` es False si la política
+    lo rechaza (el fichero subido ya se ha borrado). Los derivados reutilizados quedan
+    en nuevo.miniatura y nuevo.media_info. `ver_privados` como en `buscar_duplicado`.
+    """
+    existente = buscar_duplicado(nuevo.hash_archivo, ver_privados)
+    if existente is None:
+        return None, True
+
+    politica = current_app.config['DEDUPLICACION']
+    if politica == 'rechazar':
+        os.remove(nuevo.ruta)
+        return existente, False
+
+    enlazar = politica == 'enlazar'
+    carpeta = os.path.dirname(nuevo.ruta)
+    if existente.hash_archivo != nuevo.hash_archivo:
+        # Es el original de un archivo ya convertido o reempaquetado (faststart): se hereda el
+        # resultado, con el nombre de la conversión solo si cambió de formato
+        mismo_formato = existente.tipo == nuevo.tipo and _extension(existente) == _extension(nuevo)
+        plan = None if mismo_formato else plan_conversion(nuevo)
+        nombre = nombre_libre(carpeta, plan[0] if plan else nuevo.nombre)
+        destino = os.path.join(carpeta, nombre)
+        _poner_bytes(existente.ruta, destino, enlazar)
+        os.remove(nuevo.ruta)
+        nuevo.hash_original = nuevo.hash_archivo
+        nuevo.hash_archivo = existente.hash_archivo
+        nuevo.algoritmo_hash = existente.algoritmo_hash
+        nuevo.nombre = nombre
+        nuevo.ruta = destino
+        nuevo.tipo = existente.tipo
+    elif enlazar:
+        _poner_bytes(existente.ruta, nuevo.ruta, enlazar=True)
+    nuevo.tamaño = os.path.getsize(nuevo.ruta)
+    nuevo.mtime = os.path.getmtime(nuevo.ruta)
+
+    # Las miniaturas van por hash: basta con apuntar a las mismas (las thumb_ antiguas se regeneran)
+    if existente.miniatura and not es_legado(existente.miniatura):
+        nuevo.miniatura = existente.miniatura
+    nuevo.trickplay = existente.trickplay
+
+    info = existente.media_info
+    if info is not None and not info.caducada():
+        copia = MediaInfo(**{
+            columna: getattr(info, columna)
+            for columna in MediaInfo.__table__.columns.keys()
+            if columna != 'archivo_id'
+        })
+        copia.hash_archivo = nuevo.hash_archivo
+        copia.mtime = nuevo.mtime
+        nuevo.media_info = copia
+
+    return existente, True
+
+
+def informe_duplicados():
+    """Grupos de archivos con el mismo hash y el espacio que liberaría enlazarlos.
+
+    Los que ya comparten inodo (enlaces duros) no cuentan como espacio recuperable.
+    """
+    repetidos = (
+        select(Archivo.hash_archivo)
+        .where(Archivo.hash_archivo.isnot(None), Archivo.hash_archivo != '')
+        .group_by(Archivo.hash_archivo)
+        .having(func.count(Archivo.id) > 1)
+    )
+    archivos = (
+        Archivo.query.filter(Archivo.hash_archivo.in_(repetidos))
+        .order_by(Archivo.hash_archivo, Archivo.id)
+        .all()
+    )
+
+    grupos = []
+    for hash_archivo, grupo in groupby(archivos, key=attrgetter('hash_archivo')):
+        grupo = list(grupo)
+        copias = {}
+        for archivo in grupo:
+            try:
+                datos = os.stat(archivo.ruta)
+            except (OSError, TypeError):
+                continue
+            copias[(datos.st_dev, datos.st_ino)] = datos.st_size
+        grupos.append({
+            'hash': hash_archivo,
+            'archivos': grupo,
+            'copias': len(copias),
+            'recuperable': sum(copias.values()) - max(copias.values(), default=0),
+        })
+
+    grupos.sort(key=lambda grupo: grupo['recuperable'], reverse=True)
+    return grupos
@@ -0,0 +1,199 @@
+"""Entrega de ficheros por HTTP con validadores, rangos y peticiones condicionales."""
+from datetime import datetime, timezone
+from urllib.parse import quote
+import mimetypes
+import os
+import unicodedata
+import uuid
+
+from flask import current_app, request
+from werkzeug.datastructures import Headers
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+TAMANO_BLOQUE = 256 * 1024
+
+
+def etag_de_archivo(archivo, st):
+    """ETag estable para el original: su hash si existe, si no tamaño+mtime."""
+    if archivo is not None and archivo.hash_archivo:
+        return f"{archivo.hash_archivo}-{st.st_size:x}"
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def _ruta_interna(ruta):
+    """Traduce una ruta física al prefijo interno del proxy (X-Accel-Redirect)."""
+    ruta = os.path.abspath(ruta)
+    reglas = current_app.config['DELIVERY_INTERNAL_LOCATIONS']
+    for carpeta in sorted(reglas, key=len, reverse=True):
+        carpeta_abs = os.path.abspath(carpeta)
+        if os.path.commonpath([ruta, carpeta_abs]) == carpeta_abs:
+            relativa = os.path.relpath(ruta, carpeta_abs).replace(os.sep, '/')
+            return reglas[carpeta].rstrip('/') + '/' + quote(relativa)
+    return None
+
+
+def _delegar_al_proxy(respuesta, ruta):
+    """Cede la transferencia al proxy si DELIVERY_MODE lo indica. True si se delegó."""
+    modo = current_app.config.get('DELIVERY_MODE', 'flask')
+    if modo == 'x-accel':
+        interna = _ruta_interna(ruta)
+        if interna is None:
+            current_app.logger.warning("Sin regla X-Accel para %s, se sirve desde Flask", ruta)
+            return False
+        respuesta.headers['X-Accel-Redirect'] = interna
+    elif modo == 'x-sendfile':
+        respuesta.headers['X-Sendfile'] = os.path.abspath(ruta)
+    else:
+        return False
+
+    # El proxy resuelve Range/If-Range y calcula la longitud por su cuenta
+    respuesta.headers.remove('Accept-Ranges')
+    respuesta.response = []
+    return True
+
+
+def _content_disposition(nombre):
+    try:
+        nombre.encode('ascii')
+        return f'attachment; filename="{nombre}"'
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', nombre).encode('ascii', 'ignore').decode('ascii')
+        return f"attachment; filename=\"{simple}\"; filename*=UTF-8''{quote(nombre, safe='')}"
+
+
+def _no_modificado(etag, ultima_modificacion):
+    """Evalúa If-None-Match / If-Modified-Since sin tocar el contenido."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return ultima_modificacion <= request.if_modified_since
+    return False
+
+
+def _rangos_pedidos(tamano, etag, ultima_modificacion):
+    """Devuelve None para servir completo, [] si es insatisfacible o [(inicio, fin)]."""
+    rango = request.range
+    if rango is None or rango.units != 'bytes':
+        return None
+
+    # If-Range: solo se respetan los rangos si el validador sigue vigente
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date < ultima_modificacion:
+        return None
+
+    tramos = []
+    for inicio, fin in rango.ranges:
+        if fin is None:
+            fin = tamano
+        if inicio < 0:
+            inicio = max(tamano + inicio, 0)
+        fin = min(fin, tamano)
+        if inicio < fin:
+            tramos.append((inicio, fin))
+    if not tramos:
+        return []
+
+    # Fusionar tramos solapados o contiguos para no repetir bytes
+    tramos.sort()
+    fusionados = [tramos[0]]
+    for inicio, fin in tramos[1:]:
+        if inicio <= fusionados[-1][1]:
+            fusionados[-1] = (fusionados[-1][0], max(fin, fusionados[-1][1]))
+        else:
+            fusionados.append((inicio, fin))
+    return fusionados
+
+
+def _leer_tramo(ruta, inicio, fin):
+    with open(ruta, 'rb') as f:
+        f.seek(inicio)
+        pendiente = fin - inicio
+        while pendiente > 0:
+            bloque = f.read(min(TAMANO_BLOQUE, pendiente))
+            if not bloque:
+                break
+            pendiente -= len(bloque)
+            yield bloque
+
+
+def _leer_multiparte(ruta, partes, cierre):
+    for cabecera, inicio, fin in partes:
+        yield cabecera
+        yield from _leer_tramo(ruta, inicio, fin)
+    yield cierre
+
+
+def servir_archivo(ruta, archivo=None, mimetype=None, descarga_como=None, derivado=False):
+    """Sirve `ruta` con ETag/Last-Modified, 304 condicionales y rangos (206, multirango).
+
+    `archivo` es el Archivo de origen (para el ETag por hash) y `derivado`
+    indica miniaturas u otros ficheros generados, que se cachean más tiempo.
+    Con DELIVERY_MODE distinto de 'flask' el cuerpo lo envía el proxy.
+    Lanza FileNotFoundError si el fichero no existe.
+    """
+    st = os.stat(ruta)
+    tamano = st.st_size
+    etag = etag_de_archivo(None if derivado else archivo, st)
+    ultima_modificacion = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+    mimetype = mimetype or mimetypes.guess_type(ruta)[0] or 'application/octet-stream'
+
+    cabeceras = Headers()
+    cabeceras['Accept-Ranges'] = 'bytes'
+    cabeceras['Cache-Control'] = current_app.config[
+        'THUMB_CACHE_CONTROL' if derivado else 'MEDIA_CACHE_CONTROL'
+    ]
+    if descarga_como:
+        cabeceras['Content-Disposition'] = _content_disposition(descarga_como)
+
+    respuesta = Response(headers=cabeceras, mimetype=mimetype)
+    respuesta.set_etag(etag)
+    respuesta.last_modified = ultima_modificacion
+
+    if _no_modificado(etag, ultima_modificacion):
+        respuesta.status_code = 304
+        respuesta.headers.remove('Content-Type')
+        return respuesta
+
+    if _delegar_al_proxy(respuesta, ruta):
+        return respuesta
+
+    tramos = _rangos_pedidos(tamano, etag, ultima_modificacion)
+
+    if tramos is None:
+        respuesta.response = wrap_file(request.environ, open(ruta, 'rb'), TAMANO_BLOQUE)
+        respuesta.direct_passthrough = True
+        respuesta.content_length = tamano
+        return respuesta
+
+    if not tramos:
+        respuesta.status_code = 416
+        respuesta.headers['Content-Range'] = f'bytes */{tamano}'
+        respuesta.headers.remove('Content-Type')
+        return respuesta
+
+    respuesta.status_code = 206
+    if len(tramos) == 1:
+        inicio, fin = tramos[0]
+        respuesta.headers['Content-Range'] = f'bytes {inicio}-{fin - 1}/{tamano}'
+        respuesta.response = _leer_tramo(ruta, inicio, fin)
+        respuesta.content_length = fin - inicio
+        return respuesta
+
+    frontera = uuid.uuid4().hex
+    partes = [
+        (
+            (f'\r\n--{frontera}\r\nContent-Type: {mimetype}\r\n'
+             f'Content-Range: bytes {inicio}-{fin - 1}/{tamano}\r\n\r\n').encode('ascii'),
+            inicio,
+            fin,
+        )
+        for inicio, fin in tramos
+    ]
+    cierre = f'\r\n--{frontera}--\r\n'.encode('ascii')
+    respuesta.content_type = f'multipart/byteranges; boundary={frontera}'
+    respuesta.content_length = sum(len(c) + fin - inicio for c, inicio, fin in partes) + len(cierre)
+    respuesta.response = _leer_multiparte(ruta, partes, cierre)
+    return respuesta
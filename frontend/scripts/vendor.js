@@ -0,0 +1,44 @@
+// Descarga las librerías que usan los reproductores (plantillas de Flask y SPA) y las
+// deja en static/vendor, desde donde las sirve la propia app. No son dependencias del
+// build: las versiones se fijan aquí. Uso: `npm run vendor`.
+import { execFileSync } from "node:child_process";
+import { copyFileSync, mkdirSync, mkdtempSync, rmSync } from "node:fs";
+import { tmpdir } from "node:os";
+import { dirname, join } from "node:path";
+import { fileURLToPath } from "node:url";
+
+const frontend = join(dirname(fileURLToPath(import.meta.url)), "..");
+const vendor = join(frontend, "..", "static", "vendor");
+const npm = process.platform === "win32" ? "npm.cmd" : "npm";
+
+const PACKAGES = [
+  {
+    name: "hls.js",
+    version: "1.5.17",
+    files: [
+      ["dist/hls.min.js", "hls.js/hls.min.js"],
+      ["LICENSE", "hls.js/LICENSE"],
+    ],
+  },
+];
+
+for (const { name, version, files } of PACKAGES) {
+  const temp = mkdtempSync(join(tmpdir(), "vendor-"));
+  try {
+    // npm pack baja el tarball publicado sin tocar package.json ni el lockfile
+    const [packed] = JSON.parse(
+      execFileSync(npm, ["pack", `${name}@${version}`, "--json", "--pack-destination", temp], {
+        encoding: "utf8",
+      }),
+    );
+    execFileSync("tar", ["-xzf", join(temp, packed.filename), "-C", temp]);
+    for (const [source, target] of files) {
+      const destination = join(vendor, target);
+      mkdirSync(dirname(destination), { recursive: true });
+      copyFileSync(join(temp, "package", source), destination);
+      console.log(`vendor: ${target} (${name}@${version})`);
+    }
+  } finally {
+    rmSync(temp, { recursive: true, force: true });
+  }
+}
@@ -13,11 +13,27 @@ import { PlaylistPanel } from "./components/PlaylistPanel.jsx";
 import { apiDelete, apiGet, apiPost } from "./api/client.js";
 import { useApi } from "./hooks/useApi.js";
 
+// Número de archivos solicitados por página al listado paginado.
+const PAGE_SIZE = 60;
+// Intervalo de consulta de las tareas en segundo plano tras una subida.
+const JOB_POLL_INTERVAL_MS = 2000;
+// Estados en los que una tarea ya no va a cambiar.
+const FINISHED_JOB_STATES = ["completada", "fallida", "cancelada"];
+
 export default function App() {
   // Estado que mantiene la sesión actual.
   const [user, setUser] = useState(null);
-  // Conjunto completo de archivos accesibles.
+  // Archivos accesibles cargados hasta el momento (paginados).
   const [files, setFiles] = useState([]);
+  // Cursor opaco para pedir la siguiente página, o null si no hay más.
+  const [nextCursor, setNextCursor] = useState(null);
+  // Total aproximado de archivos que cumplen los filtros.
+  const [totalFiles, setTotalFiles] = useState(0);
+  // Favoritos y privados entre los archivos que cumplen los filtros, contados en el servidor.
+  const [totalFavorites, setTotalFavorites] = useState(0);
+  const [totalPrivate, setTotalPrivate] = useState(0);
+  // Indica si se está cargando una página adicional.
+  const [loadingMore, setLoadingMore] = useState(false);
   // Catálogo de etiquetas disponibles.
   const [tags, setTags] = useState([]);
   // Playlists personales del usuario.
@@ -78,19 +94,46 @@ export default function App() {
       });
   }, []);
 
-  // Función utilitaria para solicitar los archivos con los filtros actuales.
-  const fetchFiles = useCallback(() => {
-    if (!user) return Promise.resolve();
-
+  // Construye los parámetros de filtrado comunes a todas las páginas.
+  const buildFileParams = useCallback(() => {
     const params = new URLSearchParams();
+    params.set("limit", String(PAGE_SIZE));
     if (search.trim()) params.set("search", search.trim());
     if (showFavorites) params.set("favorites", "1");
     if (selectedType) params.set("type", selectedType);
+    return params;
+  }, [search, showFavorites, selectedType]);
+
+  // Función utilitaria para solicitar la primera página con los filtros actuales.
+  const fetchFiles = useCallback(() => {
+    if (!user) return Promise.resolve();
 
-    return apiGet(`/files?${params.toString()}`)
-      .then((data) => setFiles(data))
+    return apiGet(`/files?${buildFileParams().toString()}`)
+      .then((data) => {
+        setFiles(data.items);
+        setNextCursor(data.nextCursor);
+        setTotalFiles(data.total);
+        setTotalFavorites(data.favoritesTotal);
+        setTotalPrivate(data.privateTotal);
+      })
       .catch(() => pushNotification("Error", "No fue posible cargar los archivos."));
-  }, [user, search, showFavorites, selectedType, pushNotification]);
+  }, [user, buildFileParams, pushNotification]);
+
+  // Añade la siguiente página de resultados al listado actual.
+  const loadMoreFiles = useCallback(() => {
+    if (!user || !nextCursor || loadingMore) return;
+
+    const params = buildFileParams();
+    params.set("cursor", nextCursor);
+    setLoadingMore(true);
+    apiGet(`/files?${params.toString()}`)
+      .then((data) => {
+        setFiles((current) => [...current, ...data.items]);
+        setNextCursor(data.nextCursor);
+      })
+      .catch(() => pushNotification("Error", "No fue posible cargar más archivos."))
+      .finally(() => setLoadingMore(false));
+  }, [user, nextCursor, loadingMore, buildFileParams, pushNotification]);
 
   // Refresco de datos cada vez que hay un usuario autenticado o cambian parámetros de filtrado.
   useEffect(() => {
@@ -121,11 +164,11 @@ export default function App() {
   // Genera estadísticas básicas para el panel lateral.
   const stats = useMemo(() => {
     return {
-      total: files.length,
-      favorites: files.filter((file) => file.isFavorite).length,
-      private: files.filter((file) => file.isPrivate).length,
+      total: totalFiles,
+      favorites: totalFavorites,
+      private: totalPrivate,
     };
-  }, [files]);
+  }, [totalFiles, totalFavorites, totalPrivate]);
 
   // Identifica el objeto etiqueta actual para filtrado por nombre.
   const activeTag = useMemo(
@@ -169,6 +212,10 @@ export default function App() {
       .then(() => {
         setUser(null);
         setFiles([]);
+        setNextCursor(null);
+        setTotalFiles(0);
+        setTotalFavorites(0);
+        setTotalPrivate(0);
         setPlaylists([]);
         setTags([]);
         pushNotification("Sesión finalizada", "Has salido de DovahCloud con éxito.");
@@ -181,6 +228,9 @@ export default function App() {
     (file) => {
       apiPost(`/files/${file.id}/favorite`)
         .then((updated) => {
+          if (updated.favorite !== file.isFavorite) {
+            setTotalFavorites((current) => current + (updated.favorite ? 1 : -1));
+          }
           setFiles((current) =>
             current.map((item) =>
               item.id === updated.id ? { ...item, isFavorite: updated.favorite } : item
@@ -195,6 +245,30 @@ export default function App() {
     [pushNotification]
   );
 
+  // Sigue las tareas en segundo plano (miniaturas) y refresca cada archivo al terminar.
+  const watchJobs = useCallback((jobs) => {
+    let pending = jobs.filter((job) => !FINISHED_JOB_STATES.includes(job.status));
+
+    const poll = () => {
+      if (!pending.length) return;
+      apiGet(`/jobs?ids=${pending.map((job) => job.id).join(",")}`)
+        .then((updated) => {
+          updated
+            .filter((job) => FINISHED_JOB_STATES.includes(job.status))
+            .forEach((job) => {
+              apiGet(`/files/${job.fileId}`).then((file) =>
+                setFiles((current) => current.map((item) => (item.id === file.id ? file : item)))
+              );
+            });
+          pending = updated.filter((job) => !FINISHED_JOB_STATES.includes(job.status));
+          if (pending.length) setTimeout(poll, JOB_POLL_INTERVAL_MS);
+        })
+        .catch(() => setTimeout(poll, JOB_POLL_INTERVAL_MS * 3));
+    };
+
+    setTimeout(poll, JOB_POLL_INTERVAL_MS);
+  }, []);
+
   // Envía una subida con las opciones especificadas.
   const handleUpload = useCallback(
     async (formData) => {
@@ -202,10 +276,19 @@ export default function App() {
       if (result && result.uploaded) {
         setShowUploadDialog(false);
         setFiles((current) => [...result.uploaded, ...current]);
+        setTotalFiles((current) => current + result.count);
         pushNotification("Subida completada", `${result.count} archivo(s) añadidos con éxito.`);
+        if (result.jobs?.length) watchJobs(result.jobs);
+        const rejected = (result.duplicates || []).filter((item) => item.rejected);
+        if (rejected.length) {
+          pushNotification(
+            "Duplicados omitidos",
+            `${rejected.length} archivo(s) ya estaban en la biblioteca: ${rejected.map((item) => item.name).join(", ")}.`
+          );
+        }
       }
     },
-    [executeUpload, pushNotification]
+    [executeUpload, pushNotification, watchJobs]
   );
 
   // Añade un archivo a la playlist activa.
@@ -357,6 +440,17 @@ export default function App() {
           onAddToPlaylist={handleAddToPlaylist}
         />
 
+        {nextCursor && (
+          <button
+            className="ghost-button"
+            style={{ alignSelf: "center" }}
+            onClick={loadMoreFiles}
+            disabled={loadingMore}
+          >
+            {loadingMore ? "Cargando…" : `Cargar más (${files.length} de ${totalFiles})`}
+          </button>
+        )}
+
         <motion.section layout style={{ display: "grid", gap: "1.4rem", gridTemplateColumns: "1fr 320px" }}>
           <PlaylistPanel
             playlist={activePlaylist}
@@ -60,7 +60,12 @@ export function FileCard({ file, onSelect, onToggleFavorite, onQuickPlay, onAddT
               }}
               className="text-balance"
             >
-              {file.name}
+              {file.highlight?.name ? (
+                // El servidor escapa el nombre y solo añade <mark> (busqueda.marcar)
+                <span dangerouslySetInnerHTML={{ __html: file.highlight.name }} />
+              ) : (
+                file.name
+              )}
             </h4>
             <p style={{ color: "var(--color-text-secondary)", fontSize: "0.88rem" }}>
               {file.mimeType ?? "Tipo desconocido"}
@@ -87,7 +92,11 @@ export function FileCard({ file, onSelect, onToggleFavorite, onQuickPlay, onAddT
         }}
         className="text-balance"
       >
-        {file.description || "Sin descripción registrada para este elemento."}
+        {file.highlight?.snippet && file.highlight.snippet !== file.highlight.name ? (
+          <span dangerouslySetInnerHTML={{ __html: file.highlight.snippet }} />
+        ) : (
+          file.description || "Sin descripción registrada para este elemento."
+        )}
       </p>
 
       <div style={{ display: "flex", alignItems: "center", justifyContent: "space-between" }}>
@@ -121,6 +130,8 @@ export function FileCard({ file, onSelect, onToggleFavorite, onQuickPlay, onAddT
       {file.thumbnailUrl && (
         <img
           src={file.thumbnailUrl}
+          srcSet={file.thumbnailSrcSet || undefined}
+          sizes="220px"
           alt={`Miniatura de ${file.name}`}
           style={{
             position: "absolute",
@@ -1,6 +1,12 @@
 // Panel deslizable que muestra los metadatos completos de un archivo.
 import { AnimatePresence, motion } from "framer-motion";
 import { API_BASE_URL } from "../api/client.js";
+import { VideoPlayer } from "./VideoPlayer.jsx";
+
+function absoluteUrl(url) {
+  // Las rutas de medios cuelgan del servidor Flask, no del prefijo /api.
+  return url.startsWith("http") ? url : `${API_BASE_URL.replace("/api", "")}${url}`;
+}
 
 function formatDate(isoString) {
   // Traducimos la fecha ISO a un mensaje legible.
@@ -59,9 +65,25 @@ export function FileDetailDrawer({ file, onClose }) {
               </button>
             </div>
 
-            {file.thumbnailUrl && (
+            {file.mimeType?.startsWith("video/") && file.mediaUrl ? (
+              <VideoPlayer
+                src={absoluteUrl(file.mediaUrl)}
+                hlsSrc={file.hlsUrl ? absoluteUrl(file.hlsUrl) : null}
+                hlsJsSrc={absoluteUrl("/vendor/hls.js/hls.min.js")}
+                poster={file.thumbnailUrl ? absoluteUrl(file.thumbnailUrl) : undefined}
+                style={{
+                  width: "100%",
+                  borderRadius: "var(--radius-md)",
+                  border: "1px solid rgba(163, 123, 255, 0.18)",
+                  boxShadow: "var(--shadow-soft)",
+                  background: "#000",
+                }}
+              />
+            ) : file.thumbnailUrl && (
               <img
                 src={file.thumbnailUrl}
+                srcSet={file.imageSrcSet || file.thumbnailSrcSet || undefined}
+                sizes="min(520px, 90vw)"
                 alt={`Miniatura de ${file.name}`}
                 style={{
                   width: "100%",
@@ -99,7 +121,7 @@ export function FileDetailDrawer({ file, onClose }) {
               {file.mediaUrl && (
                 <a
                   className="primary-button"
-                  href={file.mediaUrl.startsWith("http") ? file.mediaUrl : `${API_BASE_URL.replace("/api", "")}${file.mediaUrl}`}
+                  href={absoluteUrl(file.mediaUrl)}
                   target="_blank"
                   rel="noopener noreferrer"
                 >
@@ -0,0 +1,78 @@
+// Reproductor de vídeo con streaming HLS adaptativo y vuelta al fichero original.
+import { useEffect, useRef } from "react";
+
+let hlsJsPromise = null;
+
+function loadHlsJs(url) {
+  // Copia local de hls.js servida por Flask en /vendor: se carga una sola vez y solo cuando algún vídeo la necesita.
+  // Si no se ha instalado (`npm run vendor`), queda el HLS nativo o el fichero original.
+  if (!hlsJsPromise) {
+    hlsJsPromise = new Promise((resolve) => {
+      if (window.Hls) {
+        resolve(window.Hls);
+        return;
+      }
+      const script = document.createElement("script");
+      script.src = url;
+      script.onload = () => resolve(window.Hls ?? null);
+      script.onerror = () => resolve(null);
+      document.head.appendChild(script);
+    });
+  }
+  return hlsJsPromise;
+}
+
+export function VideoPlayer({ src, hlsSrc, hlsJsSrc, poster, style }) {
+  const videoRef = useRef(null);
+
+  useEffect(() => {
+    const video = videoRef.current;
+    if (!video || !hlsSrc) return undefined;
+    let hls = null;
+    let cancelled = false;
+
+    const start = async () => {
+      const loaded = await loadHlsJs(hlsJsSrc);
+      const Hls = loaded && loaded.isSupported() ? loaded : null;
+      // Sin forma de reproducir HLS no pedimos la lista: pedirla encola el empaquetado en el servidor.
+      if (cancelled || (!Hls && !video.canPlayType("application/vnd.apple.mpegurl"))) return;
+
+      // Mientras el servidor prepara el paquete (503) seguimos con el original; la petición lo encola.
+      const response = await fetch(hlsSrc, { credentials: "include" });
+      if (cancelled || !response.ok) return;
+      const position = video.currentTime;
+
+      if (Hls) {
+        hls = new Hls({
+          startPosition: position,
+          xhrSetup: (xhr) => {
+            xhr.withCredentials = true;
+          },
+        });
+        hls.on(Hls.Events.ERROR, (_event, data) => {
+          if (!data.fatal) return;
+          // Paquete desalojado o red caída: volvemos al fichero original en el mismo punto.
+          const instant = video.currentTime;
+          hls.destroy();
+          hls = null;
+          video.src = src;
+          video.addEventListener("loadedmetadata", () => (video.currentTime = instant), { once: true });
+        });
+        hls.loadSource(hlsSrc);
+        hls.attachMedia(video);
+      } else {
+        // Safari e iOS reproducen HLS de forma nativa.
+        video.src = hlsSrc;
+        video.addEventListener("loadedmetadata", () => (video.currentTime = position), { once: true });
+      }
+    };
+    start().catch(() => {});
+
+    return () => {
+      cancelled = true;
+      if (hls) hls.destroy();
+    };
+  }, [src, hlsSrc, hlsJsSrc]);
+
+  return <video ref={videoRef} src={src} poster={poster} controls preload="metadata" style={style} />;
+}
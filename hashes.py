@@ -0,0 +1,195 @@
+"""Hash de contenido de los archivos, el mismo en toda la aplicación.
+
+Ingesta, conversiones, reconciliación y `flask rehash` calculan `hash_archivo`
+con HASH_ALGORITMO y guardan en `algoritmo_hash` con cuál lo hicieron, así que
+cambiar de algoritmo no mezcla resúmenes de uno y otro: `flask rehash` vuelve a
+calcular solo las filas que lo necesitan.
+
+Los ficheros se leen con `readinto` sobre un búfer grande y reutilizado;
+hashlib suelta el GIL con trozos así, de modo que varios hilos o procesos
+leen a la vez sin estorbarse.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import hashlib
+import multiprocessing
+import os
+import time
+
+from flask import current_app
+from sqlalchemy import bindparam
+
+BLOQUE = 4 * 1024 * 1024
+
+# Resúmenes de 64 caracteres hexadecimales como mucho (tamaño de la columna)
+ALGORITMOS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+
+
+def algoritmo_actual():
+    """Algoritmo configurado (HASH_ALGORITMO), o md5 fuera de la aplicación."""
+    try:
+        return current_app.config['HASH_ALGORITMO']
+    except RuntimeError:
+        return 'md5'
+
+
+def nuevo_resumen(algoritmo=None):
+    algoritmo = algoritmo or algoritmo_actual()
+    if algoritmo not in ALGORITMOS:
+        raise ValueError(f"Algoritmo de hash no admitido: {algoritmo}")
+    return ALGORITMOS[algoritmo]()
+
+
+def calcular_hash(ruta_archivo, algoritmo=None):
+    """Hash hexadecimal del fichero, o None si no se puede leer."""
+    try:
+        return _hashear(ruta_archivo, nuevo_resumen(algoritmo))[0]
+    except OSError as e:
+        print(f"⚠️ Error calculando hash de {ruta_archivo}: {e}")
+        return None
+
+
+def _hashear(ruta, resumen):
+    """(hexdigest, tamaño, mtime) leyendo el fichero una vez."""
+    bufer = bytearray(BLOQUE)
+    vista = memoryview(bufer)
+    with open(ruta, 'rb', buffering=0) as f:
+        datos = os.fstat(f.fileno())
+        while True:
+            leidos = f.readinto(bufer)
+            if not leidos:
+                break
+            resumen.update(vista[:leidos])
+    return resumen.hexdigest(), datos.st_size, datos.st_mtime
+
+
+def _hashear_trabajo(archivo_id, ruta, algoritmo):
+    # Proceso hijo de rehashear: no toca la base de datos
+    try:
+        resumen, tamaño, mtime = _hashear(ruta, nuevo_resumen(algoritmo))
+        return archivo_id, resumen, tamaño, mtime, None
+    except OSError as e:
+        return archivo_id, None, None, None, str(e)
+
+
+def _estado_en_disco(ruta):
+    try:
+        datos = os.stat(ruta)
+    except OSError:
+        return None
+    return datos.st_size, datos.st_mtime
+
+
+def rehashear(algoritmo=None, todos=False, procesos=None, lote=500, al_progresar=None):
+    """Recalcula `hash_archivo` en paralelo. Devuelve un resumen con contadores.
+
+    Una fila se salta si ya tiene hash del algoritmo pedido y su tamaño y mtime
+    coinciden con los del disco (salvo con `todos`). Los resultados se guardan
+    cada `lote` ficheros: si se interrumpe, lo guardado no se repite al relanzarlo.
+    `al_progresar(hechos, total, bytes_leidos)` se llama tras cada fichero.
+    """
+    # Import tardío: los procesos hijo importan este módulo y no necesitan los modelos
+    from models import db, Archivo, MediaInfo, ruta_absoluta
+
+    algoritmo = algoritmo or algoritmo_actual()
+    nuevo_resumen(algoritmo)  # Falla pronto si no se admite
+    procesos = procesos or os.cpu_count() or 1
+
+    filas = db.session.execute(
+        db.select(Archivo.id, Archivo.ruta_guardada, Archivo.tamaño, Archivo.mtime,
+                  Archivo.hash_archivo, Archivo.algoritmo_hash)
+    ).all()
+    rutas = [ruta_absoluta(fila.ruta_guardada) for fila in filas]
+    # stat en hilos: en discos de red o muchos ficheros es lo que más espera
+    with ThreadPoolExecutor(max_workers=min(32, procesos * 4)) as pool:
+        en_disco = list(pool.map(_estado_en_disco, rutas))
+
+    resultado = {'total': len(filas), 'sin_cambios': 0, 'sin_fichero': [], 'errores': [],
+                 'hasheados': 0, 'bytes': 0, 'segundos': 0.0}
+    pendientes = []
+    anteriores = {}
+    for fila, ruta, estado in zip(filas, rutas, en_disco):
+        if estado is None:
+            resultado['sin_fichero'].append(ruta or f"#{fila.id}")
+            continue
+        vigente = (
+            fila.hash_archivo
+            and fila.algoritmo_hash == algoritmo
+            and (fila.tamaño, fila.mtime) == estado
+        )
+        if vigente and not todos:
+            resultado['sin_cambios'] += 1
+            continue
+        pendientes.append((fila.id, ruta, estado[0]))
+        anteriores[fila.id] = fila
+    # Los grandes primero: el último proceso no se queda solo con un fichero enorme
+    pendientes.sort(key=lambda pendiente: pendiente[2], reverse=True)
+
+    tabla = Archivo.__table__
+    actualizar_archivo = (
+        tabla.update()
+        .where(tabla.c.id == bindparam('b_id'))
+        .values(hash_archivo=bindparam('b_hash'), algoritmo_hash=bindparam('b_algoritmo'),
+                tamaño=bindparam('b_bytes'), mtime=bindparam('b_mtime'))
+    )
+    # Mismo contenido con otro algoritmo: media_info sigue valiendo si se le cambia el hash
+    info = MediaInfo.__table__
+    actualizar_info = (
+        info.update()
+        .where(info.c.archivo_id == bindparam('b_id'), info.c.hash_archivo == bindparam('b_anterior'))
+        .values(hash_archivo=bindparam('b_hash'))
+    )
+
+    def guardar(hechos):
+        if not hechos:
+            return
+        db.session.execute(actualizar_archivo, hechos)
+        mismos = [h for h in hechos if h['b_anterior'] and h['b_sin_tocar']]
+        if mismos:
+            db.session.execute(actualizar_info, mismos)
+        db.session.commit()
+        hechos.clear()
+
+    inicio = time.monotonic()
+    hechos = []
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as pool:
+        cola = iter(pendientes)
+        en_curso = set()
+        terminados = 0
+        while True:
+            # Ventana acotada: no se encolan de golpe cientos de miles de futuros
+            for archivo_id, ruta, _ in cola:
+                en_curso.add(pool.submit(_hashear_trabajo, archivo_id, ruta, algoritmo))
+                if len(en_curso) >= procesos * 4:
+                    break
+            if not en_curso:
+                break
+            listos, en_curso = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in listos:
+                archivo_id, resumen, tamaño, mtime, error = futuro.result()
+                terminados += 1
+                fila = anteriores[archivo_id]
+                if error:
+                    resultado['errores'].append(f"#{archivo_id}: {error}")
+                else:
+                    resultado['hasheados'] += 1
+                    resultado['bytes'] += tamaño
+                    hechos.append({
+                        'b_id': archivo_id, 'b_hash': resumen, 'b_algoritmo': algoritmo,
+                        'b_bytes': tamaño, 'b_mtime': mtime,
+                        'b_anterior': fila.hash_archivo,
+                        'b_sin_tocar': (fila.tamaño, fila.mtime) == (tamaño, mtime),
+                    })
+                if al_progresar:
+                    al_progresar(terminados, len(pendientes), resultado['bytes'])
+            if len(hechos) >= lote:
+                guardar(hechos)
+    guardar(hechos)
+
+    resultado['segundos'] = time.monotonic() - inicio
+    return resultado
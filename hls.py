@@ -0,0 +1,213 @@
+"""Streaming adaptativo HLS de los vídeos.
+
+Cada vídeo se empaqueta en una escalera de calidades (HLS_ESCALERA) con una
+sola pasada de ffmpeg: se decodifica una vez, se reescala a cada alto y se
+codifica en H.264 + AAC en segmentos de HLS_SEGUNDOS con los fotogramas
+clave alineados, para que el reproductor pueda cambiar de calidad en
+cualquier corte. Nunca se amplía: solo se generan las calidades que no
+pasan del lado corto del original (como mínimo la más baja).
+
+Los paquetes se guardan por hash de contenido en HLS_FOLDER/<ab>/<hash>/:
+  master.m3u8           lista maestra con una entrada por calidad
+  <alto>p/index.m3u8    lista de segmentos de cada calidad
+  <alto>p/seg_NNNNN.ts  segmentos MPEG-TS
+Un paquete está listo cuando existe su master.m3u8: se genera en una carpeta
+temporal y se mueve entera al terminar.
+
+Se generan a demanda (la primera vez que un usuario con sesión pide la lista
+maestra, que responde 503 mientras tanto y el reproductor tira del fichero
+original; sin sesión, 404) o por adelantado con `flask tareas hls`. La carpeta es una caché con presupuesto
+HLS_MAX_BYTES: al pasarse se borran los paquetes vistos hace más tiempo (el
+mtime de master.m3u8 hace de fecha de último uso) y se regeneran si alguien
+vuelve a reproducirlos.
+"""
+import os
+import shutil
+import time
+import uuid
+
+from flask import current_app, session, url_for
+
+from utils import ejecutar_ffmpeg
+
+MAESTRA = 'master.m3u8'
+# Copia de hls.js que sirve /vendor (`npm run vendor` en frontend/)
+HLS_JS = 'hls.js/hls.min.js'
+LISTA = 'index.m3u8'
+PATRON_SEGMENTO = 'seg_%05d.ts'
+TIPOS_MIME = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+
+# Cada cuánto se actualiza el mtime de un paquete reproducido (segundos)
+REFRESCO_USO = 3600
+# Al pasarse del presupuesto se libera hasta quedar en esta fracción
+MARGEN_EVICCION = 0.9
+
+
+def carpeta_hls(clave, carpeta=None):
+    carpeta = carpeta or current_app.config['HLS_FOLDER']
+    return os.path.join(carpeta, clave[:2], clave)
+
+
+def admite_hls(archivo):
+    return bool(archivo.hash_archivo) and (archivo.tipo or '').startswith('video/')
+
+
+def esta_listo(archivo):
+    return admite_hls(archivo) and os.path.isfile(os.path.join(carpeta_hls(archivo.hash_archivo), MAESTRA))
+
+
+def url_hls_js():
+    """URL de la copia local de hls.js, o None si no se ha instalado."""
+    if not os.path.isfile(os.path.join(current_app.config['VENDOR_FOLDER'], HLS_JS)):
+        return None
+    return url_for('vendor', fichero=HLS_JS)
+
+
+def url_hls(archivo):
+    """URL de la lista maestra, o None si el archivo no la admite o el usuario no puede verlo.
+
+    Con sesión no comprueba que el paquete exista: pedirla es lo que lo genera.
+    Sin sesión solo se ofrece si ya está listo, porque entonces no se genera.
+    """
+    if not admite_hls(archivo):
+        return None
+    if archivo.es_privado and not session.get('acceso_privado'):
+        return None
+    if not session.get('usuario_id') and not esta_listo(archivo):
+        return None
+    # La versión va en la ruta (no en ?v=) para que la hereden las URLs relativas
+    # de las listas y los segmentos
+    return url_for('hls', id=archivo.id, version=archivo.hash_archivo[:8], fichero=MAESTRA)
+
+
+def marcar_uso(clave):
+    """Refresca la fecha de último uso de un paquete. FileNotFoundError si no está listo."""
+    maestra = os.path.join(carpeta_hls(clave), MAESTRA)
+    if time.time() - os.stat(maestra).st_mtime > REFRESCO_USO:
+        os.utime(maestra)
+
+
+def parametros_generacion():
+    """Ajustes de HLS_* para pasarlos a un proceso hijo."""
+    config = current_app.config
+    return {
+        'carpeta': config['HLS_FOLDER'],
+        'escalera': [tuple(escalon) for escalon in config['HLS_ESCALERA']],
+        'segundos': config['HLS_SEGUNDOS'],
+    }
+
+
+# --- Generación (sin contexto de Flask: corre en los procesos hijo) -----------
+
+def calidades(escalera, lado_corto):
+    """Escalones (alto, kbps de vídeo, kbps de audio) que no amplían el original."""
+    escalera = sorted(escalera)
+    elegidos = [escalon for escalon in escalera if lado_corto is None or escalon[0] <= lado_corto]
+    if not elegidos:
+        # Original más pequeño que la calidad más baja: se deja a su tamaño (par, para H.264)
+        alto, video, audio = escalera[0]
+        elegidos = [(max(2, lado_corto - lado_corto % 2), video, audio)]
+    return elegidos
+
+
+def _argumentos(ruta, destino, escalones, con_audio, segundos):
+    filtros = [f"[0:v:0]split={len(escalones)}" + ''.join(f"[e{i}]" for i in range(len(escalones)))]
+    mapas, tasas, flujos = [], [], []
+    for i, (alto, video, audio) in enumerate(escalones):
+        # El lado corto pasa a `alto`, tanto en horizontal como en vertical
+        filtros.append(f"[e{i}]scale='if(gt(iw,ih),-2,{alto})':'if(gt(iw,ih),{alto},-2)'[s{i}]")
+        mapas += ['-map', f"[s{i}]"]
+        tasas += [f"-b:v:{i}", f"{video}k", f"-maxrate:v:{i}", f"{int(video * 1.07)}k",
+                  f"-bufsize:v:{i}", f"{int(video * 1.5)}k"]
+        if con_audio:
+            mapas += ['-map', '0:a:0']
+            tasas += [f"-b:a:{i}", f"{audio}k"]
+            flujos.append(f"v:{i},a:{i},name:{alto}p")
+        else:
+            flujos.append(f"v:{i},name:{alto}p")
+
+    return [
+        '-i', ruta, '-filter_complex', ';'.join(filtros), *mapas,
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-sc_threshold', '0',
+        # Un fotograma clave al principio de cada segmento en todas las calidades
+        '-force_key_frames', f"expr:gte(t,n_forced*{segundos})",
+        *(['-c:a', 'aac', '-ac', '2'] if con_audio else []), *tasas,
+        '-f', 'hls', '-hls_time', str(segundos), '-hls_playlist_type', 'vod',
+        '-hls_flags', 'independent_segments',
+        '-hls_segment_filename', os.path.join(destino, '%v', PATRON_SEGMENTO),
+        '-master_pl_name', MAESTRA, '-var_stream_map', ' '.join(flujos),
+        os.path.join(destino, '%v', LISTA),
+    ]
+
+
+def generar_hls(ruta, clave, duracion, lado_corto, con_audio, carpeta, escalera, segundos,
+                al_progresar=None, al_iniciar=None):
+    """Empaqueta un vídeo en su carpeta. Devuelve la clave."""
+    destino = carpeta_hls(clave, carpeta)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporal = os.path.join(os.path.dirname(destino), f".{uuid.uuid4().hex}")
+    os.makedirs(temporal)
+    try:
+        ejecutar_ffmpeg(
+            _argumentos(ruta, temporal, calidades(escalera, lado_corto), con_audio, segundos),
+            duracion=duracion,
+            al_progresar=al_progresar,
+            al_iniciar=al_iniciar,
+        )
+        if not os.path.isfile(os.path.join(temporal, MAESTRA)):
+            raise RuntimeError("ffmpeg no generó la lista maestra")
+
+        if os.path.isdir(destino):
+            shutil.rmtree(destino)
+        os.replace(temporal, destino)
+    finally:
+        if os.path.isdir(temporal):
+            shutil.rmtree(temporal)
+    return clave
+
+
+# --- Presupuesto de la caché ----------------------------------------------------
+
+def _escanear(carpeta):
+    """(último uso, bytes, ruta) de cada paquete de la caché."""
+    paquetes = []
+    try:
+        with os.scandir(carpeta) as subcarpetas:
+            for subcarpeta in subcarpetas:
+                if not subcarpeta.is_dir():
+                    continue
+                with os.scandir(subcarpeta.path) as entradas:
+                    for entrada in entradas:
+                        # Las carpetas .<uuid> son paquetes a medio generar
+                        if not entrada.is_dir() or entrada.name.startswith('.'):
+                            continue
+                        tamano = 0
+                        for raiz, _, ficheros in os.walk(entrada.path):
+                            for fichero in ficheros:
+                                try:
+                                    tamano += os.path.getsize(os.path.join(raiz, fichero))
+                                except FileNotFoundError:
+                                    pass
+                        try:
+                            uso = os.stat(os.path.join(entrada.path, MAESTRA)).st_mtime
+                        except FileNotFoundError:
+                            uso = 0
+                        paquetes.append((uso, tamano, entrada.path))
+    except FileNotFoundError:
+        pass
+    return paquetes
+
+
+def podar(carpeta, limite):
+    """Borra los paquetes menos vistos si la caché pasa de `limite`. Devuelve los bytes que quedan."""
+    paquetes = _escanear(carpeta)
+    ocupado = sum(tamano for _, tamano, _ in paquetes)
+    if ocupado <= limite:
+        return ocupado
+    objetivo = limite * MARGEN_EVICCION
+    for _, tamano, ruta in sorted(paquetes):
+        if ocupado <= objetivo:
+            break
+        shutil.rmtree(ruta, ignore_errors=True)
+        ocupado -= tamano
+    return ocupado
@@ -0,0 +1,301 @@
+"""Índice invertido de etiquetas en memoria para /buscar, /filtrar_privado y
+/sugerencias_etiquetas.
+
+Para cada ámbito de visibilidad guarda etiqueta -> conjunto de ids de archivo,
+así que una consulta como `paisaje -noche 2023 viaje` es una intersección de
+conjuntos (empezando por el más pequeño) menos los excluidos, sin tocar la BD.
+Los archivos en la papelera no están en ningún ámbito. El tamaño de cada
+conjunto es además el número de usos de la etiqueta en ese ámbito, y una lista
+ordenada de nombres permite autocompletar prefijos con bisect.
+
+Cada proceso tiene su copia y la mantiene al día de forma incremental: un
+listener de SQLAlchemy apunta en `cambio_etiquetas`, dentro de la misma
+transacción, cada archivo cuyas etiquetas, privacidad o papelera cambian
+(editar_etiquetas, subidas, borrados, reconcile...). Antes de cada consulta el
+índice lee las entradas nuevas y recarga solo esos archivos.
+"""
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import threading
+
+from sqlalchemy import delete, event, func, inspect, insert, or_, select
+from sqlalchemy.orm import Session
+
+from models import db, Archivo, CambioEtiquetas, Etiqueta, archivo_etiqueta
+
+# Ámbitos: quién ve qué. Cada archivo visible está en 'todos' y en uno de los otros dos.
+TODOS = 'todos'
+PUBLICOS = 'publicos'
+PRIVADOS = 'privados'
+
+# Las entradas de cambio_etiquetas más antiguas se purgan; un proceso que lleve
+# más tiempo sin consultar reconstruye su índice entero
+CADUCIDAD_CAMBIOS = timedelta(days=1)
+# Margen para entradas que se confirman fuera de orden (PostgreSQL): se releen
+# las recientes aunque tengan un id menor que el último visto
+MARGEN_CAMBIOS = timedelta(minutes=5)
+# Ids por consulta al recargar archivos
+LOTE = 500
+
+
+def separar_terminos(consulta):
+    """('a -b c') -> (['a', 'c'], ['b']): la sintaxis de siempre de /buscar."""
+    terminos = consulta.split()
+    incluir = [t for t in terminos if not t.startswith('-')]
+    excluir = [t[1:] for t in terminos if t.startswith('-') and len(t) > 1]
+    return incluir, excluir
+
+
+class IndiceEtiquetas:
+    def __init__(self):
+        self._cerrojo = threading.Lock()
+        self._ambitos = None  # {ámbito: {etiqueta: set(ids)}}
+        self._etiquetados = None  # {ámbito: set(ids con alguna etiqueta)}
+        self._entradas = {}  # {archivo_id: (ámbitos, etiquetas)} para poder quitarlo
+        self._privadas = set()  # Etiquetas marcadas es_privada
+        self._ordenados = None  # (claves en minúsculas, nombres), ordenados; None si hay que rehacerlos
+        self._ultimo_cambio = 0
+        self._recientes = {}  # {id de cambio: fecha} dentro del margen, ya aplicados
+        self._ultima_purga = None
+
+    # --- Consulta ------------------------------------------------------------------
+
+    def consultar(self, incluir, excluir, ambito):
+        """Ids del ámbito con todas las etiquetas de `incluir` y ninguna de `excluir`.
+
+        Sin etiquetas que incluir parte de todos los archivos etiquetados del
+        ámbito, como hacía el join con archivo_etiqueta.
+        """
+        self.refrescar()
+        with self._cerrojo:
+            por_etiqueta = self._ambitos[ambito]
+            if incluir:
+                conjuntos = sorted((por_etiqueta.get(t, ()) for t in set(incluir)), key=len)
+                if not conjuntos[0]:
+                    return set()
+                resultado = set(conjuntos[0]).intersection(*conjuntos[1:])
+            else:
+                resultado = set(self._etiquetados[ambito])
+            for etiqueta in set(excluir):
+                if not resultado:
+                    break
+                resultado.difference_update(por_etiqueta.get(etiqueta, ()))
+            return resultado
+
+    def sugerir(self, parcial, ambito, etiquetas_privadas=True, limite=10):
+        """[(nombre, usos)] de las etiquetas usadas en el ámbito que empiezan por `parcial`.
+
+        Sin distinguir mayúsculas, en orden alfabético y con las que empiezan
+        por ' al final.
+        """
+        self.refrescar()
+        with self._cerrojo:
+            if self._ordenados is None:
+                nombres = sorted(self._ambitos[TODOS], key=lambda nombre: (nombre.lower(), nombre))
+                self._ordenados = ([nombre.lower() for nombre in nombres], nombres)
+            claves, nombres = self._ordenados
+            por_etiqueta = self._ambitos[ambito]
+            parcial = parcial.lower()
+
+            def coincidencias(prefijo):
+                for posicion in range(bisect_left(claves, prefijo), len(claves)):
+                    if not claves[posicion].startswith(prefijo):
+                        return
+                    nombre = nombres[posicion]
+                    usos = len(por_etiqueta.get(nombre, ()))
+                    if usos and (etiquetas_privadas or nombre not in self._privadas):
+                        yield nombre, usos
+
+            resultado = []
+            # Las ' van juntas (ordenan antes que las letras): se piden aparte, al final
+            if parcial.startswith("'"):
+                fuentes = [coincidencias(parcial)]
+            else:
+                fuentes = [
+                    (par for par in coincidencias(parcial) if not par[0].startswith("'")),
+                    coincidencias("'") if not parcial else iter(()),
+                ]
+            for fuente in fuentes:
+                for par in fuente:
+                    if len(resultado) == limite:
+                        return resultado
+                    resultado.append(par)
+            return resultado
+
+    # --- Mantenimiento ---------------------------------------------------------------
+
+    def refrescar(self):
+        """Aplica los cambios registrados desde la última vez (o construye el índice)."""
+        with self._cerrojo:
+            if self._ambitos is None:
+                self._reconstruir()
+                return
+
+            ahora = datetime.utcnow()
+            desde = ahora - MARGEN_CAMBIOS
+            minimo = db.session.execute(select(func.min(CambioEtiquetas.id))).scalar()
+            if minimo is not None and minimo > self._ultimo_cambio + 1 and self._ultimo_cambio:
+                # Se han purgado cambios que este proceso no llegó a ver
+                self._reconstruir()
+                return
+
+            filas = db.session.execute(
+                select(CambioEtiquetas.id, CambioEtiquetas.archivo_id, CambioEtiquetas.fecha)
+                .where(or_(CambioEtiquetas.id > self._ultimo_cambio, CambioEtiquetas.fecha >= desde))
+            ).all()
+            pendientes = set()
+            for cambio_id, archivo_id, fecha in filas:
+                if cambio_id in self._recientes:
+                    continue
+                pendientes.add(archivo_id)
+                self._ultimo_cambio = max(self._ultimo_cambio, cambio_id)
+                if fecha and fecha >= desde:
+                    self._recientes[cambio_id] = fecha
+            self._recientes = {c: f for c, f in self._recientes.items() if f >= desde}
+            if pendientes:
+                self._recargar(pendientes)
+            self._purgar(ahora)
+
+    def _reconstruir(self):
+        self._ambitos = {TODOS: {}, PUBLICOS: {}, PRIVADOS: {}}
+        self._etiquetados = {TODOS: set(), PUBLICOS: set(), PRIVADOS: set()}
+        self._entradas = {}
+        self._privadas = set()
+        self._ordenados = None
+        self._recientes = {}
+        # Primero el último cambio: lo que se registre mientras se lee se aplica después
+        self._ultimo_cambio = db.session.execute(select(func.max(CambioEtiquetas.id))).scalar() or 0
+        self._cargar(self._filas())
+
+    def _recargar(self, ids):
+        for archivo_id in ids:
+            self._quitar(archivo_id)
+        ids = sorted(ids)
+        for inicio in range(0, len(ids), LOTE):
+            self._cargar(self._filas(ids[inicio:inicio + LOTE]))
+
+    def _filas(self, ids=None):
+        consulta = (
+            select(Archivo.id, Archivo.es_privado, Etiqueta.nombre, Etiqueta.es_privada)
+            .join(archivo_etiqueta, archivo_etiqueta.c.archivo_id == Archivo.id)
+            .join(Etiqueta, Etiqueta.id == archivo_etiqueta.c.etiqueta_id)
+            .where(Archivo.fecha_eliminado.is_(None))
+        )
+        if ids is not None:
+            consulta = consulta.where(Archivo.id.in_(ids))
+        return db.session.execute(consulta)
+
+    def _cargar(self, filas):
+        nuevas = {}
+        for archivo_id, es_privado, etiqueta, es_privada in filas:
+            ambitos, etiquetas = nuevas.setdefault(
+                archivo_id, ((TODOS, PRIVADOS if es_privado else PUBLICOS), set())
+            )
+            etiquetas.add(etiqueta)
+            if es_privada:
+                self._privadas.add(etiqueta)
+            else:
+                self._privadas.discard(etiqueta)
+        for archivo_id, (ambitos, etiquetas) in nuevas.items():
+            for ambito in ambitos:
+                por_etiqueta = self._ambitos[ambito]
+                for etiqueta in etiquetas:
+                    if etiqueta not in por_etiqueta:
+                        por_etiqueta[etiqueta] = set()
+                        if ambito == TODOS:
+                            self._ordenados = None
+                    por_etiqueta[etiqueta].add(archivo_id)
+                self._etiquetados[ambito].add(archivo_id)
+            self._entradas[archivo_id] = (ambitos, frozenset(etiquetas))
+
+    def _quitar(self, archivo_id):
+        entrada = self._entradas.pop(archivo_id, None)
+        if entrada is None:
+            return
+        ambitos, etiquetas = entrada
+        for ambito in ambitos:
+            por_etiqueta = self._ambitos[ambito]
+            for etiqueta in etiquetas:
+                ids = por_etiqueta.get(etiqueta)
+                if ids is not None:
+                    ids.discard(archivo_id)
+                    if not ids:
+                        del por_etiqueta[etiqueta]
+                        if ambito == TODOS:
+                            self._ordenados = None
+            self._etiquetados[ambito].discard(archivo_id)
+
+    def _purgar(self, ahora):
+        if self._ultima_purga and ahora - self._ultima_purga < timedelta(hours=1):
+            return
+        self._ultima_purga = ahora
+        # Se conserva siempre la última entrada, para que el mínimo delate las purgas
+        ultimo = select(func.max(CambioEtiquetas.id)).scalar_subquery()
+        # Conexión aparte: no confirma nada pendiente en la sesión de la petición
+        with db.engine.begin() as conexion:
+            conexion.execute(
+                delete(CambioEtiquetas)
+                .where(CambioEtiquetas.fecha < ahora - CADUCIDAD_CAMBIOS, CambioEtiquetas.id < ultimo)
+            )
+
+
+indice = IndiceEtiquetas()
+
+
+def buscar_archivos(consulta, ambito, orden=None):
+    """Archivos de `ambito` que cumplen la consulta de etiquetas, en el orden pedido (o por id)."""
+    incluir, excluir = separar_terminos(consulta)
+    ids = sorted(indice.consultar(incluir, excluir, ambito))
+    archivos = []
+    for inicio in range(0, len(ids), LOTE):
+        archivos.extend(Archivo.query.filter(Archivo.id.in_(ids[inicio:inicio + LOTE])).all())
+    if orden is not None:
+        atributo, descendente = orden
+
+        def clave(archivo):
+            # NULL primero al subir y último al bajar, como el ORDER BY de SQLite
+            valor = getattr(archivo, atributo)
+            return (valor is not None, valor if valor is not None else 0)
+
+        archivos.sort(key=clave, reverse=descendente)
+    else:
+        archivos.sort(key=lambda archivo: archivo.id)
+    return archivos
+
+
+# --- Registro de cambios ----------------------------------------------------------------
+
+def _archivos_afectados(sesion):
+    ids = set()
+    for objeto in sesion.new:
+        if isinstance(objeto, Archivo):
+            ids.add(objeto.id)
+    for objeto in sesion.deleted:
+        if isinstance(objeto, Archivo):
+            ids.add(objeto.id)
+    for objeto in sesion.dirty:
+        if isinstance(objeto, Archivo):
+            estado = inspect(objeto)
+            if any(estado.attrs[a].history.has_changes() for a in ('etiquetas', 'es_privado', 'fecha_eliminado')):
+                ids.add(objeto.id)
+        elif isinstance(objeto, Etiqueta):
+            estado = inspect(objeto)
+            if estado.attrs.nombre.history.has_changes() or estado.attrs.archivos.history.has_changes():
+                ids.update(a.id for a in estado.attrs.archivos.history.sum() if a.id is not None)
+                ids.update(sesion.connection().execute(
+                    select(archivo_etiqueta.c.archivo_id).where(archivo_etiqueta.c.etiqueta_id == objeto.id)
+                ).scalars())
+    ids.discard(None)
+    return ids
+
+
+@event.listens_for(Session, 'after_flush')
+def _registrar_cambios(sesion, contexto):
+    # Mismo commit que el cambio: si se deshace, el registro también
+    ids = _archivos_afectados(sesion)
+    if ids:
+        ahora = datetime.utcnow()
+        sesion.connection().execute(
+            insert(CambioEtiquetas),
+            [{'archivo_id': archivo_id, 'fecha': ahora} for archivo_id in sorted(ids)],
+        )
@@ -0,0 +1,215 @@
+"""Ingesta de subidas en una sola pasada.
+
+Werkzeug entrega cada fichero multipart a un FicheroEntrante que lo escribe en
+disco (SUBIDAS_FOLDER, en la misma unidad que la biblioteca) mientras calcula
+el hash, cuenta los bytes y guarda la cabecera para reconocer el tipo por sus
+bytes mágicos. Colocarlo en su carpeta es un simple renombrado, así que el
+contenido de la subida solo se lee y se escribe una vez.
+
+Las tres rutas de subida (upload, upload_privado y /api/files) y las subidas
+troceadas comparten `ingerir`, que crea el Archivo con esos datos.
+"""
+from collections import namedtuple
+import mimetypes
+import os
+import shutil
+import uuid
+
+from flask import Request, current_app
+
+from duplicados import deduplicar
+from hashes import algoritmo_actual, nuevo_resumen
+from models import db, Archivo
+from tareas import encolar_audio, encolar_derivados, encolar_pdf
+
+BLOQUE = 1024 * 1024
+CABECERA = 64  # Bytes que hacen falta para reconocer el tipo
+
+Recibido = namedtuple('Recibido', ['ruta', 'tamaño', 'hash_archivo', 'tipo'])
+
+
+# --- Tipo por contenido ---------------------------------------------------------
+
+_FIRMAS = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'%PDF-', 'application/pdf'),
+    (b'OggS', 'audio/ogg'),
+    (b'fLaC', 'audio/flac'),
+    (b'ID3', 'audio/mpeg'),
+)
+
+_MARCAS_ISO = {
+    b'qt  ': 'video/quicktime',
+    b'M4A ': 'audio/mp4',
+    b'M4B ': 'audio/mp4',
+    b'heic': 'image/heic',
+    b'heix': 'image/heic',
+    b'avif': 'image/avif',
+    b'3gp4': 'video/3gpp',
+    b'3gp5': 'video/3gpp',
+}
+
+_RIFF = {
+    b'WEBP': 'image/webp',
+    b'WAVE': 'audio/wav',
+    b'AVI ': 'video/x-msvideo',
+}
+
+
+def tipo_por_contenido(cabecera):
+    """Tipo MIME según los primeros bytes, o None si no es concluyente.
+
+    Los contenedores genéricos (ZIP de ofimática, ASF de WMA/WMV) se dejan a la
+    extensión, que ahí es más precisa.
+    """
+    for firma, tipo in _FIRMAS:
+        if cabecera.startswith(firma):
+            return tipo
+    if cabecera[4:8] == b'ftyp':
+        return _MARCAS_ISO.get(cabecera[8:12], 'video/mp4')
+    if cabecera.startswith(b'RIFF'):
+        return _RIFF.get(cabecera[8:12])
+    if cabecera.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm' if b'webm' in cabecera else 'video/x-matroska'
+    if len(cabecera) >= 2 and cabecera[0] == 0xff and cabecera[1] & 0xe0 == 0xe0:
+        # Sincronía de trama MPEG sin etiqueta ID3
+        return 'audio/mpeg'
+    return None
+
+
+def _resolver_tipo(ruta, cabecera, tipo_cliente=None):
+    return (
+        tipo_por_contenido(cabecera)
+        or mimetypes.guess_type(ruta)[0]
+        or tipo_cliente
+        or 'application/octet-stream'
+    )
+
+
+# --- Recepción --------------------------------------------------------------------
+
+class FicheroEntrante:
+    """Destino de Werkzeug para un fichero multipart: disco + hash + tamaño + cabecera."""
+
+    def __init__(self, carpeta):
+        os.makedirs(carpeta, exist_ok=True)
+        # No mkstemp: crearía el fichero con permisos 0600 y el proxy de entrega no lo leería
+        self.ruta = os.path.join(carpeta, f".ingesta_{uuid.uuid4().hex}")
+        self._fichero = open(self.ruta, 'x+b')
+        self.resumen = nuevo_resumen()
+        self.tamaño = 0
+        self.cabecera = b''
+        self.colocado = False
+
+    def write(self, datos):
+        if len(self.cabecera) < CABECERA:
+            self.cabecera += bytes(datos[:CABECERA - len(self.cabecera)])
+        self.resumen.update(datos)
+        self.tamaño += len(datos)
+        return self._fichero.write(datos)
+
+    def __getattr__(self, nombre):
+        # read, seek, tell... para FileStorage y para quien use .save() fuera de la ingesta
+        return getattr(self._fichero, nombre)
+
+    def colocar(self, destino):
+        """Mueve el temporal a `destino`; en la misma unidad no copia nada."""
+        self._fichero.close()
+        shutil.move(self.ruta, destino)
+        self.colocado = True
+
+    def close(self):
+        self._fichero.close()
+        # Subidas que ninguna vista ha colocado (formularios de avatar...): fuera
+        if not self.colocado and os.path.exists(self.ruta):
+            os.remove(self.ruta)
+
+
+class PeticionIngesta(Request):
+    """Request que escribe los ficheros multipart directamente en un FicheroEntrante."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return FicheroEntrante(current_app.config['SUBIDAS_FOLDER'])
+
+
+def recibir(archivo_subido, carpeta, filename):
+    """Lleva una subida multipart a carpeta/filename. Devuelve un Recibido."""
+    ruta = os.path.join(carpeta, filename)
+    flujo = archivo_subido.stream
+    if isinstance(flujo, FicheroEntrante):
+        flujo.colocar(ruta)
+        return Recibido(ruta, flujo.tamaño, flujo.resumen.hexdigest(),
+                        _resolver_tipo(ruta, flujo.cabecera, archivo_subido.mimetype))
+
+    # Sin PeticionIngesta: se copia calculando lo mismo por el camino
+    resumen = nuevo_resumen()
+    tamaño = 0
+    cabecera = b''
+    with open(ruta, 'wb') as destino:
+        for bloque in iter(lambda: flujo.read(BLOQUE), b''):
+            if len(cabecera) < CABECERA:
+                cabecera += bloque[:CABECERA - len(cabecera)]
+            resumen.update(bloque)
+            tamaño += len(bloque)
+            destino.write(bloque)
+    return Recibido(ruta, tamaño, resumen.hexdigest(), _resolver_tipo(ruta, cabecera, archivo_subido.mimetype))
+
+
+def medir(ruta, tipo_cliente=None):
+    """Recibido de un fichero que ya está en disco (subidas troceadas), en una lectura."""
+    resumen = nuevo_resumen()
+    tamaño = 0
+    with open(ruta, 'rb') as origen:
+        cabecera = origen.read(CABECERA)
+        origen.seek(0)
+        for bloque in iter(lambda: origen.read(BLOQUE), b''):
+            resumen.update(bloque)
+            tamaño += len(bloque)
+    return Recibido(ruta, tamaño, resumen.hexdigest(), _resolver_tipo(ruta, cabecera, tipo_cliente))
+
+
+# --- Registro -----------------------------------------------------------------------
+
+def ingerir(recibido, es_privado=False, convertir_pdf=False, convertir_audio=False, ver_privados=True, **campos):
+    """Crea el Archivo de un fichero ya colocado, con su deduplicación y derivados.
+
+    Devuelve (nuevo, existente, tareas): `nuevo` es None si la política de
+    duplicados rechaza la subida y `existente` el Archivo con los mismos bytes,
+    si lo hay. En las subidas, `ver_privados` es el acceso privado de quien
+    sube: sin él no se deduplica contra los privados. `convertir_pdf` y
+    `convertir_audio` encolan el PDF de un documento o el audio de un vídeo,
+    que se añaden a la biblioteca al terminar. El llamante hace el commit.
+    """
+    filename = os.path.basename(recibido.ruta)
+
+    nuevo = Archivo(
+        nombre=filename,
+        ruta=recibido.ruta,
+        tipo=recibido.tipo,
+        tamaño=recibido.tamaño,
+        mtime=os.path.getmtime(recibido.ruta),
+        hash_archivo=recibido.hash_archivo,
+        algoritmo_hash=algoritmo_actual(),
+        es_privado=es_privado,
+        **campos
+    )
+    existente, aceptado = deduplicar(nuevo, ver_privados)
+    if not aceptado:
+        return None, existente, []
+
+    db.session.add(nuevo)
+    tareas = encolar_derivados(nuevo)
+
+    # Los tipos que no admiten la conversión devuelven None
+    if convertir_pdf:
+        tareas.append(encolar_pdf(nuevo))
+    if convertir_audio:
+        tareas.append(encolar_audio(nuevo))
+
+    return nuevo, existente, [tarea for tarea in tareas if tarea is not None]
@@ -0,0 +1,45 @@
+"""tabla subida para las subidas troceadas
+
+Revision ID: 1d5a7c9e3f60
+Revises: 9c3f6a1e4b82
+Create Date: 2026-10-17 17:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1d5a7c9e3f60'
+down_revision = '9c3f6a1e4b82'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() puede haber creado ya la tabla en instalaciones nuevas
+    if sa.inspect(op.get_bind()).has_table('subida'):
+        return
+
+    op.create_table(
+        'subida',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('usuario_id', sa.Integer(), nullable=False),
+        sa.Column('nombre', sa.String(length=255), nullable=False),
+        sa.Column('tamaño', sa.BigInteger(), nullable=False),
+        sa.Column('recibido', sa.BigInteger(), nullable=False),
+        sa.Column('es_privado', sa.Boolean(), nullable=True),
+        sa.Column('opciones', sa.JSON(), nullable=True),
+        sa.Column('estado', sa.String(length=16), nullable=False),
+        sa.Column('archivo_id', sa.Integer(), nullable=True),
+        sa.Column('rechazada', sa.Boolean(), nullable=True),
+        sa.Column('fecha_creada', sa.DateTime(), nullable=True),
+        sa.Column('fecha_actualizada', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['archivo_id'], ['archivo.id']),
+        sa.ForeignKeyConstraint(['usuario_id'], ['usuario.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('subida')
@@ -0,0 +1,63 @@
+"""miniatura y tamaño almacenados en archivo
+
+Revision ID: 3f1c2a9d7b10
+Revises: 
+Create Date: 2026-10-17 10:12:00.000000
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    columnas = {c['name'] for c in sa.inspect(bind).get_columns('archivo')}
+    # db.create_all() puede haber creado ya la columna en instalaciones nuevas
+    if 'miniatura' not in columnas:
+        with op.batch_alter_table('archivo') as batch_op:
+            batch_op.add_column(sa.Column('miniatura', sa.String(length=255), nullable=True))
+
+    # Rellenar una única vez desde disco lo que antes se consultaba en cada listado
+    archivo = sa.table(
+        'archivo',
+        sa.column('id', sa.Integer),
+        sa.column('nombre', sa.String),
+        sa.column('ruta', sa.Text),
+        sa.column('es_privado', sa.Boolean),
+        sa.column('tamaño', sa.BigInteger),
+        sa.column('miniatura', sa.String),
+    )
+    filas = bind.execute(sa.select(
+        archivo.c.id, archivo.c.nombre, archivo.c.ruta, archivo.c.es_privado,
+        archivo.c['tamaño'], archivo.c.miniatura,
+    )).fetchall()
+
+    for fila in filas:
+        cambios = {}
+        if fila._mapping['tamaño'] is None and fila.ruta and os.path.isfile(fila.ruta):
+            cambios['tamaño'] = os.path.getsize(fila.ruta)
+
+        if fila.miniatura is None and fila.nombre:
+            carpeta = current_app.config['PRIVATE_UPLOAD_FOLDER'] if fila.es_privado else current_app.config['UPLOAD_FOLDER']
+            for candidata in (f"thumb_{fila.nombre}", f"thumb_{fila.nombre}.jpg"):
+                if os.path.isfile(os.path.join(carpeta, candidata)):
+                    cambios['miniatura'] = candidata
+                    break
+
+        if cambios:
+            bind.execute(archivo.update().where(archivo.c.id == fila.id).values(**cambios))
+
+
+def downgrade():
+    with op.batch_alter_table('archivo') as batch_op:
+        batch_op.drop_column('miniatura')
@@ -0,0 +1,47 @@
+"""tabla media_info con los metadatos de ffprobe
+
+Revision ID: 5b7e1d3f9a24
+Revises: c2d9f4a7e613
+Create Date: 2026-10-17 14:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e1d3f9a24'
+down_revision = 'c2d9f4a7e613'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() puede haber creado ya la tabla en instalaciones nuevas
+    if sa.inspect(op.get_bind()).has_table('media_info'):
+        return
+
+    op.create_table(
+        'media_info',
+        sa.Column('archivo_id', sa.Integer(), nullable=False),
+        sa.Column('hash_archivo', sa.String(length=64), nullable=True),
+        sa.Column('mtime', sa.Float(), nullable=True),
+        sa.Column('formato', sa.String(length=100), nullable=True),
+        sa.Column('duracion', sa.Float(), nullable=True),
+        sa.Column('bitrate', sa.BigInteger(), nullable=True),
+        sa.Column('video_codec', sa.String(length=32), nullable=True),
+        sa.Column('audio_codec', sa.String(length=32), nullable=True),
+        sa.Column('ancho', sa.Integer(), nullable=True),
+        sa.Column('alto', sa.Integer(), nullable=True),
+        sa.Column('streams_video', sa.Integer(), nullable=True),
+        sa.Column('streams_audio', sa.Integer(), nullable=True),
+        sa.Column('streams_subtitulos', sa.Integer(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('fecha_sondeo', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['archivo_id'], ['archivo.id']),
+        sa.PrimaryKeyConstraint('archivo_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('media_info')
@@ -0,0 +1,36 @@
+"""algoritmo_hash en archivo
+
+Revision ID: 7e2b4d6f8a13
+Revises: 1d5a7c9e3f60
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e2b4d6f8a13'
+down_revision = '1d5a7c9e3f60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columnas = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('archivo')}
+
+    # db.create_all() puede haber creado ya la columna en instalaciones nuevas
+    if 'algoritmo_hash' not in columnas:
+        with op.batch_alter_table('archivo') as batch_op:
+            batch_op.add_column(sa.Column('algoritmo_hash', sa.String(length=16), nullable=True))
+
+    # Hasta ahora las subidas guardaban md5 y el antiguo hash.py sha256: se distinguen por longitud
+    op.execute("UPDATE archivo SET algoritmo_hash = 'md5' "
+               "WHERE algoritmo_hash IS NULL AND LENGTH(hash_archivo) = 32")
+    op.execute("UPDATE archivo SET algoritmo_hash = 'sha256' "
+               "WHERE algoritmo_hash IS NULL AND LENGTH(hash_archivo) = 64")
+
+
+def downgrade():
+    with op.batch_alter_table('archivo') as batch_op:
+        batch_op.drop_column('algoritmo_hash')
@@ -0,0 +1,50 @@
+"""tabla tarea para la cola en segundo plano
+
+Revision ID: 8a4e0c6b2d51
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-17 11:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e0c6b2d51'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() puede haber creado ya la tabla en instalaciones nuevas
+    if sa.inspect(op.get_bind()).has_table('tarea'):
+        return
+
+    op.create_table(
+        'tarea',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('tipo', sa.String(length=32), nullable=False),
+        sa.Column('archivo_id', sa.Integer(), nullable=True),
+        sa.Column('estado', sa.String(length=16), nullable=False),
+        sa.Column('parametros', sa.JSON(), nullable=True),
+        sa.Column('progreso', sa.Float(), nullable=True),
+        sa.Column('intentos', sa.Integer(), nullable=True),
+        sa.Column('max_intentos', sa.Integer(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('disponible_desde', sa.DateTime(), nullable=True),
+        sa.Column('fecha_creada', sa.DateTime(), nullable=True),
+        sa.Column('fecha_inicio', sa.DateTime(), nullable=True),
+        sa.Column('fecha_fin', sa.DateTime(), nullable=True),
+        sa.Column('fecha_actualizada', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['archivo_id'], ['archivo.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_tarea_estado_disponible', 'tarea', ['estado', 'disponible_desde'])
+    op.create_index('ix_tarea_archivo', 'tarea', ['archivo_id'])
+
+
+def downgrade():
+    op.drop_index('ix_tarea_archivo', table_name='tarea')
+    op.drop_index('ix_tarea_estado_disponible', table_name='tarea')
+    op.drop_table('tarea')
@@ -0,0 +1,38 @@
+"""índices de hash y hash_original en archivo
+
+Revision ID: 9c3f6a1e4b82
+Revises: e4a8b2c6d017
+Create Date: 2026-10-17 16:45:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3f6a1e4b82'
+down_revision = 'e4a8b2c6d017'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    columnas = {c['name'] for c in inspector.get_columns('archivo')}
+    indices = {i['name'] for i in inspector.get_indexes('archivo')}
+
+    # db.create_all() puede haber creado ya columna e índices en instalaciones nuevas
+    with op.batch_alter_table('archivo') as batch_op:
+        if 'hash_original' not in columnas:
+            batch_op.add_column(sa.Column('hash_original', sa.String(length=64), nullable=True))
+        if 'ix_archivo_hash_archivo' not in indices:
+            batch_op.create_index('ix_archivo_hash_archivo', ['hash_archivo'])
+        if 'ix_archivo_hash_original' not in indices:
+            batch_op.create_index('ix_archivo_hash_original', ['hash_original'])
+
+
+def downgrade():
+    with op.batch_alter_table('archivo') as batch_op:
+        batch_op.drop_index('ix_archivo_hash_original')
+        batch_op.drop_index('ix_archivo_hash_archivo')
+        batch_op.drop_column('hash_original')
@@ -0,0 +1,76 @@
+"""índice FTS5 de búsqueda (solo SQLite)
+
+Revision ID: a3c5e7f9b214
+Revises: 7e2b4d6f8a13
+Create Date: 2026-10-17 18:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c5e7f9b214'
+down_revision = '7e2b4d6f8a13'
+branch_labels = None
+depends_on = None
+
+ETIQUETAS_DE = (
+    "(SELECT group_concat(e.nombre, ' ') FROM archivo_etiqueta ae "
+    "JOIN etiqueta e ON e.id = ae.etiqueta_id WHERE ae.archivo_id = {})"
+)
+
+TRIGGERS = {
+    'archivo_fts_insertar': f"""AFTER INSERT ON archivo BEGIN
+        INSERT INTO archivo_fts(rowid, nombre, descripcion, tipo, etiquetas)
+        VALUES (NEW.id, NEW.nombre, NEW.descripcion, NEW.tipo, {ETIQUETAS_DE.format('NEW.id')});
+    END""",
+    'archivo_fts_actualizar': """AFTER UPDATE OF nombre, descripcion, tipo ON archivo BEGIN
+        UPDATE archivo_fts SET nombre = NEW.nombre, descripcion = NEW.descripcion, tipo = NEW.tipo
+        WHERE rowid = NEW.id;
+    END""",
+    'archivo_fts_borrar': """AFTER DELETE ON archivo BEGIN
+        DELETE FROM archivo_fts WHERE rowid = OLD.id;
+    END""",
+    'archivo_etiqueta_fts_insertar': f"""AFTER INSERT ON archivo_etiqueta BEGIN
+        UPDATE archivo_fts SET etiquetas = {ETIQUETAS_DE.format('NEW.archivo_id')}
+        WHERE rowid = NEW.archivo_id;
+    END""",
+    'archivo_etiqueta_fts_borrar': f"""AFTER DELETE ON archivo_etiqueta BEGIN
+        UPDATE archivo_fts SET etiquetas = {ETIQUETAS_DE.format('OLD.archivo_id')}
+        WHERE rowid = OLD.archivo_id;
+    END""",
+    'etiqueta_fts_renombrar': f"""AFTER UPDATE OF nombre ON etiqueta BEGIN
+        UPDATE archivo_fts SET etiquetas = {ETIQUETAS_DE.format('archivo_fts.rowid')}
+        WHERE rowid IN (SELECT archivo_id FROM archivo_etiqueta WHERE etiqueta_id = NEW.id);
+    END""",
+}
+
+
+def upgrade():
+    bind = op.get_bind()
+    # Otros motores buscan con ILIKE (ver busqueda.py)
+    if bind.dialect.name != 'sqlite':
+        return
+
+    # El arranque de la app (asegurar_indice) puede haberlo creado ya
+    if 'archivo_fts' not in sa.inspect(bind).get_table_names():
+        op.execute("""CREATE VIRTUAL TABLE archivo_fts USING fts5(
+            nombre, descripcion, tipo, etiquetas,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )""")
+        op.execute(
+            "INSERT INTO archivo_fts(rowid, nombre, descripcion, tipo, etiquetas) "
+            f"SELECT a.id, a.nombre, a.descripcion, a.tipo, {ETIQUETAS_DE.format('a.id')} FROM archivo a"
+        )
+    for nombre, cuerpo in TRIGGERS.items():
+        op.execute(f"CREATE TRIGGER IF NOT EXISTS {nombre} {cuerpo}")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for nombre in TRIGGERS:
+        op.execute(f"DROP TRIGGER IF EXISTS {nombre}")
+    op.execute("DROP TABLE IF EXISTS archivo_fts")
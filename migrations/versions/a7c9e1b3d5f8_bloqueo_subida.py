@@ -0,0 +1,29 @@
+"""bloqueo de escritura de las subidas
+
+Revision ID: a7c9e1b3d5f8
+Revises: f1b3d5e7a9c2
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c9e1b3d5f8'
+down_revision = 'f1b3d5e7a9c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columnas = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('subida')}
+    # db.create_all() puede haber creado ya la columna en instalaciones nuevas
+    if 'bloqueo' not in columnas:
+        with op.batch_alter_table('subida') as batch_op:
+            batch_op.add_column(sa.Column('bloqueo', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('subida') as batch_op:
+        batch_op.drop_column('bloqueo')
@@ -0,0 +1,33 @@
+"""formato de píxel y perfil de vídeo en media_info
+
+Revision ID: b2d4f6a8c0e1
+Revises: a7c9e1b3d5f8
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d4f6a8c0e1'
+down_revision = 'a7c9e1b3d5f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columnas = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('media_info')}
+    # db.create_all() puede haber creado ya las columnas en instalaciones nuevas.
+    # Los vídeos sondeados antes quedan caducados (MediaInfo.caducada) y se vuelven a sondear.
+    with op.batch_alter_table('media_info') as batch_op:
+        if 'formato_pixel' not in columnas:
+            batch_op.add_column(sa.Column('formato_pixel', sa.String(length=32), nullable=True))
+        if 'perfil_video' not in columnas:
+            batch_op.add_column(sa.Column('perfil_video', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('media_info') as batch_op:
+        batch_op.drop_column('perfil_video')
+        batch_op.drop_column('formato_pixel')
@@ -0,0 +1,36 @@
+"""tabla cambio_etiquetas
+
+Revision ID: b8d0f2a4c6e9
+Revises: a3c5e7f9b214
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d0f2a4c6e9'
+down_revision = 'a3c5e7f9b214'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() puede haber creado ya la tabla en instalaciones nuevas
+    if 'cambio_etiquetas' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'cambio_etiquetas',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('archivo_id', sa.Integer(), nullable=False),
+        sa.Column('fecha', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sqlite_autoincrement=True,
+    )
+    op.create_index('ix_cambio_etiquetas_fecha', 'cambio_etiquetas', ['fecha'])
+
+
+def downgrade():
+    op.drop_index('ix_cambio_etiquetas_fecha', table_name='cambio_etiquetas')
+    op.drop_table('cambio_etiquetas')
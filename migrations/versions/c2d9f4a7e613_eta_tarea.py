@@ -0,0 +1,29 @@
+"""columna eta en tarea
+
+Revision ID: c2d9f4a7e613
+Revises: 8a4e0c6b2d51
+Create Date: 2026-10-17 13:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d9f4a7e613'
+down_revision = '8a4e0c6b2d51'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columnas = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('tarea')}
+    # db.create_all() puede haber creado ya la columna en instalaciones nuevas
+    if 'eta' not in columnas:
+        with op.batch_alter_table('tarea') as batch_op:
+            batch_op.add_column(sa.Column('eta', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('tarea') as batch_op:
+        batch_op.drop_column('eta')
@@ -0,0 +1,80 @@
+"""índices de listados, /media y tablas de relación; sin duplicados en favoritos y playlists
+
+Revision ID: c4e6a8b0d2f5
+Revises: b8d0f2a4c6e9
+Create Date: 2026-10-17 19:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e6a8b0d2f5'
+down_revision = 'b8d0f2a4c6e9'
+branch_labels = None
+depends_on = None
+
+VISIBLES = 'fecha_eliminado IS NULL'
+EN_PAPELERA = 'fecha_eliminado IS NOT NULL'
+
+# (nombre, tabla, columnas, único, condición del índice parcial)
+INDICES = [
+    ('ix_archivo_nombre', 'archivo', ['nombre'], False, None),
+    ('ix_archivo_privado_fecha', 'archivo', ['es_privado', 'fecha_subida'], False, None),
+    ('ix_archivo_privado_tamano', 'archivo', ['es_privado', 'tamaño'], False, None),
+    ('ix_archivo_visibles_fecha', 'archivo', ['fecha_subida'], False, VISIBLES),
+    ('ix_archivo_papelera', 'archivo', ['fecha_eliminado'], False, EN_PAPELERA),
+    ('ix_archivo_etiqueta_etiqueta', 'archivo_etiqueta', ['etiqueta_id', 'archivo_id'], False, None),
+    ('uq_favoritos_usuario_archivo', 'favoritos', ['usuario_id', 'archivo_id'], True, None),
+    ('ix_favoritos_archivo', 'favoritos', ['archivo_id'], False, None),
+    ('uq_playlist_archivo_playlist_archivo', 'playlist_archivo', ['playlist_id', 'archivo_id'], True, None),
+    ('ix_playlist_archivo_archivo', 'playlist_archivo', ['archivo_id'], False, None),
+    ('ix_playlist_usuario_id', 'playlist', ['usuario_id'], False, None),
+]
+
+
+def _quitar_duplicados(tabla, columnas):
+    # Las tablas de relación no tienen clave primaria ni más columnas que la pareja:
+    # las filas repetidas son idénticas, así que se borran todas y se vuelve a poner una.
+    # Sin rowid ni ctid, que no existen (o no sirven de identidad) en todos los motores.
+    conexion = op.get_bind()
+    relacion = sa.table(tabla, *(sa.column(columna) for columna in columnas))
+    claves = [relacion.c[columna] for columna in columnas]
+    repetidas = conexion.execute(
+        sa.select(*claves).group_by(*claves).having(sa.func.count() > 1)
+    ).all()
+    for pareja in repetidas:
+        if None in pareja:
+            continue  # El índice único admite varios NULL
+        valores = dict(zip(columnas, pareja))
+        conexion.execute(relacion.delete().where(*(relacion.c[c] == v for c, v in valores.items())))
+        conexion.execute(relacion.insert().values(**valores))
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existentes = {
+        tabla: {i['name'] for i in inspector.get_indexes(tabla)}
+        for tabla in {indice[1] for indice in INDICES}
+    }
+
+    # db.create_all() puede haber creado ya los índices en instalaciones nuevas
+    for nombre, tabla, columnas, unico, condicion in INDICES:
+        if nombre in existentes[tabla]:
+            continue
+        if unico:
+            _quitar_duplicados(tabla, columnas)
+        parcial = {}
+        if condicion:
+            parcial = {'sqlite_where': sa.text(condicion), 'postgresql_where': sa.text(condicion)}
+        op.create_index(nombre, tabla, columnas, unique=unico, **parcial)
+
+    # Estadísticas para que el planificador de SQLite elija bien entre índices
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('ANALYZE')
+
+
+def downgrade():
+    for nombre, tabla, _, _, _ in reversed(INDICES):
+        op.drop_index(nombre, table_name=tabla)
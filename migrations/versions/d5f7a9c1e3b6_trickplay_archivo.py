@@ -0,0 +1,30 @@
+"""hojas de trickplay de los vídeos
+
+Revision ID: d5f7a9c1e3b6
+Revises: c4e6a8b0d2f5
+Create Date: 2026-10-17 20:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5f7a9c1e3b6'
+down_revision = 'c4e6a8b0d2f5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columnas = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('archivo')}
+    # db.create_all() puede haber creado ya la columna en instalaciones nuevas
+    if 'trickplay' not in columnas:
+        with op.batch_alter_table('archivo') as batch_op:
+            batch_op.add_column(sa.Column('trickplay', sa.String(length=64), nullable=True))
+    # Los vídeos existentes se rellenan con `flask tareas trickplay`
+
+
+def downgrade():
+    with op.batch_alter_table('archivo') as batch_op:
+        batch_op.drop_column('trickplay')
@@ -0,0 +1,57 @@
+"""rutas relativas a STORAGE_ROOT y mtime en archivo
+
+Revision ID: e4a8b2c6d017
+Revises: 5b7e1d3f9a24
+Create Date: 2026-10-17 15:30:00.000000
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a8b2c6d017'
+down_revision = '5b7e1d3f9a24'
+branch_labels = None
+depends_on = None
+
+
+archivo = sa.table(
+    'archivo',
+    sa.column('id', sa.Integer),
+    sa.column('ruta', sa.Text),
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+    columnas = {c['name'] for c in sa.inspect(bind).get_columns('archivo')}
+    # db.create_all() puede haber creado ya la columna en instalaciones nuevas
+    if 'mtime' not in columnas:
+        with op.batch_alter_table('archivo') as batch_op:
+            batch_op.add_column(sa.Column('mtime', sa.Float(), nullable=True))
+
+    # Las rutas absolutas que cuelgan de STORAGE_ROOT pasan a guardarse relativas
+    raiz = os.path.abspath(current_app.config['STORAGE_ROOT'])
+    for fila in bind.execute(sa.select(archivo.c.id, archivo.c.ruta)).fetchall():
+        if not fila.ruta or not os.path.isabs(fila.ruta):
+            continue
+        ruta = os.path.abspath(fila.ruta)
+        if os.path.commonpath([raiz, ruta]) == raiz:
+            relativa = os.path.relpath(ruta, raiz).replace(os.sep, '/')
+            bind.execute(archivo.update().where(archivo.c.id == fila.id).values(ruta=relativa))
+
+
+def downgrade():
+    bind = op.get_bind()
+    raiz = current_app.config['STORAGE_ROOT']
+    for fila in bind.execute(sa.select(archivo.c.id, archivo.c.ruta)).fetchall():
+        if fila.ruta and not os.path.isabs(fila.ruta):
+            absoluta = os.path.normpath(os.path.join(raiz, *fila.ruta.split('/')))
+            bind.execute(archivo.update().where(archivo.c.id == fila.id).values(ruta=absoluta))
+
+    with op.batch_alter_table('archivo') as batch_op:
+        batch_op.drop_column('mtime')
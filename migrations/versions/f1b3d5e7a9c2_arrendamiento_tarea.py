@@ -0,0 +1,32 @@
+"""arrendamiento de las tareas en curso
+
+Revision ID: f1b3d5e7a9c2
+Revises: d5f7a9c1e3b6
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b3d5e7a9c2'
+down_revision = 'd5f7a9c1e3b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columnas = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('tarea')}
+    # db.create_all() puede haber creado ya las columnas en instalaciones nuevas
+    with op.batch_alter_table('tarea') as batch_op:
+        if 'despachador' not in columnas:
+            batch_op.add_column(sa.Column('despachador', sa.String(length=32), nullable=True))
+        if 'vence_en' not in columnas:
+            batch_op.add_column(sa.Column('vence_en', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('tarea') as batch_op:
+        batch_op.drop_column('vence_en')
+        batch_op.drop_column('despachador')
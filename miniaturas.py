@@ -0,0 +1,469 @@
+"""Miniaturas en varias medidas, guardadas por hash de contenido.
+
+Cada archivo tiene una miniatura por medida de MINIATURAS_MEDIDAS en
+MINIATURAS_FOLDER/<ab>/<hash>_<medida>.<ext>, donde <ab> son los dos
+primeros caracteres del hash. La columna `Archivo.miniatura` guarda
+"<hash>.<ext>": los duplicados comparten las mismas miniaturas sin copiarlas
+y un fichero modificado (hash nuevo) no pisa las de su versión anterior.
+
+Las filas antiguas pueden tener aún un `thumb_<nombre>` junto al original;
+`url_miniatura` resuelve los dos casos y es la única forma de obtener la URL
+de una miniatura, tanto en las plantillas como en la API.
+
+`flask thumbs rebuild` (y su equivalente en segundo plano desde /admin)
+regenera en bloque las que faltan, las de ficheros cambiados o todas.
+
+Las imágenes se decodifican ya reducidas: en JPEG, `draft()` pide al
+decodificador la escala 1/2, 1/4 o 1/8 más pequeña que sigue cubriendo la
+medida mayor, y en el resto `reduce()` hace el grueso de la reducción por
+bloques antes del filtro LANCZOS. Cada medida se saca de la anterior.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import json
+import math
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import time
+import uuid
+
+from flask import current_app, session, url_for
+from pdf2image import convert_from_path
+from PIL import ExifTags, Image, ImageOps, ImageStat
+from sqlalchemy import bindparam
+
+from hashes import calcular_hash
+from utils import duracion_media
+
+PREFIJO_LEGADO = 'thumb_'
+EXTENSIONES = {'webp': '.webp', 'jpeg': '.jpg'}
+CALIDAD = {'webp': 80, 'jpeg': 85}
+
+# Fotogramas candidatos a póster de un vídeo, como fracción de su duración; sin
+# duración conocida se prueba en SEGUNDO_VIDEO. Gana el de mejor `_puntuacion`.
+CANDIDATOS_VIDEO = (0.1, 0.25, 0.5)
+SEGUNDO_VIDEO = 3
+
+def es_legado(miniatura):
+    """True si `miniatura` es un thumb_ antiguo, guardado junto al original."""
+    return bool(miniatura) and miniatura.startswith(PREFIJO_LEGADO)
+
+
+def ruta_miniatura(miniatura, medida, carpeta=None):
+    """Ruta física de una medida de una miniatura "<hash>.<ext>"."""
+    clave, extension = os.path.splitext(miniatura)
+    carpeta = carpeta or current_app.config['MINIATURAS_FOLDER']
+    return os.path.join(carpeta, clave[:2], f"{clave}_{medida}{extension}")
+
+
+def url_miniatura(archivo, medida=None):
+    """URL de la miniatura de `archivo`, o None si no tiene o el usuario no puede verla."""
+    if not archivo.miniatura:
+        return None
+    if archivo.es_privado and not session.get('acceso_privado'):
+        return None
+    if es_legado(archivo.miniatura):
+        return url_for('media', nombre=archivo.miniatura)
+    medida = medida or current_app.config['MINIATURAS_MEDIDA_POR_DEFECTO']
+    # El hash en la URL invalida la caché del navegador si la miniatura cambia
+    return url_for('miniatura', id=archivo.id, medida=medida, v=archivo.miniatura[:8])
+
+
+def srcset_miniatura(archivo):
+    """Atributo srcset con todas las medidas, o None."""
+    if not archivo.miniatura or es_legado(archivo.miniatura):
+        return None
+    if archivo.es_privado and not session.get('acceso_privado'):
+        return None
+    medidas = current_app.config['MINIATURAS_MEDIDAS']
+    return ', '.join(f"{url_miniatura(archivo, medida)} {lado}w" for medida, lado in medidas.items())
+
+
+def parametros_generacion():
+    """(carpeta, medidas, formato) de la configuración, para pasarlos a un proceso hijo."""
+    config = current_app.config
+    return config['MINIATURAS_FOLDER'], dict(config['MINIATURAS_MEDIDAS']), config['MINIATURAS_FORMATO']
+
+
+# --- Generación (sin contexto de Flask: corre en los procesos hijo) -----------
+
+def _escala(tamano, caja):
+    """Factor que encaja `tamano` en `caja` (ancho, alto); None en la caja es sin límite."""
+    return min(limite / lado for limite, lado in zip(caja, tamano) if limite is not None)
+
+
+def _abrir_imagen(ruta, caja):
+    """Abre una imagen decodificándola a la menor resolución que cubra `caja`."""
+    imagen = Image.open(ruta)
+    if imagen.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+        # Se girará 90°: la caja se compara con la imagen tal y como está guardada
+        caja = caja[::-1]
+    ancho, alto = imagen.size
+    escala = _escala(imagen.size, caja)
+    if escala < 1:
+        # Solo hace algo en JPEG (y el decodificador lo aplica al cargar)
+        imagen.draft('RGB', (math.ceil(ancho * escala), math.ceil(alto * escala)))
+    imagen.load()
+    return imagen
+
+
+def _extraer_fotograma(ruta, instante, lado, destino):
+    """Primer fotograma clave desde `instante` (None: el primero del vídeo), reducido a `lado`."""
+    # -ss antes de -i: el demuxer salta al fotograma clave y solo se decodifican
+    # fotogramas clave, en vez de todo el vídeo hasta el instante pedido
+    busqueda = ['-skip_frame', 'nokey', '-noaccurate_seek', '-ss', f"{instante:.3f}"] if instante else []
+    subprocess.run(
+        ['ffmpeg', '-y', '-loglevel', 'error', *busqueda, '-i', ruta, '-an', '-sn', '-dn',
+         '-frames:v', '1', '-vf', f"scale='min({lado},iw)':-2", destino],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return os.path.exists(destino)
+
+
+def _puntuacion(imagen):
+    """Lo interesante que parece un fotograma: entropía, castigando los casi negros o blancos."""
+    muestra = imagen.convert('L')
+    muestra.thumbnail((64, 64))
+    brillo = ImageStat.Stat(muestra).mean[0]
+    # Fundidos, claquetas y pantallas en blanco tienen poca entropía o un brillo extremo
+    return muestra.entropy() * (1 if 24 <= brillo <= 232 else 0.25)
+
+
+def fotograma_representativo(ruta, lado, carpeta_temporal, duracion=None):
+    """Póster de un vídeo: el mejor de varios fotogramas clave repartidos por su duración."""
+    duracion = duracion or duracion_media(ruta)
+    instantes = [duracion * fraccion for fraccion in CANDIDATOS_VIDEO] if duracion else [SEGUNDO_VIDEO]
+    mejor, mejor_puntuacion = None, None
+    for indice, instante in enumerate(instantes):
+        destino = os.path.join(carpeta_temporal, f"fotograma_{indice}.png")
+        if not _extraer_fotograma(ruta, instante, lado, destino):
+            continue  # Pasado el último fotograma clave
+        with Image.open(destino) as candidato:
+            puntuacion = _puntuacion(candidato)
+        if mejor is None or puntuacion > mejor_puntuacion:
+            mejor, mejor_puntuacion = destino, puntuacion
+    if mejor is None:
+        # Vídeos muy cortos o con un único fotograma clave: el primero
+        mejor = os.path.join(carpeta_temporal, 'fotograma.png')
+        if not _extraer_fotograma(ruta, None, lado, mejor):
+            raise RuntimeError("ffmpeg no pudo extraer ningún fotograma")
+    return Image.open(mejor)
+
+
+def imagen_base(ruta, tipo_mime, lado, carpeta_temporal, duracion=None):
+    """Imagen de partida de la miniatura, ya reducida cerca de `lado`."""
+    tipo_mime = tipo_mime or ''
+    if tipo_mime == 'application/pdf':
+        paginas = convert_from_path(ruta, first_page=1, last_page=1, size=(lado, None))
+        if not paginas:
+            raise RuntimeError("El PDF no tiene páginas")
+        return paginas[0]
+    if tipo_mime.startswith('video/'):
+        return fotograma_representativo(ruta, lado, carpeta_temporal, duracion)
+    return _abrir_imagen(ruta, (lado, lado))
+
+
+def _normalizar(imagen, formato):
+    """Orientación EXIF aplicada y un modo que el formato de salida acepte."""
+    imagen = ImageOps.exif_transpose(imagen)
+    transparente = imagen.mode in ('RGBA', 'LA') or (imagen.mode == 'P' and 'transparency' in imagen.info)
+    if formato == 'webp' and transparente:
+        return imagen.convert('RGBA')
+    if imagen.mode != 'RGB':
+        return imagen.convert('RGB')
+    return imagen
+
+
+def _reducir(imagen, caja):
+    """Copia de `imagen` encajada en `caja` (ancho, alto), sin ampliarla."""
+    escala = _escala(imagen.size, caja)
+    if escala >= 1:
+        return imagen
+    # reduce() por bloques hasta ~2x el destino; LANCZOS termina el trabajo con buena calidad
+    factor = int(1 / escala) // 2
+    if factor >= 2:
+        imagen = imagen.reduce(factor)
+        escala = _escala(imagen.size, caja)
+    ancho, alto = imagen.size
+    destino = (max(1, round(ancho * escala)), max(1, round(alto * escala)))
+    return imagen.resize(destino, Image.Resampling.LANCZOS)
+
+
+def _guardar(imagen, ruta, formato):
+    # Escritura atómica: un lector nunca ve una miniatura a medias
+    temporal = os.path.join(os.path.dirname(ruta), f".{uuid.uuid4().hex}.tmp")
+    try:
+        if formato == 'webp':
+            imagen.save(temporal, 'WEBP', quality=CALIDAD['webp'], method=4)
+        else:
+            imagen.save(temporal, 'JPEG', quality=CALIDAD['jpeg'], optimize=True, progressive=True)
+        os.replace(temporal, ruta)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+
+def generar_miniaturas(ruta, tipo_mime, clave, carpeta, medidas, formato, duracion=None):
+    """Escribe todas las medidas de la miniatura de `ruta` y devuelve su nombre "<clave>.<ext>".
+
+    `duracion` (segundos, solo vídeos) ahorra un ffprobe si ya se conoce.
+    """
+    miniatura = clave + EXTENSIONES[formato]
+    os.makedirs(os.path.dirname(ruta_miniatura(miniatura, 'x', carpeta)), exist_ok=True)
+    orden = sorted(medidas.items(), key=lambda medida: medida[1], reverse=True)
+
+    with tempfile.TemporaryDirectory() as carpeta_temporal:
+        with imagen_base(ruta, tipo_mime, orden[0][1], carpeta_temporal, duracion) as original:
+            # Sin seek, los GIF/WebP animados se quedan en el primer fotograma
+            imagen = _normalizar(original, formato)
+            for medida, lado in orden:
+                imagen = _reducir(imagen, (lado, lado))
+                _guardar(imagen, ruta_miniatura(miniatura, medida, carpeta), formato)
+    return miniatura
+
+
+def redimensionar(ruta, destino, caja, formato):
+    """Escribe en `destino` la imagen de `ruta` encajada en `caja` (ancho, alto; None sin límite)."""
+    with _abrir_imagen(ruta, caja) as original:
+        imagen = _reducir(_normalizar(original, formato), caja)
+        _guardar(imagen, destino, formato)
+
+
+def generar_lote(trabajos):
+    """generar_miniaturas de varios archivos en un solo proceso hijo.
+
+    `trabajos` es una lista de tuplas con los argumentos de generar_miniaturas
+    (con la clave a None si el archivo aún no tiene hash). Devuelve, en el mismo
+    orden, (miniatura, None) o (None, mensaje de error): un fichero roto no
+    tumba al resto del lote.
+    """
+    resultados = []
+    for ruta, tipo_mime, clave, *resto in trabajos:
+        try:
+            clave = clave or calcular_hash(ruta)
+            if clave is None:
+                raise RuntimeError("No se pudo leer el fichero")
+            resultados.append((generar_miniaturas(ruta, tipo_mime, clave, *resto), None))
+        except Exception as e:
+            resultados.append((None, str(e) or e.__class__.__name__))
+    return resultados
+
+
+# --- Reconstrucción en bloque ---------------------------------------------------
+
+MODOS = ('faltan', 'cambiados', 'todos')
+# Archivos por envío al pool: un lote es siempre de una sola clase, y los
+# vídeos y PDF tardan mucho más por archivo que las imágenes
+LOTES = {'video': 4, 'pdf': 4, 'imagen': 16}
+
+
+def clase_de(tipo_mime):
+    """'imagen', 'video', 'pdf' o None si el tipo no tiene miniatura."""
+    tipo_mime = tipo_mime or ''
+    if tipo_mime == 'application/pdf':
+        return 'pdf'
+    if tipo_mime.startswith('video/'):
+        return 'video'
+    if tipo_mime.startswith('image/'):
+        return 'imagen'
+    return None
+
+
+def _mtime(ruta):
+    try:
+        return os.stat(ruta).st_mtime
+    except (OSError, TypeError):
+        return None
+
+
+def pendientes_miniatura(modo='faltan', hilos=None):
+    """Filas cuya miniatura hay que (re)generar según `modo`, y las que no tienen fichero.
+
+    - 'faltan': sin miniatura, con una thumb_ antigua o con los ficheros borrados.
+    - 'cambiados': además, las de un hash anterior o más viejas que su original.
+    - 'todos': todas.
+    Devuelve (pendientes, sin_fichero); cada pendiente es una fila con id, ruta,
+    mtime (del original), nombre, tipo, hash_archivo, miniatura y duracion (de media_info, si vale).
+    """
+    # Import tardío: los procesos hijo importan este módulo y no necesitan los modelos
+    from models import db, Archivo, MediaInfo, ruta_absoluta
+
+    if modo not in MODOS:
+        raise ValueError(f"Modo no admitido: {modo} (usa {', '.join(MODOS)})")
+    medida = current_app.config['MINIATURAS_MEDIDA_POR_DEFECTO']
+    filas = db.session.execute(
+        db.select(Archivo.id, Archivo.ruta_guardada, Archivo.nombre, Archivo.tipo, Archivo.hash_archivo,
+                  Archivo.miniatura, MediaInfo.duracion, MediaInfo.hash_archivo.label('hash_info'))
+        .outerjoin(MediaInfo, MediaInfo.archivo_id == Archivo.id)
+        .where(Archivo.fecha_eliminado.is_(None))
+        .order_by(Archivo.id)
+    ).all()
+    filas = [fila for fila in filas if clase_de(fila.tipo)]
+
+    carpeta = current_app.config['MINIATURAS_FOLDER']
+    rutas = [
+        (ruta_absoluta(fila.ruta_guardada),
+         ruta_miniatura(fila.miniatura, medida, carpeta) if fila.miniatura and not es_legado(fila.miniatura) else None)
+        for fila in filas
+    ]
+
+    def estado(rutas_fila):
+        ruta, miniatura = rutas_fila
+        return ruta, _mtime(ruta), _mtime(miniatura) if miniatura else None
+
+    # stat en hilos, como en rehashear: en discos de red es lo que más espera
+    with ThreadPoolExecutor(max_workers=hilos or min(32, (os.cpu_count() or 1) * 4)) as pool:
+        estados = list(pool.map(estado, rutas))
+
+    pendientes, sin_fichero = [], []
+    for fila, (ruta, mtime_original, mtime_miniatura) in zip(filas, estados):
+        if mtime_original is None:
+            sin_fichero.append(ruta or f"#{fila.id}")
+            continue
+        if modo == 'todos' or mtime_miniatura is None:
+            necesita = True
+        elif modo == 'cambiados':
+            # Sin hash (aún no calculado) solo cuenta la fecha: la clave sería siempre distinta
+            cambio_hash = fila.hash_archivo is not None and os.path.splitext(fila.miniatura)[0] != fila.hash_archivo
+            necesita = cambio_hash or mtime_original > mtime_miniatura
+        else:
+            necesita = False
+        if necesita:
+            vigente = fila.hash_info is not None and fila.hash_info == fila.hash_archivo
+            pendientes.append({
+                'id': fila.id, 'ruta': ruta, 'mtime': mtime_original, 'nombre': fila.nombre, 'tipo': fila.tipo,
+                'hash_archivo': fila.hash_archivo, 'miniatura': fila.miniatura,
+                'duracion': fila.duracion if vigente else None,
+            })
+    return pendientes, sin_fichero
+
+
+def _leer_punto_control(ruta, modo):
+    """(inicio, ids hechos) del punto de control; uno nuevo si no hay o es de otro modo."""
+    try:
+        with open(ruta, encoding='utf-8') as f:
+            datos = json.load(f)
+    except (OSError, ValueError):
+        datos = {}
+    # Un punto de control de otro modo (o sin fecha de inicio) no sirve: se empieza de cero
+    if datos.get('modo') != modo or not isinstance(datos.get('inicio'), (int, float)):
+        return time.time(), set()
+    return datos['inicio'], set(datos.get('hechos', []))
+
+
+def _guardar_punto_control(ruta, modo, inicio, hechos):
+    temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump({'modo': modo, 'inicio': inicio, 'hechos': sorted(hechos)}, f)
+    os.replace(temporal, ruta)
+
+
+def reconstruir(modo='faltan', procesos=None, lote=200, reiniciar=False, al_progresar=None):
+    """Regenera en paralelo las miniaturas de `pendientes_miniatura(modo)`. Devuelve un resumen.
+
+    Los resultados se guardan cada `lote` archivos, junto con un punto de control
+    (MINIATURAS_PUNTO_CONTROL) con los ids ya hechos y la hora en que empezó la
+    pasada: si se interrumpe, al relanzarlo con el mismo modo no se repiten, salvo
+    los que se hayan modificado desde entonces. `reiniciar` descarta el punto de
+    control. `al_progresar(hechos, total)` se llama tras cada lote del pool.
+    """
+    from models import db, Archivo
+
+    procesos = procesos or os.cpu_count() or 1
+    punto_control = current_app.config['MINIATURAS_PUNTO_CONTROL']
+    if reiniciar and os.path.exists(punto_control):
+        os.remove(punto_control)
+    inicio_pasada, hechos_antes = _leer_punto_control(punto_control, modo)
+
+    pendientes, sin_fichero = pendientes_miniatura(modo)
+    resultado = {
+        'total': len(pendientes), 'reanudados': 0, 'sin_fichero': sin_fichero, 'errores': [],
+        'generadas': {clase: 0 for clase in LOTES}, 'segundos': 0.0,
+    }
+    por_clase = {clase: [] for clase in LOTES}
+    unicos = {}
+    for pendiente in pendientes:
+        if pendiente['id'] in hechos_antes:
+            if pendiente['mtime'] < inicio_pasada:
+                resultado['reanudados'] += 1
+                continue
+            # Modificado después de empezar la pasada: su miniatura puede ser de la versión anterior
+            hechos_antes.discard(pendiente['id'])
+        # Los duplicados comparten miniatura: se genera una vez por hash
+        clave = pendiente['hash_archivo'] or f"#{pendiente['id']}"
+        if clave in unicos:
+            unicos[clave]['copias'].append(pendiente)
+            continue
+        unicos[clave] = dict(pendiente, copias=[])
+        por_clase[clase_de(pendiente['tipo'])].append(unicos[clave])
+
+    carpeta, medidas, formato = parametros_generacion()
+    lotes = []
+    # Las clases lentas primero: el último proceso no se queda solo con los vídeos
+    for clase in ('video', 'pdf', 'imagen'):
+        grupo = por_clase[clase]
+        for inicio in range(0, len(grupo), LOTES[clase]):
+            lotes.append((clase, grupo[inicio:inicio + LOTES[clase]]))
+
+    tabla = Archivo.__table__
+    actualizar = (
+        tabla.update()
+        .where(tabla.c.id == bindparam('b_id'))
+        .values(miniatura=bindparam('b_miniatura'))
+    )
+    hechos = set(hechos_antes)
+    por_guardar = []
+
+    def guardar():
+        if por_guardar:
+            db.session.execute(actualizar, por_guardar)
+            db.session.commit()
+            por_guardar.clear()
+        _guardar_punto_control(punto_control, modo, inicio_pasada, hechos)
+
+    inicio = time.monotonic()
+    total = len(pendientes) - resultado['reanudados']
+    terminados = 0
+    contexto = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as pool:
+            cola = iter(lotes)
+            en_curso = {}
+            while True:
+                # Ventana acotada: no se encolan de golpe miles de lotes
+                for clase, grupo in cola:
+                    trabajos = [
+                        (p['ruta'], p['tipo'], p['hash_archivo'], carpeta, medidas, formato, p['duracion'])
+                        for p in grupo
+                    ]
+                    en_curso[pool.submit(generar_lote, trabajos)] = (clase, grupo)
+                    if len(en_curso) >= procesos * 2:
+                        break
+                if not en_curso:
+                    break
+                listos, _ = wait(list(en_curso), return_when=FIRST_COMPLETED)
+                for futuro in listos:
+                    clase, grupo = en_curso.pop(futuro)
+                    for unico, (miniatura, error) in zip(grupo, futuro.result()):
+                        filas = [unico, *unico['copias']]
+                        terminados += len(filas)
+                        for fila in filas:
+                            if error:
+                                resultado['errores'].append(f"#{fila['id']} {fila['nombre']}: {error}")
+                                continue
+                            resultado['generadas'][clase] += 1
+                            hechos.add(fila['id'])
+                            por_guardar.append({'b_id': fila['id'], 'b_miniatura': miniatura})
+                    if al_progresar:
+                        al_progresar(terminados, total)
+                if len(por_guardar) >= lote:
+                    guardar()
+    finally:
+        # También al interrumpir: lo ya generado no se repite al relanzar
+        guardar()
+    # Terminado sin interrupciones: la próxima vez se empieza de cero
+    os.remove(punto_control)
+
+    resultado['segundos'] = time.monotonic() - inicio
+    return resultado
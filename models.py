@@ -1,27 +1,55 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from flask_login import UserMixin
 from sqlalchemy.orm import relationship
+import os
 
 db = SQLAlchemy()
 
+def ruta_relativa(ruta):
+    """Ruta tal y como se guarda: relativa a STORAGE_ROOT si cuelga de él, si no absoluta."""
+    if not ruta or not os.path.isabs(ruta):
+        return ruta
+    raiz = os.path.abspath(current_app.config['STORAGE_ROOT'])
+    ruta = os.path.abspath(ruta)
+    try:
+        fuera = os.path.commonpath([raiz, ruta]) != raiz
+    except ValueError:  # Otra unidad en Windows
+        fuera = True
+    if fuera:
+        return ruta
+    # Con '/' para que la BD valga igual en Linux y en Windows
+    return os.path.relpath(ruta, raiz).replace(os.sep, '/')
+
+def ruta_absoluta(ruta):
+    """Inversa de ruta_relativa: resuelve una ruta guardada contra STORAGE_ROOT."""
+    if not ruta or os.path.isabs(ruta):
+        return ruta
+    return os.path.normpath(os.path.join(current_app.config['STORAGE_ROOT'], *ruta.split('/')))
+
 # Relación muchos-a-muchos
 archivo_etiqueta = db.Table('archivo_etiqueta',
     db.Column('archivo_id', db.Integer, db.ForeignKey('archivo.id'), primary_key=True),
-    db.Column('etiqueta_id', db.Integer, db.ForeignKey('etiqueta.id'), primary_key=True)
+    db.Column('etiqueta_id', db.Integer, db.ForeignKey('etiqueta.id'), primary_key=True),
+    db.Index('ix_archivo_etiqueta_etiqueta', 'etiqueta_id', 'archivo_id')  # Archivos de una etiqueta
 )
 
 # Tabla de favoritos
 favoritos = db.Table('favoritos',
     db.Column('usuario_id', db.Integer, db.ForeignKey('usuario.id')),
-    db.Column('archivo_id', db.Integer, db.ForeignKey('archivo.id'))
+    db.Column('archivo_id', db.Integer, db.ForeignKey('archivo.id')),
+    db.Index('uq_favoritos_usuario_archivo', 'usuario_id', 'archivo_id', unique=True),
+    db.Index('ix_favoritos_archivo', 'archivo_id')
 )
 
 # Tabla de playlist
 playlist_archivo = db.Table('playlist_archivo',
     db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id')),
-    db.Column('archivo_id', db.Integer, db.ForeignKey('archivo.id'))
+    db.Column('archivo_id', db.Integer, db.ForeignKey('archivo.id')),
+    db.Index('uq_playlist_archivo_playlist_archivo', 'playlist_id', 'archivo_id', unique=True),
+    db.Index('ix_playlist_archivo_archivo', 'archivo_id')
 )
 
 bloc_compartido = db.Table('bloc_compartido',
@@ -32,17 +60,43 @@ bloc_compartido = db.Table('bloc_compartido',
 # Tabla de archivos
 class Archivo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    nombre = db.Column(db.String(255))
-    ruta = db.Column(db.Text)
+    nombre = db.Column(db.String(255), index=True)  # /media busca por nombre
+    ruta_guardada = db.Column('ruta', db.Text)  # Relativa a STORAGE_ROOT; usar la propiedad `ruta`
     tipo = db.Column(db.String(100))
     tamaño = db.Column(db.BigInteger)
+    mtime = db.Column(db.Float, nullable=True)  # Con tamaño, permite a `flask reconcile` saltar los que no cambian
     fecha_subida = db.Column(db.DateTime, server_default=db.func.now())
     es_privado = db.Column(db.Boolean, default=False)
     descripcion = db.Column(db.Text, nullable=True)
-    hash_archivo = db.Column(db.String(64), nullable=True)
+    hash_archivo = db.Column(db.String(64), nullable=True, index=True)
+    hash_original = db.Column(db.String(64), nullable=True, index=True)  # Hash tal y como se subió, si luego se convirtió
+    algoritmo_hash = db.Column(db.String(16), nullable=True)  # Con qué se calculó hash_archivo (ver hashes.py)
+    miniatura = db.Column(db.String(255), nullable=True)  # Nombre del thumb generado, si existe
+    trickplay = db.Column(db.String(64), nullable=True)  # Clave de las hojas de previsualización (ver trickplay.py)
     fecha_eliminado = db.Column(db.DateTime, nullable=True)  # 🗑️ Si tiene valor, está en papelera
     etiquetas = db.relationship('Etiqueta', secondary=archivo_etiqueta, back_populates='archivos')
 
+    # Listados: visibles (fuera de la papelera) por privacidad y orden; `flask explain` comprueba que se usan
+    __table_args__ = (
+        db.Index('ix_archivo_privado_fecha', 'es_privado', 'fecha_subida'),
+        db.Index('ix_archivo_privado_tamano', 'es_privado', 'tamaño'),
+        db.Index('ix_archivo_visibles_fecha', 'fecha_subida',
+                 sqlite_where=db.text('fecha_eliminado IS NULL'),
+                 postgresql_where=db.text('fecha_eliminado IS NULL')),
+        db.Index('ix_archivo_papelera', 'fecha_eliminado',
+                 sqlite_where=db.text('fecha_eliminado IS NOT NULL'),
+                 postgresql_where=db.text('fecha_eliminado IS NOT NULL')),
+    )
+
+    # Mover la biblioteca entera solo exige cambiar STORAGE_ROOT
+    @property
+    def ruta(self):
+        return ruta_absoluta(self.ruta_guardada)
+
+    @ruta.setter
+    def ruta(self, valor):
+        self.ruta_guardada = ruta_relativa(valor)
+
 # Tabla de etiquetas
 class Etiqueta(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -70,10 +124,121 @@ class Usuario(db.Model, UserMixin):
 class Playlist(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(100), nullable=False)
-    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False, index=True)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     archivos = db.relationship('Archivo', secondary='playlist_archivo', backref='playlists')
 
+# Tabla de tareas en segundo plano (miniaturas, conversiones...)
+class Tarea(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(32), nullable=False)
+    archivo_id = db.Column(db.Integer, db.ForeignKey('archivo.id'), nullable=True)
+    estado = db.Column(db.String(16), nullable=False, default='pendiente')  # pendiente, en_curso, completada, fallida, cancelada
+    parametros = db.Column(db.JSON, nullable=True)
+    progreso = db.Column(db.Float, default=0)
+    eta = db.Column(db.Integer, nullable=True)  # Segundos estimados hasta terminar
+    intentos = db.Column(db.Integer, default=0)
+    max_intentos = db.Column(db.Integer, default=3)
+    error = db.Column(db.Text, nullable=True)
+    disponible_desde = db.Column(db.DateTime, default=datetime.utcnow)  # Espera entre reintentos
+    fecha_creada = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_inicio = db.Column(db.DateTime, nullable=True)
+    fecha_fin = db.Column(db.DateTime, nullable=True)
+    fecha_actualizada = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    despachador = db.Column(db.String(32), nullable=True)  # Despachador que la tiene en curso
+    vence_en = db.Column(db.DateTime, nullable=True)  # Fin de su arrendamiento: pasado, se da por huérfana
+    archivo = relationship('Archivo', backref='tareas')
+
+    __table_args__ = (
+        db.Index('ix_tarea_estado_disponible', 'estado', 'disponible_desde'),
+        db.Index('ix_tarea_archivo', 'archivo_id'),
+    )
+
+# Códecs que los navegadores reproducen en MP4 sin recodificar (MediaInfo.recomendado
+# y las conversiones de tareas.py)
+CODECS_VIDEO_COMPATIBLES = ('h264',)
+CODECS_AUDIO_COMPATIBLES = ('aac', 'mp3')
+# Y solo en 8 bits 4:2:0: High 10, 4:2:2 o 4:4:4 siguen siendo H.264 pero no se reproducen
+FORMATOS_PIXEL_COMPATIBLES = ('yuv420p', 'yuvj420p')
+PERFILES_VIDEO_COMPATIBLES = ('Constrained Baseline', 'Baseline', 'Main', 'High')
+
+def video_compatible(datos):
+    """True si la pista de vídeo de `datos` (de ffprobe) se puede copiar tal cual a un MP4 reproducible."""
+    return (datos.get('video_codec') in CODECS_VIDEO_COMPATIBLES
+            and datos.get('formato_pixel') in FORMATOS_PIXEL_COMPATIBLES
+            and datos.get('perfil_video') in (None, *PERFILES_VIDEO_COMPATIBLES))
+
+# Metadatos de ffprobe por archivo, para no relanzarlo en cada vista
+class MediaInfo(db.Model):
+    __tablename__ = 'media_info'
+    archivo_id = db.Column(db.Integer, db.ForeignKey('archivo.id'), primary_key=True)
+    hash_archivo = db.Column(db.String(64), nullable=True)  # Hash y mtime del fichero sondeado:
+    mtime = db.Column(db.Float, nullable=True)              # si cambian, los datos están caducados
+    formato = db.Column(db.String(100), nullable=True)
+    duracion = db.Column(db.Float, nullable=True)  # Segundos
+    bitrate = db.Column(db.BigInteger, nullable=True)  # bits/s
+    video_codec = db.Column(db.String(32), nullable=True)
+    audio_codec = db.Column(db.String(32), nullable=True)
+    ancho = db.Column(db.Integer, nullable=True)
+    alto = db.Column(db.Integer, nullable=True)
+    formato_pixel = db.Column(db.String(32), nullable=True)  # yuv420p, yuv420p10le...
+    perfil_video = db.Column(db.String(32), nullable=True)  # Main, High, High 10...
+    streams_video = db.Column(db.Integer, default=0)
+    streams_audio = db.Column(db.Integer, default=0)
+    streams_subtitulos = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)  # ffprobe no pudo leer el fichero
+    fecha_sondeo = db.Column(db.DateTime, default=datetime.utcnow)
+    archivo = relationship('Archivo', backref=db.backref('media_info', uselist=False, cascade='all, delete-orphan'))
+
+    @property
+    def recomendado(self):
+        """Reproducible en cualquier navegador sin convertir (H.264 de 8 bits 4:2:0 + AAC/MP3)."""
+        if self.video_codec and not video_compatible({
+            'video_codec': self.video_codec,
+            'formato_pixel': self.formato_pixel,
+            'perfil_video': self.perfil_video,
+        }):
+            return False
+        return self.audio_codec in (None, *CODECS_AUDIO_COMPATIBLES)
+
+    def caducada(self):
+        """True si el fichero ha cambiado (hash o mtime) desde que se sondeó.
+
+        Compara con el mtime guardado en Archivo (lo ponen al día la ingesta,
+        `flask reconcile` y `flask rehash`), sin tocar el disco.
+        """
+        if self.hash_archivo != self.archivo.hash_archivo:
+            return True
+        # Sondeado antes de guardar el formato de píxel: sin él no se sabe si es reproducible
+        if self.video_codec and self.formato_pixel is None and not self.error:
+            return True
+        return self.archivo.mtime is not None and self.archivo.mtime != self.mtime
+
+# Subidas troceadas en curso (/api/uploads)
+class Subida(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 en hex, también nombre del temporal
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    nombre = db.Column(db.String(255), nullable=False)
+    tamaño = db.Column(db.BigInteger, nullable=False)  # Declarado al crearla
+    recibido = db.Column(db.BigInteger, nullable=False, default=0)  # Desplazamiento confirmado
+    es_privado = db.Column(db.Boolean, default=False)
+    opciones = db.Column(db.JSON, nullable=True)  # convertToPdf / convertToAudio
+    estado = db.Column(db.String(16), nullable=False, default='activa')  # activa, escribiendo, finalizando, completada
+    bloqueo = db.Column(db.String(32), nullable=True)  # Petición que está escribiendo un trozo
+    archivo_id = db.Column(db.Integer, db.ForeignKey('archivo.id'), nullable=True)  # Resultado al finalizar
+    rechazada = db.Column(db.Boolean, default=False)  # Duplicado rechazado por la política
+    fecha_creada = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_actualizada = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Archivos cuyas etiquetas, privacidad o papelera han cambiado: cada proceso
+# lo lee para poner al día su índice de etiquetas en memoria (indice_etiquetas.py)
+class CambioEtiquetas(db.Model):
+    __tablename__ = 'cambio_etiquetas'
+    __table_args__ = {'sqlite_autoincrement': True}  # Sin reutilizar ids al purgar
+    id = db.Column(db.Integer, primary_key=True)
+    archivo_id = db.Column(db.Integer, nullable=False)  # Sin FK: también registra los borrados
+    fecha = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 # Tabla de Notas
 class Bloc(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,221 @@
+"""Comprobación de planes de consulta (`flask explain`).
+
+Lanza EXPLAIN QUERY PLAN sobre las consultas más frecuentes de la aplicación
+(listados, /media, etiquetas, favoritos, playlists, papelera, cola de tareas)
+y señala las que recorren una tabla entera u ordenan sin índice. Las de
+/api/files se construyen con las mismas funciones que la API (filtros,
+búsqueda de texto, orden y cursor), así que son las que se sirven; el resto
+son la forma de las consultas de las vistas. Por defecto lo hace contra una
+BD SQLite temporal con datos de ejemplo, para que el resultado no dependa del
+tamaño de la biblioteca real; tras tocar modelos o migraciones debería seguir
+saliendo limpio.
+"""
+from datetime import datetime, timedelta
+import os
+import random
+import re
+import tempfile
+
+from sqlalchemy import create_engine, insert, or_, select, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from busqueda import TABLA as TABLA_FTS, crear_indice, subconsulta_fts
+from models import db, Archivo, Etiqueta, Playlist, Tarea, archivo_etiqueta, favoritos, playlist_archivo
+
+# Volumen de la BD de ejemplo: suficiente para que ANALYZE favorezca los índices
+ARCHIVOS = 5000
+ETIQUETAS = 200
+USUARIOS = 20
+
+_RECORRIDO = re.compile(r'^SCAN (\w+)(?! VIRTUAL TABLE)')
+
+# Ordenan en memoria por necesidad, pero solo un conjunto ya acotado por otro
+# índice: las coincidencias del índice de texto y los favoritos de un usuario
+ORDENAN_POCAS_FILAS = frozenset({
+    'API: búsqueda por relevancia',
+    'API: búsqueda por fecha',
+    'API: favoritos',
+})
+
+
+class _Explicar(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, consulta):
+        self.consulta = consulta
+
+
+@compiles(_Explicar)
+def _compilar_explicar(elemento, compilador, **kw):
+    return 'EXPLAIN QUERY PLAN ' + compilador.process(elemento.consulta, **kw)
+
+
+def consultas_api(conexion):
+    """{nombre: select} de /api/files, construidas con las funciones de api_routes."""
+    # Import tardío: api_routes arrastra la cola de tareas y las subidas
+    from api_routes import DEFAULT_PAGE_SIZE, _count_files, _files_query, _order_files, _sort_column
+
+    fts = conexion.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :tabla"), {'tabla': TABLA_FTS}
+    ).first() is not None
+    texto = 'archivo 12'
+    busqueda = subconsulta_fts(texto) if fts else None
+    recientes = _sort_column('recent', conexion)
+    pagina = DEFAULT_PAGE_SIZE + 1
+
+    def listado(ver_privados=False, search='', busqueda=None, tipo='', solo_favoritos=False):
+        return _files_query(1, ver_privados, search, busqueda, tipo, solo_favoritos)
+
+    publico, favoritos_usuario = listado()
+    con_privados, _ = listado(ver_privados=True)
+    por_tipo, _ = listado(tipo='image')
+    solo_favoritos, _ = listado(ver_privados=True, solo_favoritos=True)
+    buscado, _ = listado(ver_privados=True, search=texto, busqueda=busqueda)
+    consultas = {
+        'API: recientes (público)': _order_files(publico, *recientes).limit(pagina),
+        'API: recientes (con privados)': _order_files(con_privados, *recientes).limit(pagina),
+        'API: recientes, página siguiente': _order_files(
+            publico, *recientes, ('2024-01-01 00:00:00', 100)).limit(pagina),
+        'API: por nombre, página siguiente': _order_files(
+            publico, *_sort_column('name', conexion), ('archivo_100.dat', 100)).limit(pagina),
+        'API: totales de la primera página': _count_files(publico, favoritos_usuario),
+        'API: por tipo': _order_files(por_tipo, *recientes).limit(pagina),
+        'API: favoritos': _order_files(solo_favoritos, *recientes).limit(pagina),
+        'API: búsqueda por fecha': _order_files(buscado, *recientes).limit(pagina),
+    }
+    if busqueda is not None:
+        consultas['API: búsqueda por relevancia'] = _order_files(buscado, busqueda.c.rango, False).limit(pagina)
+    return {nombre: consulta.statement for nombre, consulta in consultas.items()}
+
+
+def consultas_frecuentes(conexion):
+    """{nombre: select} con las consultas de la API y las formas de consulta de las vistas."""
+    visibles = Archivo.fecha_eliminado.is_(None)
+    ids = list(range(1, 61))
+    return {
+        **consultas_api(conexion),
+        '/archivos por peso': select(Archivo).where(Archivo.fecha_eliminado.is_(None), Archivo.es_privado == False)
+            .order_by(Archivo.tamaño.desc()),
+        '/privado/archivos': select(Archivo).where(Archivo.es_privado == True)
+            .order_by(Archivo.fecha_subida.desc()),
+        '/galeria': select(Archivo).where(Archivo.tipo.like('image/%'), Archivo.es_privado == False)
+            .order_by(Archivo.fecha_subida.desc()),
+        '/media por nombre': select(Archivo).where(Archivo.nombre == 'foto.jpg').limit(1),
+        'papelera': select(Archivo).where(Archivo.fecha_eliminado.isnot(None))
+            .order_by(Archivo.fecha_eliminado.desc()),
+        'duplicado por hash': select(Archivo).where(
+                or_(Archivo.hash_archivo == 'abc', Archivo.hash_original == 'abc')).limit(10),
+        'etiqueta por nombre': select(Etiqueta).where(Etiqueta.nombre == 'viaje'),
+        'archivos de una etiqueta': select(archivo_etiqueta.c.archivo_id)
+            .where(archivo_etiqueta.c.etiqueta_id == 1),
+        'etiquetas de una página': select(archivo_etiqueta.c.archivo_id, Etiqueta.nombre)
+            .join(Etiqueta, Etiqueta.id == archivo_etiqueta.c.etiqueta_id)
+            .where(archivo_etiqueta.c.archivo_id.in_(ids)),
+        'favoritos de una página': select(favoritos.c.archivo_id)
+            .where(favoritos.c.usuario_id == 1, favoritos.c.archivo_id.in_(ids)),
+        'favoritos de un usuario': select(Archivo).join(favoritos, favoritos.c.archivo_id == Archivo.id)
+            .where(favoritos.c.usuario_id == 1),
+        'playlists de un usuario': select(Playlist).where(Playlist.usuario_id == 1),
+        'elementos de playlists': select(playlist_archivo.c.playlist_id, Archivo)
+            .join(Archivo, Archivo.id == playlist_archivo.c.archivo_id)
+            .where(playlist_archivo.c.playlist_id.in_([1, 2, 3]), visibles),
+        'tareas por reclamar': select(Tarea).where(
+                Tarea.estado == 'pendiente', Tarea.disponible_desde <= datetime.utcnow())
+            .order_by(Tarea.disponible_desde).limit(4),
+    }
+
+
+def problemas_del_plan(detalles, ordenar_admitido=False):
+    """Motivos por los que un plan no vale: recorridos completos u ordenación en temporal."""
+    problemas = []
+    for detalle in detalles:
+        recorrido = _RECORRIDO.match(detalle)
+        if recorrido and 'INDEX' not in detalle:
+            problemas.append(f"recorre la tabla {recorrido.group(1)} entera")
+        elif 'USE TEMP B-TREE FOR ORDER BY' in detalle and not ordenar_admitido:
+            problemas.append("ordena sin índice")
+    return problemas
+
+
+def explicar(conexion):
+    """[(nombre, detalles del plan, problemas)] de cada consulta frecuente."""
+    resultado = []
+    for nombre, consulta in consultas_frecuentes(conexion).items():
+        # Filas crudas del cursor: las columnas tipadas del SELECT no son las del plan
+        detalles = [fila[-1] for fila in conexion.execute(_Explicar(consulta)).cursor.fetchall()]
+        resultado.append((nombre, detalles, problemas_del_plan(detalles, nombre in ORDENAN_POCAS_FILAS)))
+    return resultado
+
+
+def _sembrar(conexion):
+    """Datos de ejemplo con proporciones parecidas a una biblioteca real."""
+    azar = random.Random(0)
+    inicio = datetime(2020, 1, 1)
+    tipos = ['image/jpeg', 'video/mp4', 'audio/mpeg', 'application/pdf']
+    conexion.execute(insert(db.metadata.tables['usuario']), [
+        {'id': i, 'nombre': f'usuario{i}', 'contraseña_hash': '-'} for i in range(1, USUARIOS + 1)
+    ])
+    conexion.execute(insert(Archivo.__table__), [
+        {
+            'id': i,
+            'nombre': f'archivo_{i}.dat',
+            'ruta': f'DovahCloud/archivo_{i}.dat',
+            'tipo': azar.choice(tipos),
+            'tamaño': azar.randint(1, 10 ** 9),
+            'fecha_subida': inicio + timedelta(minutes=i * 37),
+            'es_privado': azar.random() < 0.2,
+            'hash_archivo': f'{i:032x}',
+            # Solo los convertidos guardan el hash con el que se subieron
+            'hash_original': f'{ARCHIVOS + i:032x}' if i % 10 == 0 else None,
+            'fecha_eliminado': inicio if azar.random() < 0.02 else None,
+        }
+        for i in range(1, ARCHIVOS + 1)
+    ])
+    conexion.execute(insert(Etiqueta.__table__), [
+        {'id': i, 'nombre': f'etiqueta{i}', 'es_privada': i % 10 == 0} for i in range(1, ETIQUETAS + 1)
+    ])
+    conexion.execute(insert(archivo_etiqueta), [
+        {'archivo_id': archivo_id, 'etiqueta_id': etiqueta_id}
+        for archivo_id in range(1, ARCHIVOS + 1)
+        for etiqueta_id in azar.sample(range(1, ETIQUETAS + 1), 3)
+    ])
+    conexion.execute(insert(favoritos), [
+        {'usuario_id': usuario_id, 'archivo_id': archivo_id}
+        for usuario_id in range(1, USUARIOS + 1)
+        for archivo_id in azar.sample(range(1, ARCHIVOS + 1), 50)
+    ])
+    conexion.execute(insert(Playlist.__table__), [
+        {'id': i, 'nombre': f'lista{i}', 'usuario_id': i % USUARIOS + 1} for i in range(1, 41)
+    ])
+    conexion.execute(insert(playlist_archivo), [
+        {'playlist_id': playlist_id, 'archivo_id': archivo_id}
+        for playlist_id in range(1, 41)
+        for archivo_id in azar.sample(range(1, ARCHIVOS + 1), 25)
+    ])
+    conexion.execute(insert(Tarea.__table__), [
+        {'tipo': 'miniatura', 'archivo_id': i, 'estado': 'completada' if i % 50 else 'pendiente',
+         'disponible_desde': inicio, 'fecha_creada': inicio}
+        for i in range(1, ARCHIVOS + 1)
+    ])
+    try:
+        crear_indice(conexion)
+    except Exception as e:  # SQLite sin FTS5: la API busca con ILIKE, como en producción
+        print(f"⚠️ BD de ejemplo sin índice de texto completo: {e}")
+    conexion.exec_driver_sql('ANALYZE')
+
+
+def explicar_con_datos_de_ejemplo():
+    """Igual que `explicar`, sobre una BD SQLite temporal creada desde los modelos."""
+    descriptor, ruta = tempfile.mkstemp(suffix='.db')
+    os.close(descriptor)
+    motor = create_engine(f'sqlite:///{ruta}')
+    try:
+        db.metadata.create_all(motor)
+        with motor.begin() as conexion:
+            _sembrar(conexion)
+        with motor.connect() as conexion:
+            return explicar(conexion)
+    finally:
+        motor.dispose()
+        os.remove(ruta)
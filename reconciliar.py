@@ -0,0 +1,239 @@
+"""Reconciliación incremental entre la tabla `archivo` y las carpetas de subida.
+
+Escanea las dos carpetas en paralelo y compara cada fichero con su fila usando
+tamaño + mtime, así que los que no han cambiado no se vuelven a leer. Detecta:
+  - ficheros en disco sin fila (huérfanos) y miniaturas que nadie usa, tanto
+    las thumb_ antiguas como las de MINIATURAS_FOLDER
+  - filas cuyo fichero ya no existe
+  - ficheros modificados desde la última vez
+  - derivados que faltan: miniatura y metadatos de ffprobe (media_info)
+Sin `arreglar` solo informa. Con él importa los huérfanos, manda a la papelera
+las filas sin fichero, borra las miniaturas huérfanas, actualiza los
+modificados y encola los derivados que falten.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import mimetypes
+import os
+
+from sqlalchemy.orm import joinedload
+
+from miniaturas import es_legado
+from models import db, Archivo, ruta_relativa
+from tareas import admite_miniatura, admite_sondeo, encolar_miniatura, encolar_sondeo, tarea_activa
+from hashes import algoritmo_actual, calcular_hash
+
+
+def escanear_carpeta(carpeta):
+    """{ruta: (tamaño, mtime)} de los ficheros del primer nivel de la carpeta."""
+    ficheros = {}
+    try:
+        with os.scandir(carpeta) as entradas:
+            for entrada in entradas:
+                if entrada.is_file():
+                    datos = entrada.stat()
+                    ficheros[os.path.normpath(entrada.path)] = (datos.st_size, datos.st_mtime)
+    except FileNotFoundError:
+        pass
+    return ficheros
+
+
+def escanear_miniaturas(carpeta):
+    """{nombre: ruta} de las miniaturas de MINIATURAS_FOLDER (un nivel de subcarpetas)."""
+    miniaturas = {}
+    try:
+        with os.scandir(carpeta) as subcarpetas:
+            for subcarpeta in subcarpetas:
+                if subcarpeta.is_dir():
+                    with os.scandir(subcarpeta.path) as entradas:
+                        for entrada in entradas:
+                            # Los .tmp son escrituras en curso
+                            if entrada.is_file() and not entrada.name.startswith('.'):
+                                miniaturas[entrada.name] = entrada.path
+    except FileNotFoundError:
+        pass
+    return miniaturas
+
+
+def _nombres_miniatura(miniatura, medidas):
+    """Nombres de fichero de todas las medidas de una miniatura "<hash>.<ext>"."""
+    clave, extension = os.path.splitext(miniatura)
+    return [f"{clave}_{medida}{extension}" for medida in medidas]
+
+
+def _es_derivado(nombre):
+    # Miniaturas y temporales (.parcial_ de las conversiones) no son archivos de la biblioteca
+    return nombre.startswith(('thumb_', '.'))
+
+
+def _miniatura_de_fichero(ruta_thumb, en_disco):
+    """True si la miniatura corresponde a un fichero que sigue en la misma carpeta.
+
+    Cubre miniaturas generadas por el antiguo /regenerar_thumbs_fisico que no quedaron
+    registradas en la columna `miniatura`.
+    """
+    carpeta, nombre = os.path.split(ruta_thumb)
+    original = nombre[len('thumb_'):]
+    candidatos = {original}
+    if original.endswith('.jpg'):
+        candidatos.add(original[:-len('.jpg')])
+    return any(os.path.join(carpeta, candidato) in en_disco for candidato in candidatos)
+
+
+def _reubicar(archivo, raices_anteriores, en_disco):
+    """Traduce una ruta absoluta bajo una raíz anterior a la raíz actual."""
+    guardada = archivo.ruta_guardada
+    if not guardada or not os.path.isabs(guardada):
+        return False
+    for raiz in raices_anteriores:
+        raiz = os.path.abspath(raiz)
+        if os.path.commonpath([raiz, os.path.abspath(guardada)]) != raiz:
+            continue
+        relativa = os.path.relpath(guardada, raiz).replace(os.sep, '/')
+        archivo.ruta_guardada = relativa
+        if os.path.normpath(archivo.ruta) in en_disco:
+            return True
+        archivo.ruta_guardada = guardada
+    return False
+
+
+def reconciliar(app, arreglar=False, raices_anteriores=(), hilos=None):
+    """Compara BD y disco. Devuelve un informe {categoría: [rutas]} y el nº sin cambios."""
+    carpetas = {
+        app.config['UPLOAD_FOLDER']: False,
+        app.config['PRIVATE_UPLOAD_FOLDER']: True,
+    }
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        escaneos = dict(zip(carpetas, pool.map(escanear_carpeta, carpetas)))
+        miniaturas_en_disco = escanear_miniaturas(app.config['MINIATURAS_FOLDER'])
+    medidas = app.config['MINIATURAS_MEDIDAS']
+    en_disco = {}
+    privados = set()
+    for carpeta, ficheros in escaneos.items():
+        en_disco.update(ficheros)
+        if carpetas[carpeta]:
+            privados.update(ficheros)
+
+    informe = {
+        'reubicados': [],
+        'modificados': [],
+        'sin_fichero': [],
+        'huerfanos': [],
+        'miniaturas_huerfanas': [],
+        'sin_miniatura': [],
+        'sin_media_info': [],
+    }
+    sin_cambios = 0
+    vistos = set()
+    miniaturas_usadas = set()
+    claves_usadas = set()  # Hashes con miniaturas en MINIATURAS_FOLDER (o a punto de tenerlas)
+    por_hashear = []
+
+    archivos = Archivo.query.options(joinedload(Archivo.media_info)).all()
+    for archivo in archivos:
+        if archivo.hash_archivo:
+            claves_usadas.add(archivo.hash_archivo)
+        if raices_anteriores and _reubicar(archivo, raices_anteriores, en_disco):
+            informe['reubicados'].append(archivo.ruta)
+        elif archivo.ruta_guardada and archivo.ruta_guardada != ruta_relativa(archivo.ruta_guardada):
+            # Fila antigua con ruta absoluta dentro de STORAGE_ROOT
+            archivo.ruta = archivo.ruta_guardada
+
+        ruta = os.path.normpath(archivo.ruta) if archivo.ruta else None
+        datos = en_disco.get(ruta)
+        if datos is None and ruta and os.path.isfile(ruta):
+            # Fuera de las carpetas de subida (p. ej. rutas absolutas antiguas)
+            estado = os.stat(ruta)
+            datos = (estado.st_size, estado.st_mtime)
+        if datos is None:
+            if archivo.fecha_eliminado is None:
+                informe['sin_fichero'].append(archivo.ruta or f"#{archivo.id} {archivo.nombre}")
+                if arreglar:
+                    archivo.fecha_eliminado = datetime.utcnow()
+            continue
+        vistos.add(ruta)
+
+        tamaño, mtime = datos
+        carpeta = os.path.dirname(ruta)
+        modificado = archivo.tamaño != tamaño or (archivo.mtime is not None and archivo.mtime != mtime)
+        if modificado:
+            informe['modificados'].append(ruta)
+            if arreglar:
+                archivo.tamaño = tamaño
+                por_hashear.append(archivo)
+        else:
+            sin_cambios += 1
+        if arreglar:
+            archivo.mtime = mtime
+
+        miniatura = archivo.miniatura
+        if not miniatura:
+            falta_miniatura = True
+        elif es_legado(miniatura):
+            miniaturas_usadas.add(os.path.join(carpeta, miniatura))
+            falta_miniatura = os.path.join(carpeta, miniatura) not in en_disco
+        else:
+            claves_usadas.add(os.path.splitext(miniatura)[0])
+            falta_miniatura = any(
+                nombre not in miniaturas_en_disco for nombre in _nombres_miniatura(miniatura, medidas)
+            )
+        if admite_miniatura(archivo.tipo) and (modificado or falta_miniatura):
+            informe['sin_miniatura'].append(ruta)
+            if arreglar and tarea_activa(archivo, 'miniatura') is None:
+                encolar_miniatura(archivo)
+
+        info = archivo.media_info
+        if admite_sondeo(archivo.tipo) and (
+            modificado or info is None or info.mtime != mtime or info.hash_archivo != archivo.hash_archivo
+        ):
+            informe['sin_media_info'].append(ruta)
+            if arreglar:
+                encolar_sondeo(archivo)
+
+    for ruta, (tamaño, mtime) in sorted(en_disco.items()):
+        if ruta in vistos:
+            continue
+        nombre = os.path.basename(ruta)
+        if nombre.startswith('thumb_'):
+            if ruta not in miniaturas_usadas and not _miniatura_de_fichero(ruta, en_disco):
+                informe['miniaturas_huerfanas'].append(ruta)
+                if arreglar:
+                    os.remove(ruta)
+            continue
+        if _es_derivado(nombre):
+            continue
+
+        informe['huerfanos'].append(ruta)
+        if arreglar:
+            nuevo = Archivo(
+                nombre=nombre,
+                ruta=ruta,
+                tipo=mimetypes.guess_type(ruta)[0] or 'application/octet-stream',
+                tamaño=tamaño,
+                mtime=mtime,
+                es_privado=ruta in privados,
+                fecha_subida=datetime.utcnow(),
+            )
+            db.session.add(nuevo)
+            encolar_miniatura(nuevo)
+            encolar_sondeo(nuevo)
+            por_hashear.append(nuevo)
+
+    for nombre, ruta in sorted(miniaturas_en_disco.items()):
+        if nombre.rpartition('_')[0] not in claves_usadas:
+            informe['miniaturas_huerfanas'].append(ruta)
+            if arreglar:
+                os.remove(ruta)
+
+    if arreglar:
+        # hashlib suelta el GIL: con hilos se leen varios ficheros a la vez
+        rutas = [archivo.ruta for archivo in por_hashear]
+        algoritmo = algoritmo_actual()
+        with ThreadPoolExecutor(max_workers=hilos) as pool:
+            for archivo, resumen in zip(por_hashear, pool.map(calcular_hash, rutas, [algoritmo] * len(rutas))):
+                archivo.hash_archivo = resumen
+                archivo.algoritmo_hash = algoritmo
+        db.session.commit()
+
+    return informe, sin_cambios
+
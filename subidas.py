@@ -0,0 +1,231 @@
+"""Subidas troceadas y reanudables, al estilo del protocolo tus.
+
+El cliente crea la subida con su tamaño total, envía trozos con PATCH indicando
+el desplazamiento (y opcionalmente su checksum) y la finaliza cuando ha llegado
+todo. Tras un corte, consulta el desplazamiento confirmado y sigue desde ahí.
+Los bytes se escriben directamente en su sitio dentro de un temporal en
+SUBIDAS_FOLDER, sin pasar por el spool de Werkzeug.
+
+Mientras un PATCH escribe, la subida está en 'escribiendo' con su `bloqueo`:
+ni otro PATCH ni la finalización pueden tocarla, y lo confirmado (`recibido`)
+solo avanza cuando los bytes ya están en disco (fsync). Si el proceso muere a
+medias, el bloqueo caduca a los SUBIDAS_BLOQUEO_SEGUNDOS y el cliente reenvía
+el trozo desde lo confirmado.
+"""
+from datetime import datetime, timedelta
+import base64
+import binascii
+import hashlib
+import os
+import shutil
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy import and_, func, or_
+
+from models import db, Subida
+
+BLOQUE = 1024 * 1024
+ALGORITMOS = ('md5', 'sha1', 'sha256')
+ESTADOS_RESERVAN = ('activa', 'escribiendo', 'finalizando')
+# Cada cuánto renueva su bloqueo un PATCH largo (segundos)
+RENOVAR_BLOQUEO = 30
+
+
+class ErrorSubida(Exception):
+    """Petición no válida para el estado de la subida, con su código HTTP."""
+
+    def __init__(self, mensaje, codigo):
+        super().__init__(mensaje)
+        self.codigo = codigo
+
+
+def ruta_temporal(subida):
+    return os.path.join(current_app.config['SUBIDAS_FOLDER'], subida.id)
+
+
+def descartar(subida):
+    """Borra el temporal y la fila. El llamante hace el commit."""
+    ruta = ruta_temporal(subida)
+    if os.path.exists(ruta):
+        os.remove(ruta)
+    db.session.delete(subida)
+
+
+def purgar_caducadas():
+    """Descarta las subidas abandonadas para liberar su cupo."""
+    limite = datetime.utcnow() - timedelta(hours=current_app.config['SUBIDAS_CADUCIDAD_HORAS'])
+    # Las completadas solo se guardan para que finalizar sea idempotente
+    caducadas = Subida.query.filter(
+        Subida.estado.in_(('activa', 'escribiendo', 'completada')), Subida.fecha_actualizada < limite
+    ).all()
+    for subida in caducadas:
+        descartar(subida)
+    if caducadas:
+        db.session.commit()
+
+
+def crear(usuario, nombre, tamaño, es_privado=False, opciones=None):
+    """Reserva cupo y crea el temporal vacío de una nueva subida."""
+    if not nombre:
+        raise ErrorSubida("Falta el nombre del archivo.", 400)
+    if not isinstance(tamaño, int) or tamaño <= 0:
+        raise ErrorSubida("El tamaño debe ser un entero positivo.", 400)
+
+    purgar_caducadas()
+    reservado, pendiente = db.session.query(
+        func.coalesce(func.sum(Subida.tamaño), 0),
+        func.coalesce(func.sum(Subida.tamaño - Subida.recibido), 0),
+    ).filter(Subida.estado.in_(ESTADOS_RESERVAN)).one()
+    if reservado + tamaño > current_app.config['SUBIDAS_MAX_BYTES']:
+        raise ErrorSubida("Hay demasiados datos en subidas en curso; inténtalo más tarde.", 507)
+
+    carpeta = current_app.config['SUBIDAS_FOLDER']
+    os.makedirs(carpeta, exist_ok=True)
+    # Lo que aún falta por llegar de las demás también ocupará disco
+    if shutil.disk_usage(carpeta).free < pendiente + tamaño:
+        raise ErrorSubida("No queda espacio en disco para esta subida.", 507)
+
+    subida = Subida(
+        id=uuid.uuid4().hex,
+        usuario_id=usuario.id,
+        nombre=nombre,
+        tamaño=tamaño,
+        recibido=0,
+        es_privado=es_privado,
+        opciones=opciones or {},
+        estado='activa',
+    )
+    open(ruta_temporal(subida), 'wb').close()
+    db.session.add(subida)
+    db.session.commit()
+    return subida
+
+
+def _verificador(checksum):
+    """(hash, digest esperado) a partir de una cabecera `Upload-Checksum: <alg> <base64>`."""
+    if not checksum:
+        return None, None
+    algoritmo, _, valor = checksum.strip().partition(' ')
+    if algoritmo.lower() not in ALGORITMOS:
+        raise ErrorSubida(f"Algoritmo de checksum no admitido: {algoritmo}.", 400)
+    try:
+        esperado = base64.b64decode(valor.strip(), validate=True)
+    except binascii.Error:
+        raise ErrorSubida("Checksum mal codificado (se espera base64).", 400)
+    return hashlib.new(algoritmo.lower()), esperado
+
+
+def _bloqueo_caducado():
+    """Condición de una subida 'escribiendo' cuyo PATCH ya no da señales."""
+    limite = datetime.utcnow() - timedelta(seconds=current_app.config['SUBIDAS_BLOQUEO_SEGUNDOS'])
+    return and_(Subida.estado == 'escribiendo', Subida.fecha_actualizada < limite)
+
+
+def escribiendo(subida):
+    """True si un PATCH vivo está escribiendo en la subida."""
+    if subida.estado != 'escribiendo':
+        return False
+    return not Subida.query.filter(Subida.id == subida.id, _bloqueo_caducado()).count()
+
+
+def escribir_trozo(subida, desplazamiento, longitud, flujo, checksum=None):
+    """Escribe `longitud` bytes de `flujo` en `desplazamiento` y avanza lo recibido.
+
+    Solo se acepta el trozo que continúa justo donde termina lo confirmado, así
+    que reenviar un trozo ya aplicado da 409 con el desplazamiento actual.
+    """
+    if subida.estado not in ('activa', 'escribiendo'):
+        raise ErrorSubida("La subida ya no admite más datos.", 409)
+    if desplazamiento != subida.recibido:
+        raise ErrorSubida("El desplazamiento no coincide con lo recibido.", 409)
+    if longitud is None:
+        raise ErrorSubida("Falta Content-Length.", 411)
+    if longitud > current_app.config['SUBIDAS_MAX_TROZO']:
+        raise ErrorSubida("Trozo demasiado grande.", 413)
+    if desplazamiento + longitud > subida.tamaño:
+        raise ErrorSubida("El trozo sobrepasa el tamaño declarado.", 400)
+    verificador, esperado = _verificador(checksum)
+
+    # Bloqueo atómico de la subida: si otra petición se ha adelantado no se actualiza nada.
+    # `recibido` no se toca hasta que los bytes estén en disco.
+    bloqueo = uuid.uuid4().hex
+    reservado = Subida.query.filter(
+        Subida.id == subida.id,
+        Subida.recibido == desplazamiento,
+        or_(Subida.estado == 'activa', _bloqueo_caducado()),
+    ).update(
+        {'estado': 'escribiendo', 'bloqueo': bloqueo, 'fecha_actualizada': datetime.utcnow()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    if not reservado:
+        raise ErrorSubida("Otra petición está escribiendo en esta subida.", 409)
+
+    def renovar():
+        renovado = Subida.query.filter_by(id=subida.id, bloqueo=bloqueo, estado='escribiendo').update(
+            {'fecha_actualizada': datetime.utcnow()}, synchronize_session=False
+        )
+        db.session.commit()
+        if not renovado:
+            raise ErrorSubida("La subida ha cambiado mientras se escribía el trozo.", 409)
+
+    try:
+        escritos = 0
+        ultima_renovacion = time.monotonic()
+        with open(ruta_temporal(subida), 'r+b') as destino:
+            destino.seek(desplazamiento)
+            while escritos < longitud:
+                bloque = flujo.read(min(BLOQUE, longitud - escritos))
+                if not bloque:
+                    break
+                destino.write(bloque)
+                if verificador:
+                    verificador.update(bloque)
+                escritos += len(bloque)
+                if time.monotonic() - ultima_renovacion > RENOVAR_BLOQUEO:
+                    renovar()
+                    ultima_renovacion = time.monotonic()
+            if escritos < longitud:
+                raise ErrorSubida("Trozo incompleto.", 400)
+            if verificador and verificador.digest() != esperado:
+                # 460 Checksum Mismatch, como en la extensión checksum de tus
+                raise ErrorSubida("El checksum del trozo no coincide.", 460)
+            destino.flush()
+            os.fsync(destino.fileno())
+    except BaseException:
+        # Se libera sin avanzar lo confirmado, para que el cliente pueda reenviar el trozo
+        db.session.rollback()
+        Subida.query.filter_by(id=subida.id, bloqueo=bloqueo, estado='escribiendo').update(
+            {'estado': 'activa', 'bloqueo': None}, synchronize_session=False
+        )
+        db.session.commit()
+        raise
+
+    confirmado = Subida.query.filter_by(id=subida.id, bloqueo=bloqueo, estado='escribiendo').update(
+        {'estado': 'activa', 'bloqueo': None, 'recibido': desplazamiento + longitud,
+         'fecha_actualizada': datetime.utcnow()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    if not confirmado:
+        # El bloqueo caducó y otra petición tomó la subida: este trozo no cuenta
+        raise ErrorSubida("La subida ha cambiado mientras se escribía el trozo.", 409)
+    db.session.refresh(subida)
+    return subida
+
+
+def reclamar_para_finalizar(subida):
+    """Pasa la subida completa a 'finalizando'. False si otra petición ya lo hizo."""
+    if subida.recibido != subida.tamaño:
+        raise ErrorSubida("Faltan datos por recibir.", 409)
+    if os.path.getsize(ruta_temporal(subida)) != subida.tamaño:
+        raise ErrorSubida("El temporal no tiene el tamaño declarado.", 409)
+    # Solo desde 'activa' y con todo confirmado: nunca con un PATCH escribiendo aún
+    reclamada = Subida.query.filter_by(id=subida.id, estado='activa', recibido=subida.tamaño).update(
+        {'estado': 'finalizando'}, synchronize_session=False
+    )
+    db.session.commit()
+    db.session.refresh(subida)
+    return bool(reclamada)
@@ -0,0 +1,1011 @@
+"""Cola persistente de tareas en segundo plano.
+
+Las tareas viven en la tabla `tarea`, que hace de cola: las subidas solo las
+encolan y un despachador las reclama y las ejecuta en un pool de procesos
+con concurrencia limitada. Los procesos hijo no tocan la base de datos:
+reciben rutas y devuelven un resultado que el despachador aplica.
+
+Cada tipo de tarea se registra en TIPOS con tres funciones:
+  preparar(tarea) -> args        (despachador, con acceso a la BD)
+  ejecutar(*args) -> resultado   (proceso hijo)
+  aplicar(tarea, resultado)      (despachador, con acceso a la BD)
+y opcionalmente `descartar(resultado)`, que limpia un resultado que no se va a
+aplicar (tarea cancelada o fallo al aplicarlo), y `limite`, la clave de
+configuración con el máximo de tareas de ese tipo en curso a la vez entre todos
+los despachadores.
+
+`aplicar` solo cambia la sesión y, como último paso, los ficheros que no
+destruyen nada. Lo que no se puede deshacer (borrar o sustituir el original)
+va en la función que devuelve, `tras_commit(confirmado)`: el despachador la
+llama después del commit, con False si el commit falló para que devuelva los
+ficheros a como estaban.
+
+Pueden correr varios despachadores a la vez (el hilo del servidor, `flask
+tareas trabajar`, `flask tareas hls`...). Cada tarea en curso lleva el
+despachador que la reclamó y un arrendamiento (`vence_en`) que este renueva
+mientras vive; solo las de arrendamiento vencido se devuelven a la cola.
+"""
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy import or_
+
+from models import db, Archivo, CODECS_AUDIO_COMPATIBLES, MediaInfo, Tarea, ruta_relativa, video_compatible
+from hashes import algoritmo_actual, calcular_hash
+from hls import admite_hls, esta_listo, generar_hls, parametros_generacion as parametros_hls, podar as podar_hls
+from miniaturas import generar_miniaturas, parametros_generacion, pendientes_miniatura
+from trickplay import generar_trickplay, parametros_generacion as parametros_trickplay
+from utils import (
+    convertir_doc_a_pdf, duracion_media, ejecutar_ffmpeg, necesita_faststart, nombre_libre, plan_audio,
+    sondear_media,
+)
+
+ESTADOS_ACTIVOS = ('pendiente', 'en_curso')
+ESTADOS_FINALES = ('completada', 'fallida', 'cancelada')
+
+TipoTarea = namedtuple('TipoTarea', ['preparar', 'ejecutar', 'aplicar', 'descartar', 'limite'])
+TIPOS = {}
+
+# Cola hacia el despachador y tarea en curso, solo definidas dentro de los hijos
+_COLA_HIJO = None
+_TAREA_HIJO = None
+
+
+def registrar_tipo(nombre, preparar, ejecutar, aplicar, descartar=None, limite=None):
+    TIPOS[nombre] = TipoTarea(preparar, ejecutar, aplicar, descartar, limite)
+
+
+def encolar(tipo, archivo=None, max_intentos=3, **parametros):
+    """Añade una tarea pendiente a la sesión. El llamante hace el commit."""
+    tarea = Tarea(
+        tipo=tipo,
+        archivo=archivo,
+        estado='pendiente',
+        parametros=parametros,
+        max_intentos=max_intentos,
+        disponible_desde=datetime.utcnow(),
+    )
+    db.session.add(tarea)
+    return tarea
+
+
+def cancelar(tarea):
+    """Marca la tarea como cancelada. Si está en curso, el despachador la detiene.
+
+    Devuelve False si la tarea ya había terminado. El llamante hace el commit.
+    """
+    if tarea.estado in ESTADOS_FINALES:
+        return False
+    tarea.estado = 'cancelada'
+    tarea.eta = None
+    tarea.fecha_fin = datetime.utcnow()
+    return True
+
+
+def tarea_activa(archivo, tipo):
+    """Tarea pendiente o en curso de ese tipo para el archivo, si la hay."""
+    if archivo.id is None:
+        return None
+    return Tarea.query.filter(
+        Tarea.archivo_id == archivo.id,
+        Tarea.tipo == tipo,
+        Tarea.estado.in_(ESTADOS_ACTIVOS),
+    ).first()
+
+
+def informar(clave, valor):
+    """Envía un dato de la tarea en curso (p. ej. 'progreso') al despachador."""
+    if _COLA_HIJO is not None and _TAREA_HIJO is not None:
+        _COLA_HIJO.put((_TAREA_HIJO, clave, valor))
+
+
+def datos_media(archivo):
+    """Datos de ffprobe vigentes del Archivo (como los de `sondear_media`), o None."""
+    info = archivo.media_info
+    if info is None or info.error or info.caducada():
+        return None
+    return {columna: getattr(info, columna) for columna in (
+        'duracion', 'video_codec', 'audio_codec', 'ancho', 'alto', 'formato_pixel', 'perfil_video',
+        'streams_audio')}
+
+
+# --- Miniaturas ---------------------------------------------------------------
+
+def admite_miniatura(tipo_mime):
+    tipo_mime = tipo_mime or ''
+    return tipo_mime == 'application/pdf' or tipo_mime.startswith(('image/', 'video/'))
+
+
+def encolar_miniatura(archivo):
+    """Encola las miniaturas de un Archivo, si su tipo las admite."""
+    if not admite_miniatura(archivo.tipo):
+        return None
+    return encolar('miniatura', archivo)
+
+
+def encolar_miniaturas(modo='faltan'):
+    """Encola en bloque las miniaturas de `pendientes_miniatura(modo)`, salvo las que ya tienen tarea.
+
+    Es la versión en segundo plano de `flask thumbs rebuild`: el despachador las
+    reparte entre sus procesos. Devuelve (encoladas, sin_fichero). El llamante hace el commit.
+    """
+    pendientes, sin_fichero = pendientes_miniatura(modo)
+    activas = {
+        archivo_id for (archivo_id,) in db.session.query(Tarea.archivo_id).filter(
+            Tarea.tipo == 'miniatura', Tarea.estado.in_(ESTADOS_ACTIVOS))
+    }
+    ids = [pendiente['id'] for pendiente in pendientes if pendiente['id'] not in activas]
+    encoladas = 0
+    for inicio in range(0, len(ids), 500):
+        for archivo in Archivo.query.filter(Archivo.id.in_(ids[inicio:inicio + 500])):
+            encolar('miniatura', archivo)
+            encoladas += 1
+    return encoladas, sin_fichero
+
+
+def encolar_derivados(archivo):
+    """Encola miniatura, trickplay, faststart y sondeo de un Archivo nuevo, salvo los que ya traiga reutilizados."""
+    tareas = []
+    if archivo.miniatura is None:
+        tareas.append(encolar_miniatura(archivo))
+    if archivo.trickplay is None:
+        tareas.append(encolar_trickplay(archivo))
+    if current_app.config['HLS_AL_SUBIR']:
+        tareas.append(encolar_hls(archivo))
+    faststart = encolar_faststart(archivo)
+    tareas.append(faststart)
+    # Con faststart el fichero va a cambiar: se sondea al terminar, no antes
+    if archivo.media_info is None and faststart is None:
+        tareas.append(encolar_sondeo(archivo))
+    return [tarea for tarea in tareas if tarea is not None]
+
+
+def _preparar_miniatura(tarea):
+    archivo = tarea.archivo
+    datos = datos_media(archivo) or {}
+    return (archivo.ruta, archivo.tipo, archivo.hash_archivo, *parametros_generacion(), datos.get('duracion'))
+
+
+def _ejecutar_miniatura(ruta, tipo_mime, clave, carpeta, medidas, formato, duracion=None):
+    # Filas sin hash todavía (importadas a mano...): la clave se calcula aquí
+    clave = clave or calcular_hash(ruta)
+    try:
+        return generar_miniaturas(ruta, tipo_mime, clave, carpeta, medidas, formato, duracion)
+    except Exception as e:
+        raise RuntimeError(f"No se pudo generar la miniatura de {os.path.basename(ruta)}: {e}") from e
+
+
+def _aplicar_miniatura(tarea, miniatura):
+    tarea.archivo.miniatura = miniatura
+
+
+registrar_tipo('miniatura', _preparar_miniatura, _ejecutar_miniatura, _aplicar_miniatura)
+
+
+# --- Previsualización al buscar en vídeos (trickplay) -------------------------
+
+def admite_trickplay(tipo_mime):
+    return (tipo_mime or '').startswith('video/')
+
+
+def encolar_trickplay(archivo):
+    """Encola las hojas de previsualización de un vídeo, salvo si ya hay una tarea activa."""
+    if not admite_trickplay(archivo.tipo):
+        return None
+    return tarea_activa(archivo, 'trickplay') or encolar('trickplay', archivo)
+
+
+def _preparar_trickplay(tarea):
+    archivo = tarea.archivo
+    info = archivo.media_info
+    duracion = info.duracion if info is not None and not info.caducada() else None
+    return (archivo.ruta, archivo.hash_archivo, duracion, parametros_trickplay())
+
+
+def _ejecutar_trickplay(ruta, clave, duracion, parametros):
+    def progresar(porcentaje, eta):
+        informar('progreso', porcentaje)
+        informar('eta', eta)
+
+    return generar_trickplay(
+        ruta,
+        clave or calcular_hash(ruta),
+        duracion or duracion_media(ruta),
+        al_progresar=progresar,
+        al_iniciar=lambda pid: informar('pid', pid),
+        **parametros
+    )
+
+
+def _aplicar_trickplay(tarea, clave):
+    tarea.archivo.trickplay = clave
+
+
+registrar_tipo('trickplay', _preparar_trickplay, _ejecutar_trickplay, _aplicar_trickplay,
+               limite='TRICKPLAY_SIMULTANEOS')
+
+
+# --- Empaquetado HLS ------------------------------------------------------------
+
+# Un vídeo que ffmpeg no puede empaquetar no se reintenta en cada reproducción
+ESPERA_TRAS_FALLO_HLS = timedelta(days=1)
+
+
+def encolar_hls(archivo, forzar=False):
+    """Encola el paquete HLS de un vídeo, salvo si ya está listo, en curso o falló hace poco."""
+    if not admite_hls(archivo) or (esta_listo(archivo) and not forzar):
+        return None
+    activa = tarea_activa(archivo, 'hls')
+    if activa is not None:
+        return activa
+    fallida = Tarea.query.filter(
+        Tarea.archivo_id == archivo.id,
+        Tarea.tipo == 'hls',
+        Tarea.estado == 'fallida',
+        Tarea.fecha_fin >= datetime.utcnow() - ESPERA_TRAS_FALLO_HLS,
+    ).first()
+    if fallida is not None and not forzar:
+        return None
+    # Como las conversiones: una recodificación fallida casi nunca sale bien a la segunda
+    return encolar('hls', archivo, max_intentos=1)
+
+
+def _preparar_hls(tarea):
+    archivo = tarea.archivo
+    return (archivo.ruta, archivo.hash_archivo, datos_media(archivo), parametros_hls())
+
+
+def _ejecutar_hls(ruta, clave, datos, parametros):
+    # Sin metadatos vigentes se sondea aquí: hace falta saber si hay audio y no ampliar
+    datos = datos or sondear_media(ruta)
+    lados = [lado for lado in (datos.get('ancho'), datos.get('alto')) if lado]
+
+    def progresar(porcentaje, eta):
+        informar('progreso', porcentaje)
+        informar('eta', eta)
+
+    return generar_hls(
+        ruta,
+        clave or calcular_hash(ruta),
+        datos.get('duracion') or duracion_media(ruta),
+        min(lados) if lados else None,
+        bool(datos.get('streams_audio')),
+        al_progresar=progresar,
+        al_iniciar=lambda pid: informar('pid', pid),
+        **parametros
+    )
+
+
+def _aplicar_hls(tarea, clave):
+    # El paquete ya está en su sitio: solo queda mantener la caché en su presupuesto
+    podar_hls(current_app.config['HLS_FOLDER'], current_app.config['HLS_MAX_BYTES'])
+
+
+registrar_tipo('hls', _preparar_hls, _ejecutar_hls, _aplicar_hls, limite='HLS_SIMULTANEOS')
+
+
+# --- Metadatos de ffprobe (MediaInfo) -----------------------------------------
+
+def admite_sondeo(tipo_mime):
+    return (tipo_mime or '').startswith(('video/', 'audio/'))
+
+
+def encolar_sondeo(archivo):
+    """Encola el ffprobe de un Archivo de audio o vídeo, salvo si ya hay uno activo."""
+    if not admite_sondeo(archivo.tipo):
+        return None
+    return tarea_activa(archivo, 'sondeo') or encolar('sondeo', archivo)
+
+
+def _preparar_sondeo(tarea):
+    return (tarea.archivo.ruta,)
+
+
+def _ejecutar_sondeo(ruta):
+    # El mtime se toma antes de leer: si cambia durante el sondeo, quedará caducado
+    datos = {'mtime': os.path.getmtime(ruta), 'error': None}
+    try:
+        datos.update(sondear_media(ruta))
+    except (RuntimeError, ValueError) as e:
+        # Un fichero ilegible se guarda con su error para no reintentarlo en cada vista
+        datos['error'] = str(e)
+    return datos
+
+
+def _aplicar_sondeo(tarea, datos):
+    archivo = tarea.archivo
+    info = archivo.media_info or MediaInfo(archivo=archivo)
+    # Todas las columnas, para que un sondeo fallido no deje datos del fichero anterior
+    for columna in MediaInfo.__table__.columns.keys():
+        if columna != 'archivo_id':
+            setattr(info, columna, datos.get(columna))
+    info.hash_archivo = archivo.hash_archivo
+    info.fecha_sondeo = datetime.utcnow()
+
+
+registrar_tipo('sondeo', _preparar_sondeo, _ejecutar_sondeo, _aplicar_sondeo)
+
+
+# --- Conversión a formatos compatibles ------------------------------------------
+
+def plan_conversion(archivo):
+    """(nombre, tipo MIME, argumentos de ffmpeg) para hacer compatible un Archivo, o None.
+
+    En los vídeos los argumentos son None: se deciden al ejecutar, según los
+    códecs que tenga el fichero en ese momento (ver `argumentos_video_compatible`).
+    """
+    base = archivo.nombre.rsplit('.', 1)[0]
+    # Si es audio WMA → MP3
+    if archivo.tipo.startswith('audio/') and archivo.nombre.lower().endswith('.wma'):
+        return base + '.mp3', 'audio/mpeg', ['-acodec', 'libmp3lame']
+    # Si es vídeo con códec o contenedor incompatible → MP4 H.264 + AAC
+    if archivo.tipo.startswith('video/'):
+        datos = datos_media(archivo)
+        if (archivo.tipo == 'video/mp4' and datos is not None and video_compatible(datos)
+                and datos['audio_codec'] in (None, *CODECS_AUDIO_COMPATIBLES)):
+            return None
+        return base + '_compatible.mp4', 'video/mp4', None
+    return None
+
+
+def argumentos_video_compatible(datos):
+    """Argumentos de ffmpeg para pasar un vídeo a MP4 H.264 + AAC recodificando solo lo necesario.
+
+    Las pistas que ya son compatibles se copian tal cual (`-c copy`): un MKV con
+    H.264 de 8 bits 4:2:0 y AAC se reempaqueta en segundos en vez de recodificarse
+    en minutos.
+    Sin datos de ffprobe se recodifica todo, como antes.
+    """
+    datos = datos or {}
+    # Solo la pista principal de cada tipo: los subtítulos de un MKV no caben en MP4 sin convertir
+    argumentos = ['-map', '0:v:0', '-map', '0:a:0?', '-sn', '-dn']
+    if video_compatible(datos):
+        argumentos += ['-c:v', 'copy']
+    else:
+        # Sin -pix_fmt, libx264 mantiene los 10 bits o el 4:2:2 del original
+        argumentos += ['-c:v', 'libx264', '-preset', 'fast', '-crf', '23', '-pix_fmt', 'yuv420p']
+    if datos.get('audio_codec') in CODECS_AUDIO_COMPATIBLES:
+        argumentos += ['-c:a', 'copy']
+    else:
+        argumentos += ['-c:a', 'aac']
+    # Índice al principio, para que el navegador empiece a reproducir sin bajar el final
+    return argumentos + ['-movflags', '+faststart']
+
+
+def encolar_conversion(archivo):
+    """Encola la conversión de un Archivo, o devuelve la que ya esté activa."""
+    activa = tarea_activa(archivo, 'conversion')
+    if activa is not None:
+        return activa
+
+    plan = plan_conversion(archivo)
+    if plan is None:
+        return None
+    nombre, tipo_mime, argumentos = plan
+    # Una recodificación fallida casi nunca sale bien a la segunda: sin reintentos
+    return encolar('conversion', archivo, max_intentos=1,
+                   nombre=nombre, tipo_mime=tipo_mime, argumentos=argumentos)
+
+
+def _preparar_conversion(tarea):
+    origen = tarea.archivo.ruta
+    # Junto al original, para que los privados sigan dentro de su carpeta, y sin pisar a nadie
+    carpeta = os.path.dirname(origen)
+    destino = os.path.join(carpeta, nombre_libre(carpeta, tarea.parametros['nombre']))
+    return (origen, destino, tarea.parametros.get('argumentos'), datos_media(tarea.archivo), algoritmo_actual())
+
+
+def _ejecutar_conversion(origen, destino, argumentos, datos=None, algoritmo=None):
+    # ffmpeg escribe en un temporal de la misma carpeta; solo se renombra sobre
+    # el destino al aplicar, así un fallo nunca deja nada a medias en su lugar.
+    carpeta, nombre = os.path.split(destino)
+    temporal = os.path.join(carpeta, f".parcial_{nombre}")
+    if datos is None:
+        try:
+            datos = sondear_media(origen)
+        except RuntimeError:
+            pass  # ffmpeg dirá qué le pasa al fichero; sin datos se recodifica todo
+    if argumentos is None:
+        argumentos = argumentos_video_compatible(datos)
+
+    def progresar(porcentaje, eta):
+        informar('progreso', porcentaje)
+        informar('eta', eta)
+
+    try:
+        ejecutar_ffmpeg(
+            ['-i', origen, *argumentos, '-y', temporal],
+            duracion=(datos or {}).get('duracion') or duracion_media(origen),
+            al_progresar=progresar,
+            al_iniciar=lambda pid: informar('pid', pid),
+        )
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return {
+        'temporal': temporal,
+        'destino': destino,
+        'tamaño': os.path.getsize(temporal),
+        'mtime': os.path.getmtime(temporal),
+        'hash': calcular_hash(temporal, algoritmo),
+        'algoritmo': algoritmo,
+    }
+
+
+def _aplicar_conversion(tarea, resultado):
+    archivo = tarea.archivo
+    original = archivo.ruta
+    # Se vuelve a comprobar: mientras ffmpeg trabajaba pudo aparecer otro fichero con ese nombre
+    carpeta = os.path.dirname(resultado['destino'])
+    nombre = nombre_libre(carpeta, os.path.basename(resultado['destino']))
+    destino = os.path.join(carpeta, nombre)
+    archivo.ruta = destino
+    archivo.nombre = nombre
+    archivo.tipo = tarea.parametros['tipo_mime']
+    # Se conserva el hash de lo subido para reconocer resubidas del mismo original
+    archivo.hash_original = archivo.hash_original or archivo.hash_archivo
+    archivo.tamaño = resultado['tamaño']
+    archivo.mtime = resultado['mtime']
+    archivo.hash_archivo = resultado['hash']
+    archivo.algoritmo_hash = resultado['algoritmo']
+    # El fichero es otro: sus metadatos de ffprobe ya no valen
+    encolar_sondeo(archivo)
+    db.session.flush()
+
+    # El original ya no es de ninguna fila: si se quedara, `flask reconcile --arreglar`
+    # lo importaría como un archivo nuevo. Se conserva si otra fila apunta a él.
+    compartido = Archivo.query.filter(
+        Archivo.ruta_guardada == ruta_relativa(original), Archivo.id != archivo.id
+    ).first()
+    # El destino es un nombre libre: moverlo ahí no pisa nada
+    os.replace(resultado['temporal'], destino)
+
+    def tras_commit(confirmado):
+        if not confirmado:
+            # La fila sigue apuntando al original: la conversión sobra
+            os.remove(destino)
+        elif compartido is None and os.path.isfile(original):
+            os.remove(original)
+
+    return tras_commit
+
+
+def _descartar_conversion(resultado):
+    if os.path.exists(resultado['temporal']):
+        os.remove(resultado['temporal'])
+
+
+registrar_tipo('conversion', _preparar_conversion, _ejecutar_conversion, _aplicar_conversion,
+               descartar=_descartar_conversion, limite='CONVERSIONES_SIMULTANEAS')
+
+
+# --- Faststart (índice de MP4/MOV al principio) -------------------------------
+
+TIPOS_FASTSTART = ('video/mp4', 'video/quicktime', 'video/x-m4v', 'audio/mp4', 'audio/x-m4a')
+
+
+def admite_faststart(archivo):
+    """True si es un MP4/MOV con el átomo moov al final, y no comparte bytes con otros."""
+    if archivo.tipo not in TIPOS_FASTSTART or not archivo.ruta:
+        return False
+    try:
+        # Un enlace duro de deduplicación se reescribiría solo en una de las rutas
+        if os.stat(archivo.ruta).st_nlink > 1:
+            return False
+    except OSError:
+        return False
+    return necesita_faststart(archivo.ruta)
+
+
+def encolar_faststart(archivo):
+    """Encola la recolocación del índice de un MP4/MOV, si la necesita y no hay una activa."""
+    if not admite_faststart(archivo):
+        return None
+    return tarea_activa(archivo, 'faststart') or encolar('faststart', archivo)
+
+
+def _preparar_faststart(tarea):
+    ruta = tarea.archivo.ruta
+    return (ruta, os.path.getmtime(ruta), algoritmo_actual())
+
+
+def _ejecutar_faststart(ruta, mtime, algoritmo):
+    # Reempaquetado sin recodificar: tarda lo que tarde copiar el fichero
+    carpeta, nombre = os.path.split(ruta)
+    temporal = os.path.join(carpeta, f".parcial_{nombre}")
+    try:
+        ejecutar_ffmpeg(
+            ['-i', ruta, '-map', '0', '-c', 'copy', '-ignore_unknown',
+             '-movflags', '+faststart', '-y', temporal],
+            al_iniciar=lambda pid: informar('pid', pid),
+        )
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return {
+        'temporal': temporal,
+        'origen': ruta,
+        'mtime_origen': mtime,
+        'tamaño': os.path.getsize(temporal),
+        'mtime': os.path.getmtime(temporal),
+        'hash': calcular_hash(temporal, algoritmo),
+        'algoritmo': algoritmo,
+    }
+
+
+def _aplicar_faststart(tarea, resultado):
+    archivo = tarea.archivo
+    # Si el original se ha movido o cambiado mientras tanto, la copia ya no vale
+    if archivo.ruta != resultado['origen'] or os.path.getmtime(archivo.ruta) != resultado['mtime_origen']:
+        raise RuntimeError("El archivo cambió durante el faststart; se descarta la copia")
+    # Una deduplicación puede haberlo enlazado mientras tanto: reemplazarlo separaría las rutas
+    if os.stat(archivo.ruta).st_nlink > 1:
+        raise RuntimeError("El archivo se comparte con otro por deduplicación; se descarta la copia")
+    # Como en las conversiones, se conserva el hash de lo subido para reconocer resubidas
+    archivo.hash_original = archivo.hash_original or archivo.hash_archivo
+    archivo.tamaño = resultado['tamaño']
+    archivo.mtime = resultado['mtime']
+    archivo.hash_archivo = resultado['hash']
+    archivo.algoritmo_hash = resultado['algoritmo']
+    encolar_sondeo(archivo)
+    db.session.flush()
+
+    # El original se aparta (no se borra) hasta que la fila nueva esté confirmada.
+    # Atómico: quien esté leyendo el original sigue con su descriptor hasta terminar
+    ruta = archivo.ruta
+    carpeta, nombre = os.path.split(ruta)
+    respaldo = os.path.join(carpeta, f".respaldo_{nombre}")
+    os.replace(ruta, respaldo)
+    try:
+        os.replace(resultado['temporal'], ruta)
+    except OSError:
+        os.replace(respaldo, ruta)
+        raise
+
+    def tras_commit(confirmado):
+        if confirmado:
+            os.remove(respaldo)
+        else:
+            # La fila conserva el hash, el tamaño y el mtime del original: vuelve el original
+            os.replace(respaldo, ruta)
+
+    return tras_commit
+
+
+registrar_tipo('faststart', _preparar_faststart, _ejecutar_faststart, _aplicar_faststart,
+               descartar=_descartar_conversion, limite='FASTSTART_SIMULTANEOS')
+
+
+# --- Derivados a petición de quien sube: PDF de documentos y audio de vídeos ----
+
+CONVERTIBLES_A_PDF = {'.doc', '.docx', '.odt', '.ppt', '.pptx', '.xls', '.xlsx'}
+TIPOS_AUDIO = {'mp3': 'audio/mpeg', 'm4a': 'audio/mp4'}
+
+
+def encolar_pdf(archivo):
+    """Encola el PDF de un documento de ofimática, si lo es y no hay uno activo."""
+    if os.path.splitext(archivo.nombre)[1].lower() not in CONVERTIBLES_A_PDF:
+        return None
+    return tarea_activa(archivo, 'pdf') or encolar('pdf', archivo, max_intentos=1)
+
+
+def encolar_audio(archivo):
+    """Encola la extracción del audio de un vídeo, si lo es y no hay una activa."""
+    if not (archivo.tipo or '').startswith('video/'):
+        return None
+    return tarea_activa(archivo, 'audio') or encolar('audio', archivo, max_intentos=1)
+
+
+def _preparar_derivado(tarea):
+    return (tarea.archivo.ruta, algoritmo_actual())
+
+
+def _resultado_derivado(temporal, nombre, algoritmo):
+    return {
+        'temporal': temporal,
+        'nombre': nombre,
+        'tamaño': os.path.getsize(temporal),
+        'hash': calcular_hash(temporal, algoritmo),
+    }
+
+
+def _ejecutar_pdf(origen, algoritmo):
+    carpeta, nombre = os.path.split(origen)
+    nombre = os.path.splitext(nombre)[0] + '.pdf'
+    temporal = os.path.join(carpeta, f".parcial_{nombre}")
+    try:
+        convertir_doc_a_pdf(origen, temporal)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return _resultado_derivado(temporal, nombre, algoritmo)
+
+
+def _ejecutar_audio(origen, algoritmo):
+    try:
+        datos = sondear_media(origen)
+    except (OSError, RuntimeError, ValueError):
+        datos = None  # Sin datos se recodifica
+    extension, argumentos = plan_audio(datos)
+    carpeta, nombre = os.path.split(origen)
+    nombre = f"{os.path.splitext(nombre)[0]}.{extension}"
+    temporal = os.path.join(carpeta, f".parcial_{nombre}")
+
+    def progresar(porcentaje, eta):
+        informar('progreso', porcentaje)
+        informar('eta', eta)
+
+    try:
+        ejecutar_ffmpeg(
+            ['-i', origen, '-vn', '-map', '0:a:0', *argumentos, '-y', temporal],
+            duracion=(datos or {}).get('duracion') or duracion_media(origen),
+            al_progresar=progresar,
+            al_iniciar=lambda pid: informar('pid', pid),
+        )
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return _resultado_derivado(temporal, nombre, algoritmo)
+
+
+def _aplicar_derivado(tarea, resultado, tipo_mime):
+    """Registra el fichero generado como un Archivo nuevo junto al original."""
+    # Import tardío: ingesta encola tareas al registrar y depende de este módulo
+    from ingesta import Recibido, ingerir
+
+    archivo = tarea.archivo
+    carpeta = os.path.dirname(archivo.ruta)
+    destino = os.path.join(carpeta, nombre_libre(carpeta, resultado['nombre']))
+    recibido = Recibido(destino, resultado['tamaño'], resultado['hash'], tipo_mime)
+    # El nombre es libre: moverlo ahí no pisa nada. Antes de ingerir, que lee su mtime
+    os.replace(resultado['temporal'], destino)
+    try:
+        # Con la política de duplicados puede acabar enlazado, con otro nombre o borrado
+        nuevo, _, _ = ingerir(recibido, es_privado=archivo.es_privado, fecha_subida=datetime.utcnow())
+        db.session.flush()
+    except BaseException:
+        if os.path.isfile(destino):
+            os.remove(destino)
+        raise
+    ruta = nuevo.ruta if nuevo is not None else None
+
+    def tras_commit(confirmado):
+        # Sin commit no hay fila que apunte al fichero: sobra
+        if not confirmado and ruta and os.path.isfile(ruta):
+            os.remove(ruta)
+
+    return tras_commit
+
+
+def _aplicar_pdf(tarea, resultado):
+    return _aplicar_derivado(tarea, resultado, 'application/pdf')
+
+
+def _aplicar_audio(tarea, resultado):
+    extension = os.path.splitext(resultado['nombre'])[1].lstrip('.')
+    return _aplicar_derivado(tarea, resultado, TIPOS_AUDIO.get(extension, 'audio/mpeg'))
+
+
+registrar_tipo('pdf', _preparar_derivado, _ejecutar_pdf, _aplicar_pdf,
+               descartar=_descartar_conversion, limite='CONVERSIONES_SIMULTANEAS')
+registrar_tipo('audio', _preparar_derivado, _ejecutar_audio, _aplicar_audio,
+               descartar=_descartar_conversion, limite='CONVERSIONES_SIMULTANEAS')
+
+
+# --- Procesos hijo ------------------------------------------------------------
+
+def _iniciar_hijo(cola):
+    global _COLA_HIJO
+    _COLA_HIJO = cola
+
+
+def _ejecutar_en_hijo(tipo, tarea_id, args):
+    global _TAREA_HIJO
+    _TAREA_HIJO = tarea_id
+    try:
+        return TIPOS[tipo].ejecutar(*args)
+    finally:
+        _TAREA_HIJO = None
+
+
+# --- Despachador --------------------------------------------------------------
+
+class Despachador:
+    """Reclama tareas de la tabla y las reparte en un pool de procesos."""
+
+    def __init__(self, app, procesos=None, tipos=None):
+        self.app = app
+        self.procesos = procesos or app.config['TAREAS_PROCESOS'] or os.cpu_count() or 1
+        self.tipos = tuple(tipos or TIPOS)
+        self.en_curso = {}
+        self.pids = {}  # tarea_id -> pid del proceso externo (ffmpeg...) que informa el hijo
+        self.parar = threading.Event()
+        # Identifica las tareas que este despachador tiene en curso (columna Tarea.despachador)
+        self.id = uuid.uuid4().hex
+        self.arrendamiento = app.config['TAREAS_ARRENDAMIENTO']
+        self._renovado = 0.0
+        self._contexto = multiprocessing.get_context('spawn')
+        self._cola = self._contexto.Queue()
+        self._pool = None
+
+    def _nuevo_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.procesos,
+            mp_context=self._contexto,
+            initializer=_iniciar_hijo,
+            initargs=(self._cola,),
+        )
+
+    def vencimiento(self):
+        return datetime.utcnow() + timedelta(seconds=self.arrendamiento)
+
+    def recuperar_huerfanas(self):
+        """Devuelve a la cola las tareas 'en_curso' cuyo arrendamiento ha vencido.
+
+        Las de otros despachadores vivos se dejan en paz: los que siguen
+        corriendo renuevan el suyo en cada vuelta (`renovar`).
+        """
+        Tarea.query.filter(
+            Tarea.estado == 'en_curso',
+            Tarea.tipo.in_(self.tipos),
+            or_(Tarea.vence_en.is_(None), Tarea.vence_en < datetime.utcnow()),
+        ).update(
+            {'estado': 'pendiente', 'disponible_desde': datetime.utcnow(),
+             'despachador': None, 'vence_en': None},
+            synchronize_session=False,
+        )
+        db.session.commit()
+
+    def renovar(self):
+        """Alarga el arrendamiento de las tareas en curso y recoge las huérfanas.
+
+        Se hace cada tercio del plazo, para que una vuelta lenta no lo deje vencer.
+        """
+        if time.monotonic() - self._renovado < self.arrendamiento / 3:
+            return
+        if self.en_curso:
+            Tarea.query.filter(
+                Tarea.id.in_(list(self.en_curso.values())),
+                Tarea.despachador == self.id,
+                Tarea.estado == 'en_curso',
+            ).update({'vence_en': self.vencimiento()}, synchronize_session=False)
+            db.session.commit()
+        self.recuperar_huerfanas()
+        self._renovado = time.monotonic()
+
+    def cupos_libres(self):
+        """Plazas libres de los tipos con límite, contando todos los despachadores."""
+        cupos = {}
+        for nombre in self.tipos:
+            clave = TIPOS[nombre].limite
+            if clave:
+                ocupadas = Tarea.query.filter_by(tipo=nombre, estado='en_curso').count()
+                cupos[nombre] = self.app.config[clave] - ocupadas
+        return cupos
+
+    def reclamar(self, cantidad):
+        """Marca como en curso hasta `cantidad` tareas listas, de forma atómica."""
+        reclamadas = []
+        cupos = self.cupos_libres()
+        tipos = [nombre for nombre in self.tipos if cupos.get(nombre, 1) > 0]
+        if not tipos:
+            return reclamadas
+        candidatas = (
+            Tarea.query.filter(
+                Tarea.estado == 'pendiente',
+                Tarea.tipo.in_(tipos),
+                Tarea.disponible_desde <= datetime.utcnow(),
+            )
+            .order_by(Tarea.disponible_desde, Tarea.id)
+            .limit(cantidad)
+            .all()
+        )
+        for tarea in candidatas:
+            if tarea.tipo in cupos:
+                if cupos[tarea.tipo] <= 0:
+                    continue
+                cupos[tarea.tipo] -= 1
+            # El UPDATE condicionado evita que dos despachadores tomen la misma tarea
+            tomada = Tarea.query.filter_by(id=tarea.id, estado='pendiente').update(
+                {
+                    'estado': 'en_curso',
+                    'intentos': Tarea.intentos + 1,
+                    'fecha_inicio': datetime.utcnow(),
+                    'fecha_actualizada': datetime.utcnow(),
+                    'despachador': self.id,
+                    'vence_en': self.vencimiento(),
+                },
+                synchronize_session=False,
+            )
+            if tomada:
+                reclamadas.append(tarea.id)
+        db.session.commit()
+        return reclamadas
+
+    def lanzar(self, tarea_id):
+        tarea = db.session.get(Tarea, tarea_id)
+        try:
+            args = TIPOS[tarea.tipo].preparar(tarea)
+        except Exception as e:
+            self.fallar(tarea, e)
+            return
+        futuro = self._pool.submit(_ejecutar_en_hijo, tarea.tipo, tarea.id, args)
+        self.en_curso[futuro] = tarea.id
+
+    def fallar(self, tarea, error):
+        tarea.error = str(error)
+        tarea.eta = None
+        tarea.despachador = None
+        tarea.vence_en = None
+        if tarea.intentos < tarea.max_intentos:
+            # Reintento con espera exponencial: 10 s, 20 s, 40 s...
+            tarea.estado = 'pendiente'
+            tarea.disponible_desde = datetime.utcnow() + timedelta(seconds=10 * 2 ** (tarea.intentos - 1))
+        else:
+            tarea.estado = 'fallida'
+            tarea.fecha_fin = datetime.utcnow()
+        db.session.commit()
+        print(f"⚠️ Tarea {tarea.id} ({tarea.tipo}) fallida, intento {tarea.intentos}: {error}")
+
+    def finalizar(self, futuro):
+        tarea_id = self.en_curso.pop(futuro)
+        self.pids.pop(tarea_id, None)
+        tarea = db.session.get(Tarea, tarea_id)
+        if tarea is None or tarea.estado != 'en_curso' or tarea.despachador != self.id:
+            # Cancelada, borrada o retomada por otro despachador (arrendamiento vencido) mientras se ejecutaba
+            if tarea is not None and not futuro.cancelled() and futuro.exception() is None:
+                self.descartar(tarea.tipo, futuro.result())
+            return
+        resultado = None
+        try:
+            resultado = futuro.result()
+            tras_commit = TIPOS[tarea.tipo].aplicar(tarea, resultado)
+        except BrokenProcessPool as e:
+            self.fallar(tarea, e)
+            raise
+        except Exception as e:
+            db.session.rollback()
+            tarea = db.session.get(Tarea, tarea_id)
+            if resultado is not None:
+                self.descartar(tarea.tipo, resultado)
+            self.fallar(tarea, e)
+            return
+        tipo = tarea.tipo
+        tarea.estado = 'completada'
+        tarea.progreso = 100
+        tarea.eta = None
+        tarea.error = None
+        tarea.despachador = None
+        tarea.vence_en = None
+        tarea.fecha_fin = datetime.utcnow()
+        try:
+            db.session.commit()
+        except Exception as e:
+            # BD bloqueada, una restricción...: la fila vuelve a como estaba y los ficheros también
+            db.session.rollback()
+            self.rematar(tipo, tras_commit, False)
+            tarea = db.session.get(Tarea, tarea_id)
+            if tarea is not None:
+                self.fallar(tarea, e)
+            return
+        self.rematar(tipo, tras_commit, True)
+
+    def rematar(self, tipo, tras_commit, confirmado):
+        if tras_commit is None:
+            return
+        try:
+            tras_commit(confirmado)
+        except OSError as e:
+            print(f"⚠️ No se pudieron ajustar los ficheros de una tarea {tipo} tras el commit: {e}")
+
+    def descartar(self, tipo, resultado):
+        if TIPOS[tipo].descartar is None:
+            return
+        try:
+            TIPOS[tipo].descartar(resultado)
+        except OSError as e:
+            print(f"⚠️ No se pudo descartar el resultado de una tarea {tipo}: {e}")
+
+    def drenar_mensajes(self):
+        """Aplica los avisos de progreso y ETA enviados por los hijos."""
+        cambios = {}
+        while True:
+            try:
+                tarea_id, clave, valor = self._cola.get_nowait()
+            except queue.Empty:
+                break
+            if clave == 'pid':
+                self.pids[tarea_id] = valor
+            elif clave in ('progreso', 'eta'):
+                cambios.setdefault(tarea_id, {})[clave] = valor
+        for tarea_id, valores in cambios.items():
+            Tarea.query.filter_by(id=tarea_id, estado='en_curso', despachador=self.id).update(
+                {**valores, 'fecha_actualizada': datetime.utcnow()},
+                synchronize_session=False,
+            )
+        if cambios:
+            db.session.commit()
+
+    def detener_canceladas(self):
+        """Para las tareas en curso que se han cancelado desde fuera."""
+        if not self.en_curso:
+            return
+        canceladas = {
+            tarea_id for (tarea_id,) in db.session.query(Tarea.id).filter(
+                Tarea.id.in_(list(self.en_curso.values())), Tarea.estado == 'cancelada'
+            )
+        }
+        for futuro, tarea_id in self.en_curso.items():
+            if tarea_id not in canceladas or futuro.cancel():
+                continue
+            # Ya en ejecución: se mata el proceso externo y el hijo falla por su cuenta
+            pid = self.pids.pop(tarea_id, None)
+            if pid is not None:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def ciclo(self):
+        """Una vuelta del bucle: recoge terminadas, progreso y reclama nuevas."""
+        for futuro in [f for f in self.en_curso if f.done()]:
+            try:
+                self.finalizar(futuro)
+            except BrokenProcessPool:
+                # Un hijo murió (p. ej. sin memoria): se reinicia el pool
+                for pendiente in list(self.en_curso):
+                    tarea = db.session.get(Tarea, self.en_curso.pop(pendiente))
+                    # Borrada (o purgada) mientras corría: no hay nada que marcar
+                    if tarea is not None:
+                        self.fallar(tarea, 'Pool reiniciado')
+                self.pids.clear()
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._nuevo_pool()
+                return 0
+        self.drenar_mensajes()
+        self.detener_canceladas()
+        self.renovar()
+
+        libres = self.procesos - len(self.en_curso)
+        reclamadas = self.reclamar(libres) if libres > 0 else []
+        for tarea_id in reclamadas:
+            self.lanzar(tarea_id)
+        return len(reclamadas)
+
+    def ejecutar(self, hasta_vaciar=False, intervalo=1.0):
+        """Bucle principal. Con `hasta_vaciar` termina cuando no quedan tareas listas."""
+        self._pool = self._nuevo_pool()
+        try:
+            while not self.parar.is_set():
+                with self.app.app_context():
+                    nuevas = self.ciclo()
+                    if hasta_vaciar and not nuevas and not self.en_curso:
+                        break
+                if self.en_curso:
+                    wait(list(self.en_curso), timeout=intervalo, return_when=FIRST_COMPLETED)
+                elif not nuevas:
+                    self.parar.wait(intervalo)
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def iniciar_en_segundo_plano(app):
+    """Arranca un despachador en un hilo demonio del propio servidor."""
+    despachador = Despachador(app)
+    hilo = threading.Thread(target=despachador.ejecutar, name='despachador-tareas', daemon=True)
+    hilo.start()
+    return despachador
@@ -0,0 +1,120 @@
+"""Previsualización al buscar en los vídeos ("trickplay").
+
+Una sola pasada de ffmpeg saca un fotograma cada pocos segundos, lo reduce y
+lo coloca en hojas JPEG en rejilla (filtro `tile`). Junto a las hojas se
+escribe una pista WebVTT de miniaturas: cada cue apunta a su recorte con
+`hoja_NNN.jpg#xywh=x,y,ancho,alto`. El reproductor descarga la pista y las
+hojas una vez y pinta la vista previa sin pedir más rangos del vídeo.
+
+Como las miniaturas, se guardan por hash de contenido en
+TRICKPLAY_FOLDER/<ab>/<hash>/ y `Archivo.trickplay` guarda el hash.
+"""
+import math
+import os
+import shutil
+import uuid
+
+from flask import current_app, session, url_for
+from PIL import Image
+
+from utils import ejecutar_ffmpeg
+
+PISTA = 'index.vtt'
+PATRON_HOJA = 'hoja_{:03d}.jpg'
+
+
+def carpeta_trickplay(clave, carpeta=None):
+    carpeta = carpeta or current_app.config['TRICKPLAY_FOLDER']
+    return os.path.join(carpeta, clave[:2], clave)
+
+
+def url_trickplay(archivo):
+    """URL de la pista WebVTT de `archivo`, o None si no tiene o el usuario no puede verla."""
+    if not archivo.trickplay:
+        return None
+    if archivo.es_privado and not session.get('acceso_privado'):
+        return None
+    return url_for('trickplay', id=archivo.id, fichero=PISTA, v=archivo.trickplay[:8])
+
+
+def parametros_generacion():
+    """Ajustes de TRICKPLAY_* para pasarlos a un proceso hijo."""
+    config = current_app.config
+    return {
+        'carpeta': config['TRICKPLAY_FOLDER'],
+        'intervalo': config['TRICKPLAY_INTERVALO'],
+        'max_fotogramas': config['TRICKPLAY_MAX_FOTOGRAMAS'],
+        'ancho': config['TRICKPLAY_ANCHO'],
+        'rejilla': tuple(config['TRICKPLAY_REJILLA']),
+    }
+
+
+def _marca_tiempo(segundos):
+    horas, resto = divmod(segundos, 3600)
+    minutos, segundos = divmod(resto, 60)
+    return f"{int(horas):02d}:{int(minutos):02d}:{segundos:06.3f}"
+
+
+def escribir_pista(ruta, duracion, intervalo, fotogramas, celda, rejilla, version):
+    """Escribe la pista WebVTT de miniaturas de `fotogramas` celdas."""
+    columnas, filas = rejilla
+    ancho, alto = celda
+    por_hoja = columnas * filas
+    lineas = ['WEBVTT', '']
+    for indice in range(fotogramas):
+        inicio = indice * intervalo
+        fin = min((indice + 1) * intervalo, duracion)
+        posicion = indice % por_hoja
+        x, y = (posicion % columnas) * ancho, (posicion // columnas) * alto
+        # Relativa a la pista; la versión evita hojas de otro contenido en la caché
+        hoja = PATRON_HOJA.format(indice // por_hoja)
+        lineas += [
+            f"{_marca_tiempo(inicio)} --> {_marca_tiempo(fin)}",
+            f"{hoja}?v={version}#xywh={x},{y},{ancho},{alto}",
+            '',
+        ]
+    with open(ruta, 'w', encoding='utf-8') as pista:
+        pista.write('\n'.join(lineas))
+
+
+def generar_trickplay(ruta, clave, duracion, carpeta, intervalo, max_fotogramas, ancho, rejilla,
+                      al_progresar=None, al_iniciar=None):
+    """Genera hojas y pista de un vídeo en su carpeta. Devuelve la clave."""
+    if not duracion or duracion <= 0:
+        raise RuntimeError("Duración desconocida: no se puede repartir los fotogramas")
+    # En vídeos largos se separan más los fotogramas para no pasar de max_fotogramas
+    intervalo = max(intervalo, math.ceil(duracion / max_fotogramas))
+    columnas, filas = rejilla
+
+    destino = carpeta_trickplay(clave, carpeta)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporal = os.path.join(os.path.dirname(destino), f".{uuid.uuid4().hex}")
+    os.makedirs(temporal)
+    try:
+        ejecutar_ffmpeg(
+            # Solo se decodifican los fotogramas clave: la vista previa cae en el
+            # último anterior a cada instante, a cambio de ir muchas veces más rápido
+            ['-skip_frame', 'nokey', '-i', ruta, '-an', '-sn', '-dn',
+             '-vf', f"fps=1/{intervalo},scale={ancho}:-2,tile={columnas}x{filas}",
+             '-q:v', '5', '-start_number', '0',
+             os.path.join(temporal, PATRON_HOJA.replace('{:03d}', '%03d'))],
+            duracion=duracion,
+            al_progresar=al_progresar,
+            al_iniciar=al_iniciar,
+        )
+        hojas = [nombre for nombre in os.listdir(temporal) if nombre.startswith('hoja_')]
+        if not hojas:
+            raise RuntimeError("ffmpeg no generó ninguna hoja")
+        with Image.open(os.path.join(temporal, PATRON_HOJA.format(0))) as hoja:
+            celda = (hoja.width // columnas, hoja.height // filas)
+
+        fotogramas = min(math.ceil(duracion / intervalo), len(hojas) * columnas * filas)
+        escribir_pista(os.path.join(temporal, PISTA), duracion, intervalo, fotogramas, celda, rejilla, clave[:8])
+
+        if os.path.isdir(destino):
+            shutil.rmtree(destino)
+        os.replace(temporal, destino)
+    finally:
+        if os.path.isdir(temporal):
+            shutil.rmtree(temporal)
+    return clave
@@ -1,58 +1,170 @@
 from functools import wraps
 from flask import session, redirect, url_for, flash
-from pdf2image import convert_from_path
-from PIL import Image
-import hashlib
+from sqlalchemy import and_
+from models import Archivo
+import json
+from pathlib import Path
 import subprocess
+import tempfile
+import time
 import os
 
-def guardar_miniatura_si_es_imagen(ruta_original, ruta_destino, tipo_mime):
-    try:
-        if not tipo_mime.startswith('image/'):
-            return False  # No es imagen, omitir
-
-        with Image.open(ruta_original) as im:
-            im.convert('RGB').thumbnail((300, 300))
-            im.save(ruta_destino, format='JPEG')
-        return True
-    except Exception as e:
-        print(f"⚠️ Error generando miniatura para {ruta_original}: {e}")
-        return False
+def convertir_doc_a_pdf(ruta_doc, destino):
+    """Convierte un documento de ofimática a PDF en `destino` con LibreOffice.
+
+    Lanza RuntimeError si LibreOffice falla o no genera el PDF.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(destino), prefix='.parcial_') as temporal:
+        # Perfil propio: dos LibreOffice con el mismo perfil no arrancan a la vez
+        perfil = Path(temporal, 'perfil').as_uri()
+        try:
+            subprocess.run([
+                'libreoffice',
+                f'-env:UserInstallation={perfil}',
+                '--headless',
+                '--convert-to', 'pdf',
+                '--outdir', temporal,
+                ruta_doc
+            ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        except OSError as e:
+            raise RuntimeError(f"No se pudo lanzar LibreOffice: {e}")
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f"LibreOffice terminó con código {e.returncode}: {(e.stderr or '').strip()[-500:]}")
+        pdf = os.path.join(temporal, os.path.splitext(os.path.basename(ruta_doc))[0] + '.pdf')
+        if not os.path.isfile(pdf):
+            raise RuntimeError("LibreOffice no generó el PDF")
+        os.replace(pdf, destino)
+
+# Audio que se extrae tal cual, sin recodificar: códec -> extensión del fichero
+AUDIO_SIN_RECODIFICAR = {'aac': 'm4a', 'mp3': 'mp3'}
 
-def convertir_doc_a_pdf(ruta_doc, carpeta_salida):
-    print(f"🔁 Convirtiendo Word a PDF: {ruta_doc}")
+def plan_audio(datos, formato='mp3'):
+    """(extensión, argumentos de ffmpeg) para extraer la pista de audio de un vídeo.
+
+    `datos` es lo que devuelve sondear_media. Si el audio ya es AAC o MP3 se
+    copia tal cual (en .m4a o .mp3), en segundos; el resto se recodifica a `formato`.
+    """
+    codec = (datos or {}).get('audio_codec')
+    if codec in AUDIO_SIN_RECODIFICAR:
+        return AUDIO_SIN_RECODIFICAR[codec], ['-c:a', 'copy']
+    return formato, ['-q:a', '0']
+
+def duracion_media(ruta):
+    """Duración en segundos según ffprobe, o None si no se puede leer."""
     try:
-        subprocess.run([
-            'libreoffice',
-            '--headless',
-            '--convert-to', 'pdf',
-            '--outdir', carpeta_salida,
-            ruta_doc
-        ], check=True)
-        print(f"✅ Conversión completada: {os.path.basename(ruta_doc)}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Error al convertir Word → PDF: {e}")
-        return False
+        datos = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=nw=1:nk=1', ruta],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True
+        )
+        return float(datos.stdout.strip())
+    except (OSError, ValueError):
+        return None
+
+def sondear_media(ruta):
+    """Códecs, perfil, formato de píxel, duración, resolución, bitrate y nº de pistas con un único ffprobe en JSON.
+
+    Lanza RuntimeError si ffprobe no puede leer el fichero.
+    """
+    datos = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', ruta],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    if datos.returncode != 0:
+        raise RuntimeError(f"ffprobe no pudo leer {os.path.basename(ruta)}: {datos.stderr.strip()[-300:]}")
+
+    sondeo = json.loads(datos.stdout or '{}')
+    formato = sondeo.get('format', {})
+    # Las carátulas de los audios aparecen como pistas de vídeo: no cuentan
+    streams = [s for s in sondeo.get('streams', []) if not s.get('disposition', {}).get('attached_pic')]
+    video = [s for s in streams if s.get('codec_type') == 'video']
+    audio = [s for s in streams if s.get('codec_type') == 'audio']
+
+    def numero(valor, tipo=float):
+        try:
+            return tipo(valor)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        'formato': formato.get('format_name'),
+        'duracion': numero(formato.get('duration')),
+        'bitrate': numero(formato.get('bit_rate'), int),
+        'video_codec': video[0].get('codec_name') if video else None,
+        'audio_codec': audio[0].get('codec_name') if audio else None,
+        'ancho': video[0].get('width') if video else None,
+        'alto': video[0].get('height') if video else None,
+        'formato_pixel': video[0].get('pix_fmt') if video else None,
+        'perfil_video': video[0].get('profile') if video else None,
+        'streams_video': len(video),
+        'streams_audio': len(audio),
+        'streams_subtitulos': sum(1 for s in streams if s.get('codec_type') == 'subtitle'),
+    }
 
-def convertir_video_a_audio(ruta_video, carpeta_salida, formato='mp3'):
-    nombre_base = os.path.splitext(os.path.basename(ruta_video))[0]
-    salida = os.path.join(carpeta_salida, f"{nombre_base}.{formato}")
+def necesita_faststart(ruta):
+    """True si un MP4/MOV tiene el índice (átomo moov) detrás de los datos (mdat).
 
-    print(f"🔁 Extrayendo audio de: {ruta_video}")
+    Así el navegador tiene que pedir el final del fichero, o el fichero entero,
+    antes de empezar a reproducir. Solo lee las cabeceras de los átomos de primer nivel.
+    """
     try:
-        subprocess.run([
-            'ffmpeg',
-            '-i', ruta_video,
-            '-q:a', '0',
-            '-map', 'a',
-            salida
-        ], check=True)
-        print(f"✅ Audio generado: {salida}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Error al convertir video → audio: {e}")
-        return False
+        with open(ruta, 'rb') as f:
+            total = os.fstat(f.fileno()).st_size
+            posicion = 0
+            while posicion + 8 <= total:
+                f.seek(posicion)
+                cabecera = f.read(16)
+                tamano, tipo = int.from_bytes(cabecera[:4], 'big'), cabecera[4:8]
+                if tamano == 1:  # Tamaño de 64 bits tras el tipo
+                    tamano = int.from_bytes(cabecera[8:16], 'big')
+                elif tamano == 0:  # Hasta el final del fichero
+                    tamano = total - posicion
+                if tipo == b'moov':
+                    return False
+                if tipo == b'mdat':
+                    return True
+                if tamano < 8:
+                    return False  # Cabecera corrupta: mejor no tocarlo
+                posicion += tamano
+    except OSError:
+        pass
+    return False
+
+def ejecutar_ffmpeg(argumentos, duracion=None, al_progresar=None, al_iniciar=None):
+    """Ejecuta ffmpeg leyendo su salida -progress.
+
+    `al_iniciar(pid)` se llama al lanzar el proceso y `al_progresar(porcentaje, eta)`
+    en cada bloque de progreso, con la ETA en segundos calculada por el ritmo real.
+    Lanza RuntimeError con el final del log de ffmpeg si termina con error.
+    """
+    comando = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-progress', 'pipe:1', *argumentos]
+    with tempfile.TemporaryFile(mode='w+') as log:
+        proceso = subprocess.Popen(comando, stdout=subprocess.PIPE, stderr=log, text=True)
+        if al_iniciar:
+            al_iniciar(proceso.pid)
+
+        inicio = time.monotonic()
+        segundos = 0.0
+        for linea in proceso.stdout:
+            clave, _, valor = linea.strip().partition('=')
+            # out_time_ms también viene en microsegundos (nombre histórico de ffmpeg)
+            if clave in ('out_time_us', 'out_time_ms'):
+                try:
+                    segundos = int(valor) / 1_000_000
+                except ValueError:
+                    pass
+            elif clave == 'progress' and al_progresar and duracion and segundos > 0:
+                porcentaje = min(99.9, 100 * segundos / duracion)
+                eta = (time.monotonic() - inicio) * (duracion - segundos) / segundos
+                al_progresar(round(porcentaje, 1), max(0, int(eta)))
+
+        if proceso.wait() != 0:
+            log.seek(0)
+            detalle = log.read().strip()[-500:]
+            raise RuntimeError(f"ffmpeg terminó con código {proceso.returncode}: {detalle}")
 
 def login_requerido(f):
     @wraps(f)
@@ -70,39 +182,24 @@ def usuario_puede_ver(archivo):
         return session.get('acceso_privado', False)
     return True
 
-def generar_miniatura_pdf(ruta_pdf, ruta_destino):
-    try:
-        paginas = convert_from_path(ruta_pdf, first_page=1, last_page=1, size=(300, None))
-        if paginas:
-            paginas[0].save(ruta_destino, 'JPEG')
-            return True
-    except Exception as e:
-        print(f"⚠️ Error al generar miniatura PDF: {e}")
-    return False
+def condicion_visible(ver_privados=None):
+    """Equivalente SQL de usuario_puede_ver, para filtrar en la propia consulta.
 
-def generar_miniatura_video(ruta_video, ruta_destino):
-    try:
-        comando = [
-            'ffmpeg', '-y',
-            '-i', ruta_video,
-            '-ss', '00:00:03',
-            '-vframes', '1',
-            '-vf', 'scale=320:-1',
-            ruta_destino
-        ]
-        subprocess.run(comando, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return os.path.exists(ruta_destino)
-    except Exception as e:
-        print(f"🎥 Error al generar miniatura video: {e}")
-        return False
+    `ver_privados` sustituye al acceso privado de la sesión (fuera de una petición).
+    """
+    if ver_privados is None:
+        ver_privados = session.get('acceso_privado', False)
+    condicion = Archivo.fecha_eliminado.is_(None)
+    if not ver_privados:
+        condicion = and_(condicion, Archivo.es_privado.is_(False))
+    return condicion
 
-def calcular_hash(ruta_archivo, algoritmo='md5'):
-    hash_func = hashlib.new(algoritmo)
-    try:
-        with open(ruta_archivo, 'rb') as f:
-            for bloque in iter(lambda: f.read(4096), b""):
-                hash_func.update(bloque)
-        return hash_func.hexdigest()
-    except Exception as e:
-        print(f"⚠️ Error calculando hash de {ruta_archivo}: {e}")
-        return None
+def nombre_libre(carpeta, nombre):
+    """`nombre` o, si ya existe en la carpeta, `base_1.ext`, `base_2.ext`..."""
+    base, extension = os.path.splitext(nombre)
+    candidato = nombre
+    contador = 1
+    while os.path.exists(os.path.join(carpeta, candidato)):
+        candidato = f"{base}_{contador}{extension}"
+        contador += 1
+    return candidato
@@ -0,0 +1,149 @@
+"""Variantes de imagen a demanda (/media/<id>/resize) con caché en disco LRU.
+
+Cada variante se genera la primera vez que se pide, a partir del original, y
+se guarda en VARIANTES_FOLDER/<ab>/<hash>_<ancho>x<alto>.<ext>. Solo se
+admiten los anchos y altos de VARIANTES_MEDIDAS, para que la caché no crezca
+con cualquier combinación que alguien pida.
+
+La caché tiene un presupuesto de VARIANTES_MAX_BYTES: al pasarse se borran
+las variantes usadas hace más tiempo (el mtime hace de fecha de último uso y
+se refresca, como mucho una vez por hora, al servirlas). Dos peticiones
+simultáneas de la misma variante en un proceso la generan una sola vez; entre
+procesos, como mucho se genera dos veces y gana la última escritura, que es
+atómica.
+"""
+import os
+import threading
+import time
+
+from flask import current_app, session, url_for
+
+from miniaturas import EXTENSIONES, redimensionar
+
+# Cada cuánto se actualiza el mtime de una variante servida (segundos)
+REFRESCO_USO = 3600
+# Al pasarse del presupuesto se libera hasta quedar en esta fracción
+MARGEN_EVICCION = 0.9
+
+_cerrojo = threading.Lock()
+_en_curso = {}  # ruta -> threading.Event de la generación en marcha
+_ocupado = {}  # carpeta -> bytes estimados en la caché (None hasta el primer recuento)
+
+
+def ruta_variante(archivo, ancho, alto, formato):
+    carpeta = current_app.config['VARIANTES_FOLDER']
+    clave = archivo.hash_archivo
+    medida = f"{ancho or ''}x{alto or ''}"
+    return os.path.join(carpeta, clave[:2], f"{clave}_{medida}{EXTENSIONES[formato]}")
+
+
+def admite_variantes(archivo):
+    return bool(archivo.hash_archivo) and (archivo.tipo or '').startswith('image/')
+
+
+def url_variante(archivo, ancho=None, alto=None, formato=None):
+    """URL de una variante, o None si el archivo no la admite o el usuario no puede verlo."""
+    if not admite_variantes(archivo):
+        return None
+    if archivo.es_privado and not session.get('acceso_privado'):
+        return None
+    parametros = {'w': ancho, 'h': alto, 'fmt': formato}
+    # Con el hash en la URL la respuesta puede ser `immutable`
+    return url_for('redimensionar_media', id=archivo.id, v=archivo.hash_archivo[:8],
+                   **{clave: valor for clave, valor in parametros.items() if valor})
+
+
+def srcset_variantes(archivo, hasta=None):
+    """srcset con los anchos permitidos (hasta `hasta` px), o None."""
+    if url_variante(archivo) is None:
+        return None
+    anchos = [ancho for ancho in current_app.config['VARIANTES_MEDIDAS'] if hasta is None or ancho <= hasta]
+    return ', '.join(f"{url_variante(archivo, ancho)} {ancho}w" for ancho in anchos)
+
+
+def obtener_variante(archivo, ancho, alto, formato):
+    """Ruta de la variante, generándola si no está en la caché."""
+    ruta = ruta_variante(archivo, ancho, alto, formato)
+    while True:
+        try:
+            _marcar_uso(ruta)
+            return ruta
+        except FileNotFoundError:
+            pass
+
+        with _cerrojo:
+            generando = _en_curso.get(ruta)
+            if generando is None:
+                generando = _en_curso[ruta] = threading.Event()
+                propia = True
+            else:
+                propia = False
+        if not propia:
+            # Otra petición la está generando: se espera y se vuelve a mirar
+            generando.wait()
+            if not os.path.exists(ruta):
+                raise RuntimeError(f"No se pudo generar la variante de {archivo.nombre}")
+            continue
+
+        try:
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            redimensionar(archivo.ruta, ruta, (ancho, alto), formato)
+        finally:
+            with _cerrojo:
+                del _en_curso[ruta]
+            generando.set()
+        _anotar(os.path.getsize(ruta))
+        return ruta
+
+
+def _marcar_uso(ruta):
+    """Refresca el mtime de una variante servida. FileNotFoundError si no existe."""
+    if time.time() - os.stat(ruta).st_mtime > REFRESCO_USO:
+        os.utime(ruta)
+
+
+def _anotar(bytes_nuevos):
+    carpeta = current_app.config['VARIANTES_FOLDER']
+    limite = current_app.config['VARIANTES_MAX_BYTES']
+    with _cerrojo:
+        ocupado = _ocupado.get(carpeta)
+        if ocupado is not None:
+            _ocupado[carpeta] = ocupado = ocupado + bytes_nuevos
+    if ocupado is None or ocupado > limite:
+        # Primer uso en este proceso o presupuesto agotado: se recuenta de verdad
+        _ocupado[carpeta] = podar(carpeta, limite)
+
+
+def _escanear(carpeta):
+    ficheros = []
+    try:
+        with os.scandir(carpeta) as subcarpetas:
+            for subcarpeta in subcarpetas:
+                if not subcarpeta.is_dir():
+                    continue
+                with os.scandir(subcarpeta.path) as entradas:
+                    for entrada in entradas:
+                        if entrada.is_file() and not entrada.name.startswith('.'):
+                            datos = entrada.stat()
+                            ficheros.append((datos.st_mtime, datos.st_size, entrada.path))
+    except FileNotFoundError:
+        pass
+    return ficheros
+
+
+def podar(carpeta, limite):
+    """Borra las variantes menos usadas si la caché pasa de `limite`. Devuelve los bytes que quedan."""
+    ficheros = _escanear(carpeta)
+    ocupado = sum(tamano for _, tamano, _ in ficheros)
+    if ocupado <= limite:
+        return ocupado
+    objetivo = limite * MARGEN_EVICCION
+    for _, tamano, ruta in sorted(ficheros):
+        if ocupado <= objetivo:
+            break
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass  # Otro proceso podando a la vez
+        ocupado -= tamano
+    return ocupado